@@ -0,0 +1,69 @@
+""" Compare random and optimised chain inits by divergences and posteriors, over several warmup lengths.
+
+Every run samples the same SimpleSimulation realisation with the same seed and number
+of saved draws. The reference is random inits with the full warmup. A shorter warmup
+is only safe for an init mode if it has no more divergences than the reference, and
+moves no posterior mean by more than ``MAX_SHIFT`` reference posterior widths. The
+table is logged, and every result is written to ``init_modes.json`` in this script's
+plot directory, so the comparison can be repeated on any machine with Stan.
+"""
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from dessn.framework.fitter import Fitter
+from dessn.framework.models.approx_model import ApproximateModel
+from dessn.framework.precision import to_sampler
+from dessn.framework.simulations.simple import SimpleSimulation
+
+PARAMETERS = ["Om", "alpha", "beta", "mean_MB", "log_sigma_MB", "sigma_MB", "alpha_c"]
+WARMUPS = [1000, 500, 250, 100]
+MAX_SHIFT = 0.1
+
+
+def run(fitter, model, data, mode, warmup, num_samples, num_chains, prefix):
+    fitter.set_init_mode(mode)
+    engine = fitter.get_engine(model)
+    sampler_data = to_sampler(data)
+    start = time.time()
+    inits = fitter.get_inits(engine, model, data, sampler_data, num_chains, prefix, 0)
+    draws, divergences = engine.sample(sampler_data, inits, num_samples, warmup, prefix, seed=0,
+                                       select=lambda available: [p for p in PARAMETERS if p in available])
+    return {"mode": mode, "warmup": warmup, "divergences": divergences, "duration": time.time() - start,
+            "means": {k: float(np.mean(v)) for k, v in draws.items()},
+            "stds": {k: float(np.std(v)) for k, v in draws.items()}}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(funcName)20s()] %(message)s")
+    plot_dir = os.path.dirname(os.path.abspath(__file__)) + "/plots/%s/" % os.path.basename(__file__)[:-3]
+    dir_name = plot_dir + "output/"
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+
+    model = ApproximateModel()
+    simulation = [SimpleSimulation(500), SimpleSimulation(300, lowz=True)]
+    fitter = Fitter(dir_name)
+    data = fitter.get_data(model, simulation, 0)
+    num_samples, num_chains = 1000, 4
+
+    results = []
+    for mode in ["random", "optimise"]:
+        for warmup in WARMUPS:
+            results.append(run(fitter, model, data, mode, warmup, num_samples, num_chains,
+                               dir_name + "init_%s_%d" % (mode, warmup)))
+
+    reference = results[0]
+    for result in results:
+        shifts = [np.abs(result["means"][k] - reference["means"][k]) / reference["stds"][k]
+                  for k in reference["means"] if reference["stds"][k] > 0]
+        result["max_shift"] = float(np.max(shifts))
+        result["safe"] = bool(result["divergences"] <= reference["divergences"] and result["max_shift"] < MAX_SHIFT)
+        logging.info("%8s warmup %4d: %3d divergences, largest mean shift %0.3f sigma, %0.0fs, %s"
+                     % (result["mode"], result["warmup"], result["divergences"], result["max_shift"],
+                        result["duration"], "safe" if result["safe"] else "not safe"))
+    with open(plot_dir + "init_modes.json", "w") as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,170 @@
+""" Content addressed cache of the data dictionaries models pass to Stan.
+
+``get_data`` output depends only on the model's settings, the simulations and the
+realisation, so it is stored as a pickle keyed on all three and on a hash of the
+framework source code. Loading it takes milliseconds, against seconds to minutes of
+merging surveys, remapping systematics and fitting selection functions. Simulations
+opt in through ``Simulation.get_data_key``, and anything that cannot be identified
+is simply rebuilt every time.
+
+Models that split ``get_data`` into a flag independent base and cheap flags (see
+``Model.get_base_config``) share the base between every model with the same base
+settings. It is cached alongside the final data, and the last one built is kept in
+memory, so fitting several variants of a model in one process builds it once.
+
+Entries drawn at random for each fit (see ``Model.get_random_data``) are never cached,
+and are drawn again every time the data is loaded.
+"""
+import hashlib
+import logging
+import os
+from multiprocessing import Pool
+
+from dessn.utility.cache import get_hash, load_cache, save_cache
+
+_code_version = None
+_last_base = [None, None]
+
+
+def get_code_version():
+    """ Hash of the source of the framework and utility packages, so cached data follows code changes. """
+    global _code_version
+    if _code_version is None:
+        h = hashlib.sha1()
+        base = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        for package in ["framework", "utility"]:
+            for root, dirs, files in os.walk(base + "/" + package):
+                dirs.sort()
+                for f in sorted(files):
+                    if f.endswith(".py") or f.endswith(".stan"):
+                        with open(root + "/" + f, "rb") as source:
+                            h.update(f.encode("utf-8"))
+                            h.update(source.read())
+        _code_version = h.hexdigest()
+    return _code_version
+
+
+def get_data_key(model, simulations, cosmology_index):
+    """ The cache key of a model's data, or None if a simulation cannot be identified. """
+    if not isinstance(simulations, list):
+        simulations = [simulations]
+    keys = [s.get_data_key(cosmology_index) for s in simulations]
+    if any([k is None for k in keys]):
+        return None
+    return get_hash(type(model).__name__, model.get_config(), keys, cosmology_index, get_code_version())
+
+
+def get_base_key(model, simulations, cosmology_index):
+    """ The cache key of a model's flag independent data, or None if it cannot be shared. """
+    config = model.get_base_config()
+    if config is None:
+        return None
+    if not isinstance(simulations, list):
+        simulations = [simulations]
+    keys = [s.get_data_key(cosmology_index) for s in simulations]
+    if any([k is None for k in keys]):
+        return None
+    return get_hash(type(model).get_base_data.__qualname__, config, keys, cosmology_index, get_code_version())
+
+
+def load_base_data(directory, model, simulations, cosmology_index):
+    """ Returns ``model.get_base_data(simulations, cosmology_index)``, from memory or the cache directory if possible. """
+    key = get_base_key(model, simulations, cosmology_index)
+    if key is None:
+        return model.get_base_data(simulations, cosmology_index)
+    if _last_base[0] == key:
+        return _last_base[1]
+    filename = None if directory is None else os.path.join(directory, "base_%s.pkl" % key)
+    data = None if filename is None else load_cache(filename)
+    if data is None:
+        data = model.get_base_data(simulations, cosmology_index)
+        if filename is not None:
+            save_cache(filename, data)
+    _last_base[:] = [key, data]
+    return data
+
+
+def add_random_data(model, data):
+    """ Returns ``data`` with the model's random entries drawn, leaving the cached dictionary untouched. """
+    random = model.get_random_data(data)
+    if not random:
+        return data
+    data = dict(data)
+    data.update(random)
+    return data
+
+
+def build_fixed_data(directory, model, simulations, cosmology_index):
+    """ The cacheable part of ``model.get_data``, sharing the flag independent part where possible. """
+    if model.get_base_config() is None:
+        return model.get_data(simulations, cosmology_index)
+    return model.apply_flags(load_base_data(directory, model, simulations, cosmology_index), simulations)
+
+
+def build_model_data(directory, model, simulations, cosmology_index):
+    """ Returns ``model.get_data(simulations, cosmology_index)``, sharing the flag independent part where possible. """
+    return add_random_data(model, build_fixed_data(directory, model, simulations, cosmology_index))
+
+
+def get_data_filename(directory, model, simulations, cosmology_index):
+    key = get_data_key(model, simulations, cosmology_index)
+    if key is None:
+        return None
+    return os.path.join(directory, "data_%s.pkl" % key)
+
+
+def load_data(directory, model, simulations, cosmology_index):
+    """ Returns ``model.get_data(simulations, cosmology_index)``, from the cache if possible. """
+    filename = get_data_filename(directory, model, simulations, cosmology_index)
+    if filename is None:
+        logging.info("Cannot identify the simulations of %s, not caching its data" % model.get_name())
+        return build_model_data(directory, model, simulations, cosmology_index)
+    data = load_cache(filename)
+    if data is None:
+        logging.info("Data cache miss for %s, building %s" % (model.get_name(), filename))
+        data = build_fixed_data(directory, model, simulations, cosmology_index)
+        save_cache(filename, data)
+    else:
+        logging.debug("Loaded data from %s" % filename)
+    return add_random_data(model, data)
+
+
+def _build_base_data(args):
+    directory, model, simulations, cosmology_index = args
+    load_base_data(directory, model, simulations, cosmology_index)
+    return cosmology_index
+
+
+def _build_data(args):
+    directory, model, simulations, cosmology_index = args
+    load_data(directory, model, simulations, cosmology_index)
+    return cosmology_index
+
+
+def build_data(directory, jobs, num_cpu=None):
+    """ Build the cached data for each ``(model, simulations, cosmology_index)`` job that is missing.
+
+    The shared flag independent data is built first, once for each simulation and
+    realisation, and then each model only has to apply its flags to it.
+    """
+    missing, bases, filenames = [], [], set()
+    for model, simulations, cosmology_index in jobs:
+        filename = get_data_filename(directory, model, simulations, cosmology_index)
+        if filename is None or filename in filenames or os.path.exists(filename):
+            continue
+        filenames.add(filename)
+        missing.append((directory, model, simulations, cosmology_index))
+        base_key = get_base_key(model, simulations, cosmology_index)
+        base_filename = None if base_key is None else os.path.join(directory, "base_%s.pkl" % base_key)
+        if base_filename is not None and base_filename not in filenames and not os.path.exists(base_filename):
+            filenames.add(base_filename)
+            bases.append((directory, model, simulations, cosmology_index))
+    logging.info("Building %d of %d data dictionaries in %s, sharing %d base dictionaries"
+                 % (len(missing), len(jobs), directory, len(bases)))
+    if not missing:
+        return
+    with Pool(processes=num_cpu) as pool:
+        for index in pool.imap_unordered(_build_base_data, bases):
+            logging.debug("Built base data for realisation %d" % index)
+        for index in pool.imap_unordered(_build_data, missing):
+            logging.debug("Built data for realisation %d" % index)
@@ -0,0 +1,257 @@
+""" Backends that run a Stan model for the :class:`Fitter`.
+
+:class:`PyStanEngine` is the original in-process PyStan 2 path. :class:`CmdStanEngine`
+runs a compiled CmdStan executable instead, with one process per chain, optional
+threading within each chain, and draws streamed from the CSV output so only the saved
+parameters are ever held in memory. Every engine returns draws as dictionaries of arrays
+with one row per draw, the same as ``fit.extract``.
+"""
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from dessn.framework.stan_helpers import find_mode, get_divergences, get_laplace_draws, get_transform_fit, \
+    jitter_inits, read_stan_csv, read_variational, run_variational, split_stan_csv
+
+
+class Engine(ABC):
+    def __init__(self, stan_file):
+        self.logger = logging.getLogger(__name__)
+        self.stan_file = stan_file
+
+    def prepare(self):
+        """ Called once before jobs are submitted, to build anything the jobs can share. """
+        pass
+
+    @abstractmethod
+    def sample(self, data, inits, num_samples, num_warmup, output_prefix, seed=None, select=None):
+        """ Run NUTS with one chain per init.
+
+        Returns the draws of the parameters chosen by ``select``, a function from the list of
+        parameter names to those wanted, and the number of divergent transitions.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_mode_inits(self, data, init, num_chains, output_prefix, scale=0.1, seed=0):
+        """ Optimise from ``init`` and return ``num_chains`` starting points scattered around the mode. """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def laplace(self, data, init, num_draws, output_prefix, seed=0):
+        """ Draws from a Gaussian approximation at the posterior mode, found starting from ``init``. """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def variational(self, data, init, output_prefix, algorithm="meanfield", num_draws=1000, seed=0):
+        """ Draws from Stan's ADVI, and diagnostics holding the ELBO trace and run time. """
+        raise NotImplementedError()
+
+
+class PyStanEngine(Engine):
+    def __init__(self, stan_file):
+        super().__init__(stan_file)
+        self._stan_model = None
+
+    def get_stan_model(self):
+        if self._stan_model is None:
+            import pystan
+            self._stan_model = pystan.StanModel(file=self.stan_file, model_name="Cosmology")
+        return self._stan_model
+
+    def sample(self, data, inits, num_samples, num_warmup, output_prefix, seed=None, select=None):
+        kwargs = {} if seed is None else {"seed": seed}
+        fit = self.get_stan_model().sampling(data=data, iter=num_samples + num_warmup, warmup=num_warmup,
+                                             chains=len(inits), init=inits, **kwargs)
+        params = fit.sim["pars_oi"] if select is None else select(fit.sim["pars_oi"])
+        return fit.extract(pars=params), get_divergences(fit)
+
+    def get_mode_inits(self, data, init, num_chains, output_prefix, scale=0.1, seed=0):
+        mode, _ = find_mode(self.get_stan_model(), data, init)
+        fit = get_transform_fit(self.get_stan_model(), data, mode)
+        return jitter_inits(fit, mode, num_chains, scale=scale, seed=seed)
+
+    def laplace(self, data, init, num_draws, output_prefix, seed=0):
+        mode, _ = find_mode(self.get_stan_model(), data, init)
+        fit = get_transform_fit(self.get_stan_model(), data, mode)
+        return get_laplace_draws(fit, mode, num_draws, seed=seed)
+
+    def variational(self, data, init, output_prefix, algorithm="meanfield", num_draws=1000, seed=0):
+        return run_variational(self.get_stan_model(), data, init, output_prefix, algorithm=algorithm,
+                               num_draws=num_draws, seed=seed)
+
+
+def write_json(filename, values):
+    """ Write data or inits in the JSON format CmdStan reads.
+
+    Entries that are not numeric rectangular arrays, like the per survey node lists, are
+    not Stan data and would be rejected by CmdStan's parser, so they are left out.
+    """
+    result = {}
+    for key, value in values.items():
+        try:
+            array = np.asarray(value)
+        except ValueError:
+            continue
+        if array.dtype == object or not (np.issubdtype(array.dtype, np.number) or array.dtype == bool):
+            continue
+        if array.dtype == bool:
+            array = array.astype(int)
+        result[key] = array.tolist()
+    with open(filename, "w") as f:
+        json.dump(result, f)
+
+
+class CmdStanEngine(Engine):
+    """ Runs chains as separate CmdStan processes.
+
+    Parameters
+    ----------
+    stan_file : str
+        The model to compile.
+    cmdstan : str, optional
+        The CmdStan installation, defaulting to the ``CMDSTAN`` environment variable.
+    num_threads : int, optional
+        Threads per chain. The model is then compiled with ``STAN_THREADS``.
+    build_dir : str, optional
+        Where executables are built, by default a ``build`` folder next to the Stan file.
+    """
+    def __init__(self, stan_file, cmdstan=None, num_threads=None, build_dir=None):
+        super().__init__(stan_file)
+        self.cmdstan = cmdstan or os.environ.get("CMDSTAN")
+        self.num_threads = num_threads
+        if build_dir is None:
+            build_dir = os.path.dirname(os.path.abspath(stan_file)) + "/build"
+        self.build_dir = build_dir
+        name = os.path.splitext(os.path.basename(stan_file))[0]
+        if num_threads is not None:
+            name += "_threads"
+        self.executable = self.build_dir + "/" + name
+
+    def prepare(self):
+        """ Compile the executable if it is missing or older than the Stan file. """
+        if os.path.exists(self.executable) and os.path.getmtime(self.executable) >= os.path.getmtime(self.stan_file):
+            return
+        assert self.cmdstan is not None, "Set the CMDSTAN environment variable or pass cmdstan to use CmdStan"
+        os.makedirs(self.build_dir, exist_ok=True)
+        shutil.copy(self.stan_file, self.executable + ".stan")
+        command = ["make", self.executable]
+        if self.num_threads is not None:
+            command.insert(1, "STAN_THREADS=true")
+        self.logger.info("Compiling %s with %s" % (self.executable, " ".join(command)))
+        result = subprocess.run(command, cwd=self.cmdstan, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        assert result.returncode == 0, "Compiling %s failed:\n%s" % (self.stan_file, result.stdout.decode("utf-8"))
+
+    def get_command(self, method, data_file, output_file, init_file=None, seed=None, chain=1):
+        command = [self.executable, "id=%d" % chain] + method + ["data", "file=%s" % data_file]
+        if init_file is not None:
+            command.append("init=%s" % init_file)
+        if seed is not None:
+            command += ["random", "seed=%d" % seed]
+        command += ["output", "file=%s" % output_file, "refresh=100"]
+        if self.num_threads is not None:
+            command.append("num_threads=%d" % self.num_threads)
+        return command
+
+    def run(self, commands, output_prefix):
+        """ Run the commands in parallel, logging each to its own file, and wait for them all. """
+        self.prepare()
+        processes = []
+        for i, command in enumerate(commands):
+            log = open("%s_%d.log" % (output_prefix, i + 1), "w")
+            processes.append((subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT), log))
+        for (process, log), command in zip(processes, commands):
+            process.wait()
+            log.close()
+            assert process.returncode == 0, "CmdStan failed running %s, see %s_*.log" % (" ".join(command), output_prefix)
+
+    def write_inits(self, inits, output_prefix):
+        filenames = []
+        for i, init in enumerate(inits):
+            filenames.append("%s_init_%d.json" % (output_prefix, i + 1))
+            write_json(filenames[-1], init)
+        return filenames
+
+    def sample(self, data, inits, num_samples, num_warmup, output_prefix, seed=None, select=None):
+        data_file = output_prefix + "_data.json"
+        write_json(data_file, data)
+        init_files = self.write_inits(inits, output_prefix)
+        output_files = ["%s_chain_%d.csv" % (output_prefix, i + 1) for i in range(len(inits))]
+        method = ["method=sample", "num_samples=%d" % num_samples, "num_warmup=%d" % num_warmup]
+        start = time.time()
+        self.run([self.get_command(method, data_file, output_file, init_file=init_file, seed=seed, chain=i + 1)
+                  for i, (init_file, output_file) in enumerate(zip(init_files, output_files))], output_prefix)
+        self.logger.info("%d CmdStan chains finished in %0.1fs" % (len(inits), time.time() - start))
+
+        chains, divergences = [], 0
+        for output_file in output_files:
+            draws, diagnostics = split_stan_csv(*read_stan_csv(output_file, select=select))
+            chains.append(draws)
+            divergences += int(np.sum(diagnostics.get("divergent__", 0)))
+            os.remove(output_file)
+        for f in [data_file] + init_files:
+            os.remove(f)
+        return {k: np.concatenate([c[k] for c in chains]) for k in chains[0]}, divergences
+
+    def optimise(self, data_file, init, output_prefix, jacobian=False):
+        """ Run the optimiser, returning the CSV file holding the mode. """
+        init_file = self.write_inits([init], output_prefix)[0]
+        output_file = output_prefix + "_mode.csv"
+        method = ["method=optimize"] + (["jacobian=1"] if jacobian else [])
+        self.run([self.get_command(method, data_file, output_file, init_file=init_file)], output_prefix)
+        os.remove(init_file)
+        return output_file
+
+    def laplace_file(self, data_file, mode_file, num_draws, output_prefix, seed=0):
+        output_file = output_prefix + "_laplace.csv"
+        method = ["method=laplace", "mode=%s" % mode_file, "jacobian=1", "draws=%d" % num_draws]
+        self.run([self.get_command(method, data_file, output_file, seed=seed)], output_prefix)
+        draws, _ = split_stan_csv(*read_stan_csv(output_file))
+        os.remove(output_file)
+        return draws
+
+    def get_mode_inits(self, data, init, num_chains, output_prefix, scale=0.1, seed=0):
+        """ CmdStan exposes no parameter transforms to jitter with, so the starts are drawn
+        from the Laplace approximation at the mode instead, and ``scale`` is unused. """
+        data_file = output_prefix + "_data.json"
+        write_json(data_file, data)
+        mode_file = self.optimise(data_file, init, output_prefix)
+        draws = self.laplace_file(data_file, mode_file, num_chains, output_prefix, seed=seed)
+        for f in [data_file, mode_file]:
+            os.remove(f)
+        return [{k: v[i] for k, v in draws.items()} for i in range(num_chains)]
+
+    def laplace(self, data, init, num_draws, output_prefix, seed=0):
+        data_file = output_prefix + "_data.json"
+        write_json(data_file, data)
+        mode_file = self.optimise(data_file, init, output_prefix, jacobian=True)
+        draws = self.laplace_file(data_file, mode_file, num_draws, output_prefix, seed=seed)
+        for f in [data_file, mode_file]:
+            os.remove(f)
+        return draws
+
+    def variational(self, data, init, output_prefix, algorithm="meanfield", num_draws=1000, seed=0):
+        data_file = output_prefix + "_data.json"
+        write_json(data_file, data)
+        init_file = self.write_inits([init], output_prefix)[0]
+        sample_file = output_prefix + "_samples.csv"
+        diagnostic_file = output_prefix + "_diagnostics.csv"
+        method = ["method=variational", "algorithm=%s" % algorithm, "output_samples=%d" % num_draws]
+        command = self.get_command(method, data_file, sample_file, init_file=init_file, seed=seed)
+        command.insert(command.index("refresh=100"), "diagnostic_file=%s" % diagnostic_file)
+        start = time.time()
+        self.run([command], output_prefix)
+        duration = time.time() - start
+        draws, elbo = read_variational(sample_file, diagnostic_file)
+        for f in [data_file, init_file]:
+            os.remove(f)
+        return draws, {"algorithm": algorithm, "duration": duration, "num_draws": num_draws, "elbo": elbo}
+
+
+ENGINES = {"pystan": PyStanEngine, "cmdstan": CmdStanEngine}
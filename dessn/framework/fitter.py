@@ -1,7 +1,9 @@
+import json
 import logging
 import os
 import pickle
 import socket
+import time
 from collections import OrderedDict
 
 import numpy as np
@@ -9,6 +11,10 @@ import sys
 
 import shutil
 
+from dessn.framework.data_cache import build_data, build_model_data, load_data
+from dessn.framework.engines import ENGINES, PyStanEngine
+from dessn.framework.precision import check_rounding, to_sampler
+from dessn.framework.stan_helpers import get_deterministic_init
 from dessn.utility.doJob import write_jobscript_slurm
 
 
@@ -22,6 +28,14 @@ class Fitter(object):
         self.logger = logging.getLogger(__name__)
         self.temp_dir = temp_dir
         self.max_steps = 3000
+        self.data_cache = None
+        self.init_mode = "random"
+        self.init_jitter = 0.1
+        self.fit_mode = "nuts"
+        self.num_draws = 2000
+        self.engine = PyStanEngine
+        self.engine_options = {}
+        self._engines = {}
         if not os.path.exists(temp_dir):
             os.makedirs(temp_dir)
 
@@ -40,6 +54,66 @@ class Fitter(object):
         self.num_cosmologies = num_cosmologies
         return self
 
+    def set_data_cache(self, directory):
+        """ Cache each job's Stan data in the directory, so it is built once rather than by every job. """
+        self.data_cache = directory
+        return self
+
+    def set_init_mode(self, mode="optimise", jitter=0.1):
+        """ How to start the chains, either "random" from the model's get_init, or "optimise".
+
+        With "optimise", Stan's optimiser finds the mode from a deterministic start, and each
+        chain starts from the mode jittered by ``jitter`` in the unconstrained space. The warmup
+        length is unchanged, see ``dessn/configurations/init_modes.py`` to compare the modes.
+        """
+        assert mode in ["random", "optimise"], "Init mode %s is not random or optimise" % mode
+        self.init_mode = mode
+        self.init_jitter = jitter
+        return self
+
+    def set_fit_mode(self, mode="nuts", num_draws=2000):
+        """ How run_fit explores the posterior, either "nuts", "laplace", "meanfield" or "fullrank".
+
+        "laplace" finds the posterior mode and approximates the posterior as a Gaussian with
+        the inverse Hessian at the mode as its covariance, and saves ``num_draws`` draws from
+        that in the usual chain format. It takes seconds rather than hours, which is enough for
+        screening bias studies, but is no substitute for full sampling in final runs.
+
+        "meanfield" and "fullrank" fit a diagonal or dense Gaussian with Stan's variational
+        inference, starting from the model's init, and save ``num_draws`` draws from it. The
+        ELBO trace and run time are written next to the chain as ``*_vb.json``.
+        """
+        assert mode in ["nuts", "laplace", "meanfield", "fullrank"], "Fit mode %s is not supported" % mode
+        self.fit_mode = mode
+        self.num_draws = num_draws
+        return self
+
+    def set_engine(self, engine="pystan", **options):
+        """ The backend that runs Stan, either "pystan", "cmdstan" or an :class:`Engine` subclass.
+
+        ``options`` are passed to the engine, for example ``cmdstan`` and ``num_threads`` for
+        :class:`CmdStanEngine`.
+        """
+        if isinstance(engine, str):
+            assert engine in ENGINES, "Engine %s is not one of %s" % (engine, list(ENGINES.keys()))
+            engine = ENGINES[engine]
+        self.engine = engine
+        self.engine_options = options
+        self._engines = {}
+        return self
+
+    def get_engine(self, model):
+        stan_file = model.get_stan_file()
+        if stan_file not in self._engines:
+            self._engines[stan_file] = self.engine(stan_file, **self.engine_options)
+        return self._engines[stan_file]
+
+    def get_inits(self, engine, model, data, sampler_data, num_chains, prefix, seed):
+        if self.init_mode == "optimise":
+            init = get_deterministic_init(model, sampler_data)
+            return engine.get_mode_inits(sampler_data, init, num_chains, prefix, scale=self.init_jitter, seed=seed)
+        return [model.get_init(**data) for _ in range(num_chains)]
+
     def set_num_cpu(self, num_cpu=None):
         if num_cpu is None:
             self.num_cpu = self.num_cosmologies * self.num_walkers
@@ -82,24 +156,33 @@ class Fitter(object):
         else:
             w, n = 500, 1000
 
-        data = model.get_data(sim, cosmo_index)
+        data = self.get_data(model, sim, cosmo_index)
+        check_rounding(data)
+        sampler_data = to_sampler(data)
         self.logger.info("Running Stan job, saving to %s" % out_file)
-        import pystan
-        sm = pystan.StanModel(file=model.get_stan_file(), model_name="Cosmology")
-        fit = sm.sampling(data=data, iter=n, warmup=w, chains=num_cores, init=model.get_init_wrapped(**data))
-        self.logger.info("Stan finished sampling")
-
-        # Get parameters
-        params = [p for p in model.get_parameters() if p in fit.sim["pars_oi"]]
-        print("SAVING parameters:")
-        print(params)
-        if "weight" in fit.sim["pars_oi"]:
-            self.logger.debug("Found weight to save")
-            params.append("weight")
-        if "posterior" in fit.sim["pars_oi"]:
-            self.logger.debug("Found posterior to save")
-            params.append("posterior")
-        dictionary = fit.extract(pars=params)
+        engine = self.get_engine(model)
+        prefix = out_file[:-len(".pkl")]
+        start = time.time()
+        if self.fit_mode == "laplace":
+            init = get_deterministic_init(model, sampler_data)
+            draws = engine.laplace(sampler_data, init, self.num_draws, prefix, seed=walker_index)
+            self.logger.info("Laplace approximation finished in %0.1fs" % (time.time() - start))
+            params = self.get_saved_parameters(model, draws.keys())
+            dictionary = {p: draws[p] for p in params}
+        elif self.fit_mode in ["meanfield", "fullrank"]:
+            init = self.get_inits(engine, model, data, sampler_data, 1, prefix, walker_index)[0]
+            draws, diagnostics = engine.variational(sampler_data, init, prefix, algorithm=self.fit_mode,
+                                                    num_draws=self.num_draws, seed=walker_index)
+            with open(prefix + "_vb.json", "w") as f:
+                json.dump(diagnostics, f)
+            params = self.get_saved_parameters(model, draws.keys())
+            dictionary = {p: draws[p] for p in params}
+        else:
+            inits = self.get_inits(engine, model, data, sampler_data, num_cores, prefix, walker_index)
+            dictionary, divergences = engine.sample(sampler_data, inits, n - w, w, prefix,
+                                                    select=lambda available: self.get_saved_parameters(model, available))
+            self.logger.info("Stan finished sampling in %0.1fs with %d warmup steps and %d divergent transitions"
+                             % (time.time() - start, w, divergences))
 
         # Turn log scale parameters into normal scale to see them easier
         for key in list(dictionary.keys()):
@@ -114,6 +197,39 @@ class Fitter(object):
             pickle.dump(dictionary, output)
         self.logger.info("Saved chain to %s" % out_file)
 
+    def get_saved_parameters(self, model, available):
+        params = [p for p in model.get_parameters() if p in available]
+        print("SAVING parameters:")
+        print(params)
+        if "weight" in available:
+            self.logger.debug("Found weight to save")
+            params.append("weight")
+        if "posterior" in available:
+            self.logger.debug("Found posterior to save")
+            params.append("posterior")
+        return params
+
+    def prepare_simulations(self, num_cpu=None):
+        """ Generate each simulation's realisations once, rather than once per job. """
+        for sims in self.simulations:
+            if not type(sims) == list:
+                sims = [sims]
+            for sim in sims:
+                sim.prepare(self.num_cosmologies, num_cpu=num_cpu)
+
+    def get_data(self, model, simulation, cosmo_index):
+        if self.data_cache is None:
+            return build_model_data(None, model, simulation, cosmo_index)
+        return load_data(self.data_cache, model, simulation, cosmo_index)
+
+    def prebuild_data(self, num_cpu=None):
+        """ Build the cached data for every model, simulation and cosmology in parallel. """
+        if self.data_cache is None:
+            return
+        jobs = [(model, sim, cosmo_index) for model in self.models for sim in self.simulations
+                for cosmo_index in range(self.num_cosmologies)]
+        build_data(self.data_cache, jobs, num_cpu=num_cpu)
+
     def is_laptop(self):
         return "science" in socket.gethostname()
 
@@ -135,6 +251,10 @@ class Fitter(object):
                 if os.path.exists(self.temp_dir):
                     self.logger.info("Deleting %s" % self.temp_dir)
                     shutil.rmtree(self.temp_dir)
+                self.prepare_simulations()
+                self.prebuild_data()
+                for model in self.models:
+                    self.get_engine(model).prepare()
                 filename = write_jobscript_slurm(file, name=os.path.basename(file),
                                                  num_tasks=self.get_num_jobs(), num_cpu=self.num_cpu,
                                                  delete=True, partition=partition)
@@ -0,0 +1,252 @@
+""" Fisher matrix forecasts of parameter uncertainties, without sampling.
+
+The curvature of the model's Stan log density is evaluated at the simulation's truth
+values, and inverted to give the marginalised uncertainty of every parameter. The per
+supernova latent parameters are first moved to their conditional mode given the truth,
+and then marginalised analytically. Each supernova's latents only couple to its own
+likelihood term, so their block of the Hessian is block diagonal. All of them can be
+perturbed together, and the Hessian costs a few gradient evaluations per global
+parameter, independent of the number of supernovae.
+
+A forecast takes seconds, so survey design questions, such as how much ``w`` tightens
+with more supernovae or a smaller calibration prior, can be swept in batch with
+:func:`forecast_sweep` instead of running full fits.
+"""
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from dessn.framework.data_cache import build_model_data
+from dessn.framework.engines import PyStanEngine
+from dessn.framework.precision import to_sampler
+from dessn.framework.stan_helpers import get_deterministic_init, get_transform_fit, unflatten
+
+
+def get_fiducial_init(model, simulations, data, overrides=None):
+    """ The model's parameters set to the simulation truth values wherever they are known.
+
+    Truth values are matched to each parameter's shape, broadcasting constants such as a
+    single ``sigma_MB`` over the surveys. Parameters without a truth value keep the
+    model's deterministic init, and latent parameters start at zero. ``overrides`` sets
+    parameters directly, for example to move one off a boundary of its prior.
+    """
+    if not isinstance(simulations, list):
+        simulations = [simulations]
+    truths = [s.get_truth_values_dict() for s in simulations]
+    init = get_deterministic_init(model, data)
+    missing = []
+    for key, value in init.items():
+        shape = np.shape(value)
+        if key == "deviations":
+            init[key] = np.zeros(shape)
+            continue
+        if key not in truths[0]:
+            missing.append(key)
+            continue
+        values = [np.asarray(t[key], dtype=float) for t in truths]
+        if len(set([v.shape for v in values])) == 1 and (len(values),) + values[0].shape == shape:
+            init[key] = np.array(values)
+        elif values[0].shape == shape:
+            init[key] = values[0]
+        elif values[0].size and np.all(values[0] == values[0].flat[0]):
+            init[key] = np.full(shape, values[0].flat[0])
+        else:
+            try:
+                init[key] = np.broadcast_to(values[0], shape).copy()
+            except ValueError:
+                logging.warning("Truth for %s has shape %s, not %s, using the model init" % (key, values[0].shape, shape))
+                missing.append(key)
+    if overrides is not None:
+        init.update(overrides)
+        missing = [m for m in missing if m not in overrides]
+    if missing:
+        logging.info("No truth values for %s, using the model init" % missing)
+    return init
+
+
+def get_latent_index(fit, latents):
+    """ Indexes of each latent parameter in the unconstrained vector, as an ``(n_sne, dim)`` array. """
+    names = fit.unconstrained_param_names()
+    index = {}
+    for i, name in enumerate(names):
+        parts = name.split(".")
+        if parts[0] in latents:
+            index[tuple([parts[0]] + [int(p) for p in parts[1:]])] = i
+    if not index:
+        return np.zeros((0, 0), dtype=int)
+    keys = sorted(index.keys(), key=lambda k: (k[1], k[0], k[2:]))
+    num_sne = max(k[1] for k in keys)
+    return np.array([index[k] for k in keys]).reshape((num_sne, -1))
+
+
+def get_hessian_blocks(fit, unconstrained, global_index, latent_index, step=1e-4):
+    """ The Hessian's global block, the global-latent cross terms and the latent diagonal blocks.
+
+    Each global column is found from its own pair of gradients. The latent diagonal blocks
+    need one pair per latent dimension, perturbing that component of every supernova at
+    once. That only works because no two supernovae's latents appear in the same term.
+    """
+    def column(delta):
+        upper = np.array(fit.grad_log_prob(unconstrained + delta, adjust_transform=True))
+        lower = np.array(fit.grad_log_prob(unconstrained - delta, adjust_transform=True))
+        return (upper - lower) / (2 * step)
+
+    columns = []
+    for i in global_index:
+        delta = np.zeros(unconstrained.size)
+        delta[i] = step
+        columns.append(column(delta))
+    columns = np.array(columns).reshape((len(global_index), unconstrained.size))
+    globals_block = columns[:, global_index]
+    globals_block = 0.5 * (globals_block + globals_block.T)
+    cross = columns[:, latent_index]
+
+    num_sne, dim = latent_index.shape
+    latent_blocks = np.empty((num_sne, dim, dim))
+    for k in range(dim):
+        delta = np.zeros(unconstrained.size)
+        delta[latent_index[:, k]] = step
+        latent_blocks[:, :, k] = column(delta)[latent_index]
+    latent_blocks = 0.5 * (latent_blocks + latent_blocks.transpose((0, 2, 1)))
+    return globals_block, cross, latent_blocks
+
+
+def refine_latents(fit, unconstrained, latent_index, max_steps=10, tolerance=1e-6, step=1e-4):
+    """ Newton steps on the latent parameters alone, holding the global parameters fixed. """
+    current = np.array(unconstrained, dtype=np.float64)
+    if not latent_index.size:
+        return current
+    for i in range(max_steps):
+        _, _, blocks = get_hessian_blocks(fit, current, [], latent_index, step=step)
+        gradient = np.array(fit.grad_log_prob(current, adjust_transform=True))[latent_index]
+        update = np.linalg.solve(blocks, gradient[..., None])[..., 0]
+        current[latent_index] -= update
+        if np.max(np.abs(update)) < tolerance:
+            break
+    logging.debug("Latent parameters converged after %d Newton steps" % (i + 1))
+    return current
+
+
+def get_marginal_covariance(fit, unconstrained, latent_index, step=1e-4):
+    """ Covariance of the global unconstrained parameters, with the latent parameters marginalised out.
+
+    Returns the covariance and the indexes of the global parameters it refers to.
+    """
+    latent = np.zeros(unconstrained.size, dtype=bool)
+    latent[latent_index.flatten()] = True
+    global_index = np.where(~latent)[0]
+    globals_block, cross, latent_blocks = get_hessian_blocks(fit, unconstrained, global_index, latent_index, step=step)
+    precision = -globals_block
+    if latent_index.size:
+        # Schur complement of the block diagonal latent part
+        num_sne, dim = latent_index.shape
+        cross = cross.reshape((global_index.size, num_sne, dim)).transpose((1, 2, 0))
+        solved = np.linalg.solve(latent_blocks, cross)
+        precision += np.einsum("nig,nih->gh", cross, solved)
+    # Fails if the fiducial point is not a local maximum in the global parameters
+    chol = np.linalg.cholesky(precision)
+    identity = np.eye(precision.shape[0])
+    return np.linalg.solve(chol.T, np.linalg.solve(chol, identity)), global_index
+
+
+def get_uncertainties(fit, unconstrained, covariance, global_index, step=1e-4):
+    """ Standard deviations of every constrained parameter, propagating the covariance through the transforms. """
+    jacobian = []
+    for i in global_index:
+        delta = np.zeros(unconstrained.size)
+        delta[i] = step
+        upper = np.array(fit.constrain_pars(unconstrained + delta))
+        lower = np.array(fit.constrain_pars(unconstrained - delta))
+        jacobian.append((upper - lower) / (2 * step))
+    jacobian = np.array(jacobian).T
+    variance = np.einsum("ig,gh,ih->i", jacobian, covariance, jacobian)
+    centre = np.array(fit.constrain_pars(unconstrained))
+    names = fit.constrained_param_names()
+    return unflatten(names, centre), unflatten(names, np.sqrt(np.maximum(variance, 0)))
+
+
+def forecast(model, simulations, cosmology_index=0, systematics_scale=None, stan_model=None, overrides=None,
+             latents=("deviations",), data=None):
+    """ Forecast the marginalised uncertainty of each of the model's parameters.
+
+    Parameters
+    ----------
+    model : ApproximateModel
+        The model, and so the Stan file and data flags, to forecast for.
+    simulations : Simulation or list[Simulation]
+        Provides the supernovae, and the truth values the curvature is evaluated at.
+    cosmology_index : int, optional
+        The realisation of the simulations to use.
+    systematics_scale : float, optional
+        Overrides the model's scale of the calibration systematics, where 0 is
+        statistics only and 1 the nominal calibration prior.
+    stan_model : pystan.StanModel, optional
+        The compiled model, so sweeps only compile it once.
+    overrides : dict, optional
+        Parameter values to use instead of the truth, see :func:`get_fiducial_init`.
+    latents : tuple, optional
+        The per supernova parameters to marginalise analytically.
+    data : dict, optional
+        The model's data, if already built.
+
+    Returns
+    -------
+    OrderedDict
+        The standard deviation of each parameter in ``model.get_parameters``, with the
+        same names and shapes as the saved chains, so ``log_`` parameters are given as
+        the uncertainty of their exponential. ``n_sne`` holds the number of supernovae.
+    """
+    if data is None:
+        data = build_model_data(None, model, simulations, cosmology_index)
+    data = to_sampler(data)
+    if systematics_scale is not None:
+        data["systematics_scale"] = systematics_scale
+    if stan_model is None:
+        stan_model = PyStanEngine(model.get_stan_file()).get_stan_model()
+
+    init = get_fiducial_init(model, simulations, data, overrides=overrides)
+    fit = get_transform_fit(stan_model, data, init)
+    unconstrained = np.array(fit.unconstrain_pars(init), dtype=np.float64)
+    names = fit.unconstrained_param_names()
+    bad = [n for n, u in zip(names, unconstrained) if not np.isfinite(u)]
+    assert not bad, "Fiducial values of %s are on a boundary, move them with overrides" % bad
+
+    latent_index = get_latent_index(fit, latents)
+    unconstrained = refine_latents(fit, unconstrained, latent_index)
+    covariance, global_index = get_marginal_covariance(fit, unconstrained, latent_index)
+    values, sigmas = get_uncertainties(fit, unconstrained, covariance, global_index)
+
+    result = OrderedDict()
+    for key, sigma in sigmas.items():
+        if key.find("log_") == 0:
+            key, sigma = key[4:], np.exp(values[key]) * sigma
+        if key in model.get_parameters():
+            result[key] = sigma
+    result["n_sne"] = data["n_sne"]
+    return result
+
+
+def forecast_sweep(model, get_simulations, sample_sizes, systematics_scales=(1.0,), cosmology_index=0, **kwargs):
+    """ Forecasts over a grid of sample sizes and systematics scales.
+
+    ``get_simulations`` takes a number of supernovae and returns the simulation or list
+    of simulations to forecast for, for example ``lambda n: SimpleSimulation(n)``. The
+    data for each sample size is built once and shared by every systematics scale.
+
+    Returns a list of ``(sample_size, systematics_scale, result)`` tuples, with ``result``
+    as returned by :func:`forecast`.
+    """
+    stan_model = PyStanEngine(model.get_stan_file()).get_stan_model()
+    results = []
+    for sample_size in sample_sizes:
+        simulations = get_simulations(sample_size)
+        data = build_model_data(None, model, simulations, cosmology_index)
+        for scale in systematics_scales:
+            result = forecast(model, simulations, cosmology_index=cosmology_index, systematics_scale=scale,
+                              stan_model=stan_model, data=data, **kwargs)
+            logging.info("Forecast for %d supernovae and systematics scale %0.2f: %s" % (
+                sample_size, scale, ", ".join(["%s=%0.4f" % (k, float(v)) for k, v in result.items()
+                                              if np.size(v) == 1 and k != "n_sne"])))
+            results.append((sample_size, scale, result))
+    return results
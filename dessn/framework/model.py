@@ -32,6 +32,27 @@ class Model(ABC):
     def correct_chain(self, dictionary, simulation, data):
         return dictionary
 
+    def get_base_config(self):
+        """ Settings the flag independent part of the data depends on, or None if the model does not split it out.
+
+        Models returning settings here implement ``get_base_data(simulations, cosmology_index)`` and
+        ``apply_flags(base, simulations)``, with ``get_data`` equal to applying the flags to the base
+        and adding ``get_random_data``.
+        """
+        return None
+
+    def get_random_data(self, data):
+        """ Entries of the data drawn afresh for each fit, which ``get_data`` includes but are never cached.
+
+        The data cache stores the output of ``apply_flags``, so models sharing a base
+        config draw these here instead.
+        """
+        return {}
+
+    def get_config(self):
+        """ The settings the model was created with, identifying its data in the data cache. """
+        return {k: v for k, v in vars(self).items() if k != "logger"}
+
     @abstractmethod
     def get_labels(self):
         raise NotImplementedError()
@@ -7,12 +7,16 @@ from scipy.interpolate import interp1d
 from collections import Counter
 
 from dessn.framework.model import Model
+from dessn.framework.precision import STORAGE_TYPE
+from dessn.utility.cache import get_hash
+from dessn.utility.covariance import cholesky_batch, describe_failures
 
 
 class ApproximateModel(Model):
 
     def __init__(self, filename="approximate.stan", num_nodes=4, statonly=False, frac_shift=0.0, apply_efficiency=True,
-                 prior=False, lock_systematics=False, lock_disp=False, lock_pop=False, lock_base=False, lock_drift=False, fakes=False):
+                 prior=False, lock_systematics=False, lock_disp=False, lock_pop=False, lock_base=False, lock_drift=False, fakes=False,
+                 calib_pca=None):
         self.statonly = statonly
         file = os.path.abspath(inspect.stack()[0][1])
         directory = os.path.dirname(file)
@@ -29,6 +33,7 @@ class ApproximateModel(Model):
         self.lock_base = 1 if lock_base else 0
         self.lock_drift = 1 if lock_drift else 0
         self.fakes = fakes
+        self.calib_pca = calib_pca
 
     def get_parameters(self):
         return ["Om", "Ol", "w", "alpha", "beta", "dscale", "dratio", "mean_MB",
@@ -119,7 +124,19 @@ class ApproximateModel(Model):
         return "Approx"
 
     def get_data(self, simulations, cosmology_index, add_zs=None, plot=False):
+        data = self.apply_flags(self.get_base_data(simulations, cosmology_index, add_zs=add_zs), simulations)
+        data.update(self.get_random_data(data))
+        return data
 
+    def get_base_config(self):
+        return {"num_nodes": self.num_redshift_nodes}
+
+    def get_base_data(self, simulations, cosmology_index, add_zs=None):
+        """ The part of :meth:`get_data` that does not depend on the model's flags.
+
+        Models that differ only in their flags can share this, so it is safe to pass the
+        same result to :meth:`apply_flags` for each of them.
+        """
         if not type(simulations) == list:
             simulations = [simulations]
 
@@ -130,13 +147,9 @@ class ApproximateModel(Model):
 
         n_surveys = len(data_list)
 
-        labels, _ = self.get_systematic_labels(simulations)
+        labels, _ = self.get_systematic_labels(simulations, statonly=False)
         self.logger.info("Systematic labels are %s" % labels)
         label_lists = [s.get_systematic_names() for s in simulations]
-        if self.statonly:
-            for d in data_list:
-                if "deta_dcalib" in d.keys():
-                    d["deta_dcalib"] = np.zeros((d["n_sne"], 3, 1))
 
         self.logger.info("Got observational data")
         # Redshift shenanigans below used to create simpsons rule arrays
@@ -177,8 +190,6 @@ class ApproximateModel(Model):
             sim_data_list.append(sim_data)
 
         node_weights = np.concatenate(node_weights_list)
-        num_calib = len(labels)
-        total_num_sne = np.sum(n_snes)
 
         # data_list is a list of dictionaries, aiming for a dictionary with lists
         data_dict = {}
@@ -188,17 +199,7 @@ class ApproximateModel(Model):
         else:
             for key in data_list[0].keys():
                 if key == "deta_dcalib":  # Changing shape of deta_dcalib makes this different
-                    offset = 0
-                    blank = np.zeros((total_num_sne, 3, num_calib))
-                    for data, labs in zip(data_list, label_lists):
-                        nsne = data["n_sne"]
-                        for i, l in enumerate(labels):
-                            if l not in labs:
-                                continue
-                            index = labs.index(l)
-                            blank[offset:offset + nsne, :, i] = data["deta_dcalib"][:, :, index]
-                        offset += nsne
-                    data_dict[key] = blank
+                    data_dict[key] = self.merge_calibration(data_list, labels, label_lists)
                 else:
                     if type(data_list[0][key]) in [int, float]:
                         data_dict[key] = [d[key] for d in data_list]
@@ -209,35 +210,29 @@ class ApproximateModel(Model):
             data_dict["n_sne"] = np.sum(data_dict["n_sne"])
 
         sim_redshifts = np.array([sim["sim_redshifts"] for sim in sim_data_list if "sim_redshifts" in sim.keys()]).flatten()
-        redshifts = np.array([z for data in data_list for z in data["redshifts"]])
-        zs = sorted(redshifts.tolist() + sim_redshifts.tolist())
-        dz = zs[-1] / n_z
-        added_zs = [0]
-        pz = 0
-        for z in zs:
-            est_point = int((z - pz) / dz)
-            if est_point % 2 == 0:
-                est_point += 1
-            est_point = max(3, est_point)
-            new_points = np.linspace(pz, z, est_point)[1:-1].tolist()
-            added_zs += new_points
-            pz = z
+        redshifts = np.concatenate([data["redshifts"] for data in data_list])
+        zs = np.sort(np.concatenate((redshifts, sim_redshifts)).astype(np.float64))
+        added_zs = self.get_simpsons_points(zs, zs[-1] / n_z)
 
         n_z = len(zs) + len(added_zs)
         n_simps = int((n_z + 1) / 2)
-        to_sort = [(z, -1, -1) for z in added_zs] + [(z, i, -1) for i, z in enumerate(redshifts)]
+        # Sort by redshift, then observed index, then simulated index, with -1 for the others
+        all_zs = [added_zs, redshifts.astype(np.float64)]
+        obs_index = [np.full(added_zs.size, -1), np.arange(redshifts.size)]
+        sim_index = [np.full(added_zs.size, -1), np.full(redshifts.size, -1)]
         if add_zs is not None:
-            to_sort += [(z, -1, i) for i, z in enumerate(sim_redshifts)]
-        to_sort.sort()
-        final_redshifts = np.array([z[0] for z in to_sort])
-        sorted_vals = [(z[1], i) for i, z in enumerate(to_sort) if z[1] != -1]
-        sorted_vals.sort()
-        final = [int(z[1] / 2 + 1) for z in sorted_vals]
+            all_zs.append(sim_redshifts.astype(np.float64))
+            obs_index.append(np.full(sim_redshifts.size, -1))
+            sim_index.append(np.arange(sim_redshifts.size))
+        all_zs, obs_index, sim_index = np.concatenate(all_zs), np.concatenate(obs_index), np.concatenate(sim_index)
+        order = np.lexsort((sim_index, obs_index, all_zs))
+        positions = np.empty(order.size, dtype=int)
+        positions[order] = np.arange(order.size)
+        final_redshifts = all_zs[order]
+        final = (positions[obs_index != -1] // 2 + 1).tolist()
         # End redshift shenanigans
-        n_calib = data_dict["deta_dcalib"].shape[2]
         update = {
             "n_z": n_z,
-            "n_calib": n_calib,
             "n_surveys": n_surveys,
             "survey_map": survey_map,
             "n_simps": n_simps,
@@ -247,13 +242,11 @@ class ApproximateModel(Model):
             "zsok": (1 + final_redshifts) ** 2,
             "redshift_indexes": final,
             "redshift_pre_comp": 0.9 + np.power(10, 0.95 * redshifts),
-            "calib_std": np.ones(n_calib),
             "num_nodes": num_nodes,
             "node_weights": node_weights,
             "nodes": nodes_list,
             "outlier_MB_delta": 0.0,
-            "outlier_dispersion": np.linalg.cholesky(np.eye(3)),
-            "systematics_scale": self.systematics_scale
+            "outlier_dispersion": np.linalg.cholesky(np.eye(3))
         }
 
         sim_dict = {}
@@ -262,10 +255,8 @@ class ApproximateModel(Model):
                 sim_dict[key] = [d[key] for d in sim_data_list]
             sim_dict["n_sim"] = sim_dict["n_sim"][0]
             n_sim = sim_dict["n_sim"]
-            sim_sorted_vals = [(z[2], i) for i, z in enumerate(to_sort) if z[2] != -1]
-            sim_sorted_vals.sort()
-            sim_final = [int(z[1] / 2 + 1) for z in sim_sorted_vals]
-            update["sim_redshift_indexes"] = np.array(sim_final).reshape((n_surveys, n_sim))
+            sim_final = positions[sim_index != -1] // 2 + 1
+            update["sim_redshift_indexes"] = sim_final.reshape((n_surveys, n_sim))
             update["sim_redshift_pre_comp"] = (0.9 + np.power(10, 0.95 * sim_redshifts)).reshape((n_surveys, n_sim))
 
             sim_node_weights = []
@@ -279,6 +270,11 @@ class ApproximateModel(Model):
         obs_data = np.array(data_dict["obs_mBx1c"])
         self.logger.debug("Obs x1 std is %f, colour std is %f" % (np.std(obs_data[:, 1]), np.std(obs_data[:, 2])))
 
+        # Factorise every covariance once here, rather than in each Stan job
+        chols, valid, reasons = cholesky_batch(data_dict["obs_mBx1c_cov"])
+        assert valid.all(), "Cannot factorise observed covariances, %s" % describe_failures(reasons)
+        update["obs_mBx1c_chol"] = chols
+
         # Add in data for the approximate selection efficiency in mB
         means, stds, alphas, correction_skewnorms, norms, signs, covs, deltas = [], [], [], [], [], [], [], []
         for sim, dataa in zip(simulations, data_list):
@@ -308,25 +304,74 @@ class ApproximateModel(Model):
         update["mB_cov"] = covs
         update["mB_kappa"] = deltas
         update["correction_skewnorm"] = correction_skewnorms
-        update["frac_shift"] = self.frac_shift
-
         update["mean_mass"] = mean_masses
-        update["apply_efficiency"] = self.apply_efficiency
-        update["lock_systematics"] = self.lock_systematics
-        update["lock_pop"] = self.lock_pop
-        update["lock_disp"] = self.lock_disp
-        update["lock_base"] = self.lock_base
-        update["lock_drift"] = self.lock_drift
-        update["apply_prior"] = 1 if self.prior else 0
-
-        if self.fakes:
-            update["fakes"] = np.random.normal(loc=-1, scale=3, size=total_num_sne)
 
         final_dict = {**data_dict, **update, **sim_dict}
         return final_dict
 
-    def get_global_from_sims(self, simulations):
+    def merge_calibration(self, data_list, labels, label_lists):
+        """ Stack each survey's ``deta_dcalib`` into the columns of the combined systematic labels. """
+        total_num_sne = sum([data["n_sne"] for data in data_list])
+        merged = np.zeros((total_num_sne, 3, len(labels)), dtype=STORAGE_TYPE)
+        offset = 0
+        for data, labs in zip(data_list, label_lists):
+            nsne = data["n_sne"]
+            # First occurrence of each label, as a survey could list one twice
+            label_index = {}
+            for i, l in enumerate(labs):
+                label_index.setdefault(l, i)
+            columns = [i for i, l in enumerate(labels) if l in label_index]
+            merged[offset:offset + nsne, :, columns] = data["deta_dcalib"][:, :, [label_index[labels[i]] for i in columns]]
+            offset += nsne
+        return merged
+
+    def get_simpsons_points(self, zs, dz):
+        """ Redshifts to add between ``0`` and each of the sorted ``zs``, so Simpson's rule has steps of about ``dz``.
+
+        Each gap gets an odd number of points, at least three, including its ends, and the
+        points are spaced exactly as ``np.linspace`` would. The first point is zero.
+        """
+        starts = np.concatenate(([0.0], zs[:-1]))
+        num_points = ((zs - starts) / dz).astype(int)
+        num_points[num_points % 2 == 0] += 1
+        num_points = np.maximum(3, num_points)
+        counts = num_points - 2
+        gap = np.repeat(np.arange(zs.size), counts)
+        index = np.arange(1, 1 + counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        added = index * ((zs - starts) / (num_points - 1))[gap] + starts[gap]
+        return np.concatenate(([0.0], added))
+
+    def apply_flags(self, base, simulations):
+        """ Add the model's flags to the output of :meth:`get_base_data`, without modifying it. """
+        data = dict(base)
         if self.statonly:
+            data["deta_dcalib"] = np.zeros((data["n_sne"], 3, 1), dtype=STORAGE_TYPE)
+        if self.calib_pca is not None:
+            data.update(self.reduce_calibration(data["deta_dcalib"]))
+        n_calib = data["deta_dcalib"].shape[2]
+
+        data["n_calib"] = n_calib
+        data["calib_std"] = np.ones(n_calib)
+        data["systematics_scale"] = self.systematics_scale
+        data["frac_shift"] = self.frac_shift
+        data["apply_efficiency"] = self.apply_efficiency
+        data["lock_systematics"] = self.lock_systematics
+        data["lock_pop"] = self.lock_pop
+        data["lock_disp"] = self.lock_disp
+        data["lock_base"] = self.lock_base
+        data["lock_drift"] = self.lock_drift
+        data["apply_prior"] = 1 if self.prior else 0
+        return data
+
+    def get_random_data(self, data):
+        if self.fakes:
+            return {"fakes": np.random.normal(loc=-1, scale=3, size=data["n_sne"])}
+        return {}
+
+    def get_global_from_sims(self, simulations, statonly=None):
+        if statonly is None:
+            statonly = self.statonly
+        if statonly:
             return ["Fake"]
         num_sims = len(simulations)
         all_labels = [l for s in simulations for l in s.get_systematic_names()]
@@ -337,15 +382,17 @@ class ApproximateModel(Model):
                 global_labels.append(l)
         return global_labels
 
-    def get_systematic_labels(self, simulations):
+    def get_systematic_labels(self, simulations, statonly=None):
+        if statonly is None:
+            statonly = self.statonly
         if not isinstance(simulations, list):
             simulations = [simulations]
         label_lists = [s.get_systematic_names() for s in simulations]
-        if self.statonly:
+        if statonly:
             label_lists = [["Fake"] for s in simulations]
         if len(label_lists[0]) == 0:
             label_lists[0].append("Fake")
-        start = self.get_global_from_sims(simulations)
+        start = self.get_global_from_sims(simulations, statonly=statonly)
         for label_list in label_lists:
             for l in label_list:
                 if l not in start:
@@ -365,8 +412,56 @@ class ApproximateModel(Model):
         node_weights = (node_weights.T / reweight).T
         return node_weights
 
-    def correct_chain(self, dictionary, simulation, data):
+    def reduce_calibration(self, deta_dcalib):
+        """ Replace the calibration systematics with their leading principal components.
+
+        The sensitivities are stacked into a ``(3 n_sne, n_calib)`` matrix ``A``, and the
+        eigenvectors ``V`` of ``A^T A`` give orthonormal directions in calibration space. As
+        the calibration prior is a unit normal, rotating into those directions leaves the
+        prior unchanged, so the model samples the leading components in place of the
+        per-label shifts. Enough components are kept to explain ``calib_pca`` of the
+        variance, and :meth:`correct_chain` maps the components back to labels.
+        """
+        n_sne, _, n_calib = deta_dcalib.shape
+        stacked = np.asarray(deta_dcalib, dtype=np.float64).reshape((3 * n_sne, n_calib))
+        variances, vectors = np.linalg.eigh(stacked.T @ stacked)
+        order = np.argsort(variances)[::-1]
+        variances, vectors = np.clip(variances[order], 0, None), vectors[:, order]
+        total = variances.sum()
+        if total == 0:
+            num_keep = 1
+        else:
+            explained = np.cumsum(variances) / total
+            num_keep = min(int(np.searchsorted(explained, self.calib_pca)) + 1, n_calib)
+        components, remainder = vectors[:, :num_keep], vectors[:, num_keep:]
+
+        # The largest shift any supernova could see from the dropped components, at one sigma
+        dropped = np.sqrt(np.sum((stacked @ remainder) ** 2, axis=1)).max() if remainder.size else 0.0
+        fraction = max(1 - variances[:num_keep].sum() / total, 0.0) if total > 0 else 0.0
+        self.logger.info("Reduced %d calibration systematics to %d components, leaving %0.2g of the variance "
+                         "and at most %0.2g mag on any supernova" % (n_calib, num_keep, fraction, dropped))
+        reduced = (stacked @ components).reshape((n_sne, 3, num_keep)).astype(deta_dcalib.dtype)
+        return {
+            "deta_dcalib": reduced,
+            "calib_components": components,
+            "calib_remainder": remainder,
+            "calib_remainder_fraction": fraction,
+            "calib_remainder_max": dropped
+        }
+
+    def correct_chain(self, dictionary, simulation, data, seed=None):
         # del dictionary["intrinsic_correlation"]
+        if "calib_components" in data and "calibration" in dictionary:
+            # The dropped components barely touch the data, so their posterior is their unit normal prior.
+            # Seeding from the chain itself means correcting the same chain twice gives the same result.
+            reduced = dictionary["calibration"]
+            remainder = data["calib_remainder"]
+            if seed is None:
+                seed = int(get_hash(np.asarray(reduced))[:8], 16)
+            dropped = np.random.RandomState(seed).normal(size=(reduced.shape[0], remainder.shape[1]))
+            dictionary["calibration"] = reduced @ data["calib_components"].T + dropped @ remainder.T
+            # One value per draw, so chains from different walkers still concatenate
+            dictionary["calib_remainder_fraction"] = np.full(reduced.shape[0], data["calib_remainder_fraction"])
         return dictionary
 
     def get_cosmo_params(self):
@@ -374,24 +469,24 @@ class ApproximateModel(Model):
 
 
 class ApproximateModelOl(ApproximateModel):
-    def __init__(self, filename="approximate_ol.stan", num_nodes=4, statonly=False, frac_shift=1.0, apply_efficiency=True, prior=False, lock_systematics=False, lock_disp=False, lock_pop=False, lock_base=False, lock_drift=False):
-        super().__init__(filename, num_nodes=num_nodes, statonly=statonly, frac_shift=frac_shift, apply_efficiency=apply_efficiency, prior=prior, lock_systematics=lock_systematics, lock_disp=lock_disp, lock_pop=lock_pop, lock_base=lock_base, lock_drift=lock_drift)
+    def __init__(self, filename="approximate_ol.stan", num_nodes=4, statonly=False, frac_shift=1.0, apply_efficiency=True, prior=False, lock_systematics=False, lock_disp=False, lock_pop=False, lock_base=False, lock_drift=False, calib_pca=None):
+        super().__init__(filename, num_nodes=num_nodes, statonly=statonly, frac_shift=frac_shift, apply_efficiency=apply_efficiency, prior=prior, lock_systematics=lock_systematics, lock_disp=lock_disp, lock_pop=lock_pop, lock_base=lock_base, lock_drift=lock_drift, calib_pca=calib_pca)
 
     def get_cosmo_params(self):
         return [r"$\Omega_m$", r"$\Omega_\Lambda$"]
 
 
 class ApproximateModelW(ApproximateModel):
-    def __init__(self, filename="approximate_w.stan", num_nodes=4, statonly=False, prior=False, frac_shift=1.0, apply_efficiency=True, lock_systematics=False, lock_disp=False, lock_pop=False, lock_base=False, lock_drift=False):
-        super().__init__(filename, num_nodes=num_nodes, statonly=statonly, frac_shift=frac_shift, apply_efficiency=apply_efficiency, prior=prior, lock_systematics=lock_systematics, lock_disp=lock_disp, lock_pop=lock_pop, lock_base=lock_base, lock_drift=lock_drift)
+    def __init__(self, filename="approximate_w.stan", num_nodes=4, statonly=False, prior=False, frac_shift=1.0, apply_efficiency=True, lock_systematics=False, lock_disp=False, lock_pop=False, lock_base=False, lock_drift=False, calib_pca=None):
+        super().__init__(filename, num_nodes=num_nodes, statonly=statonly, frac_shift=frac_shift, apply_efficiency=apply_efficiency, prior=prior, lock_systematics=lock_systematics, lock_disp=lock_disp, lock_pop=lock_pop, lock_base=lock_base, lock_drift=lock_drift, calib_pca=calib_pca)
 
     def get_cosmo_params(self):
         return [r"$\Omega_m$", r"$w$"]
 
 
 class ApproximateModelWSimplified(ApproximateModel):
-    def __init__(self, filename="approximate_w_simplified.stan", num_nodes=4, statonly=False, prior=False, frac_shift=1.0, apply_efficiency=True, lock_systematics=False, lock_disp=False, lock_pop=False, lock_drift=False):
-        super().__init__(filename, num_nodes=num_nodes, statonly=statonly, frac_shift=frac_shift, apply_efficiency=apply_efficiency, prior=prior, lock_systematics=lock_systematics, lock_disp=lock_disp, lock_pop=lock_pop, lock_drift=lock_drift)
+    def __init__(self, filename="approximate_w_simplified.stan", num_nodes=4, statonly=False, prior=False, frac_shift=1.0, apply_efficiency=True, lock_systematics=False, lock_disp=False, lock_pop=False, lock_drift=False, calib_pca=None):
+        super().__init__(filename, num_nodes=num_nodes, statonly=statonly, frac_shift=frac_shift, apply_efficiency=apply_efficiency, prior=prior, lock_systematics=lock_systematics, lock_disp=lock_disp, lock_pop=lock_pop, lock_drift=lock_drift, calib_pca=calib_pca)
 
     def get_cosmo_params(self):
         return [r"$\Omega_m$", r"$w$"]
@@ -46,8 +46,8 @@ class FullModel(ApproximateModel):
     def get_name(self):
         return "FullMC"
 
-    def get_data(self, simulation, cosmology_index, add_zs=None):
-        return super().get_data(simulation, cosmology_index, add_zs=self.get_extra_zs)
+    def get_base_data(self, simulation, cosmology_index, add_zs=None):
+        return super().get_base_data(simulation, cosmology_index, add_zs=self.get_extra_zs)
 
 
 class FullModelWithCorrection(FullModel):
@@ -56,6 +56,11 @@ class FullModelWithCorrection(FullModel):
         return "Full"
 
     def correct_chain(self, chain_dictionary, simulation, data):
+        """ Weight the chain by the selection efficiency of the simulated population.
+
+        The population density is evaluated at the simulations' ``sim_*`` values, which
+        ``SimpleSimulation`` gives as the observed values unless created with ``latent_sims``.
+        """
         self.logger.info("Starting full corrections")
         if not type(simulation) == list:
             simulation = [simulation]
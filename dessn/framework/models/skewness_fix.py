@@ -6,10 +6,12 @@ Created on Fri Dec 29 20:44:13 2017
 """
 import numpy as np
 from scipy.stats import norm, skewnorm
-from scipy.integrate import simps
-from scipy.ndimage.filters import gaussian_filter
 from astropy.cosmology import wCDM
 
+from dessn.utility.cache import get_hash
+
+_biases = {}
+
 
 def get_selection_cdf(mbs, vals):
     mean, sigma, alpha, normv = vals
@@ -21,42 +23,59 @@ def get_selection_skewnorm(mbs, vals):
     return normv * skewnorm.pdf(mbs, alpha, mean, sigma)
 
 
-def get_approx_efficiency(dist_mod, alpha, vals, correction_skewnorm, alpha_shift, frac_shift, frac_shift2):
-    n = 40000
-    MBs = np.random.normal(loc=-19.365, scale=0.1, size=n)
-    x1s = np.random.normal(loc=0, scale=1.0, size=n)
+def get_magnitude_skewnorm(alpha, alpha_shift, frac_shift, frac_shift2):
+    """ The location, scale and skewness parameter of ``mB - dist_mod`` for the toy population.
 
+    The population is Gaussian in MB and x1 and skew normal in colour, and a skew normal
+    plus independent Gaussians is again skew normal, so this is exact. ``alpha`` and
+    ``alpha_shift`` can be arrays, and the results have their broadcast shape.
+    """
+    alpha, alpha_shift = np.broadcast_arrays(np.asarray(alpha, dtype=float), np.asarray(alpha_shift, dtype=float))
     delta = alpha_shift / np.sqrt(1 + alpha_shift**2)
     mean_shift = frac_shift * 0.1 * delta * np.sqrt(2 / np.pi)
 
     kurtosis_c = 2 * (np.pi - 3) * (delta ** 2 * (2 / np.pi)) ** 2 / (1 - 2 * delta ** 2 / np.pi) ** 2
     sigma_c_adjust_ratio = ((1 - (2 * delta ** 2 / np.pi)) ** 2 + (kurtosis_c / 0.1 ** 4)) ** 0.25
     sigma_shift = 0.1 * (1 + frac_shift2 * (sigma_c_adjust_ratio - 1))
-    cs = skewnorm.rvs(alpha, loc=mean_shift, scale=sigma_shift, size=n)
 
     alphax1 = 0.14
     beta = 3.1
-    mbs = MBs + dist_mod + alphax1 * x1s - beta * cs
-
-    hist, bin_edge = np.histogram(mbs, bins=1000, normed=True)
-    hist2 = gaussian_filter(hist, 15)
-    bin_center = 0.5 * (bin_edge[1:] + bin_edge[:-1])
-
-    if correction_skewnorm:
-        ratio = get_selection_skewnorm(bin_center, vals)
-    else:
-        ratio = get_selection_cdf(bin_center, vals)
-
-    area1 = simps(hist2, x=bin_center)
-    effective = ratio * hist2
-    area2 = simps(effective, x=bin_center)
-
-    # import matplotlib.pyplot as plt
-    # plt.plot(bin_center, hist2, ls="--")
-    # plt.plot(bin_center, ratio, ls="-")
-    # plt.plot(bin_center, effective, ls=":")
-
-    return area2 / area1
+    scale = np.sqrt(0.1 ** 2 + alphax1 ** 2 + (beta * sigma_shift) ** 2)
+    # Colour enters as -beta * c, which flips the sign of its skew
+    delta_m = -(alpha / np.sqrt(1 + alpha ** 2)) * beta * sigma_shift / scale
+    return -19.365 - beta * mean_shift, scale, delta_m / np.sqrt(1 - delta_m ** 2)
+
+
+def get_approx_efficiency(dist_mod, alpha, vals, correction_skewnorm, alpha_shift, frac_shift, frac_shift2,
+                          points_per_sigma=20, num_sigma=10):
+    """ The fraction of the toy population at each distance modulus passing the selection.
+
+    Vectorised over ``dist_mod`` and over ``alpha`` and ``alpha_shift``, returning an
+    array with the broadcast shape of the latter followed by the shape of ``dist_mod``.
+
+    With the CDF selection this is the probability that the skew normal magnitude is
+    below a normal threshold, which is itself a skew normal CDF. The skew normal selection
+    has no closed form, so it is integrated on a magnitude grid, relative to the distance
+    modulus, shared by every redshift and alpha.
+    """
+    loc, scale, skew = get_magnitude_skewnorm(alpha, alpha_shift, frac_shift, frac_shift2)
+    dist_mod = np.asarray(dist_mod, dtype=float)
+    mean, sigma, alpha_selection, normv = vals
+    if not correction_skewnorm:
+        expand = (Ellipsis,) + (None,) * dist_mod.ndim
+        total = np.sqrt(scale ** 2 + sigma ** 2)
+        delta = (skew / np.sqrt(1 + skew ** 2)) * scale / total
+        return normv * skewnorm.cdf(0, (delta / np.sqrt(1 - delta ** 2))[expand],
+                                    loc[expand] + dist_mod - mean, total[expand])
+
+    step = min(scale.min(), sigma) / points_per_sigma
+    grid = np.arange((loc - num_sigma * scale).min(), (loc + num_sigma * scale).max() + step, step)
+    weights = np.full(grid.size, step)
+    weights[[0, -1]] *= 0.5
+    population = skewnorm.pdf(grid, skew.reshape((-1, 1)), loc.reshape((-1, 1)), scale.reshape((-1, 1)))
+    selection = get_selection_skewnorm(dist_mod.reshape((-1, 1)) + grid, vals)
+    efficiency = np.dot(population * weights, selection.T)
+    return efficiency.reshape(loc.shape + dist_mod.shape)
 
 
 def get_shift_scale(redshifts, correction_skewnorm, vals, frac_shift, frac_shift2, plot=False):
@@ -65,21 +84,17 @@ def get_shift_scale(redshifts, correction_skewnorm, vals, frac_shift, frac_shift
 
     dist_mod = cosmo.distmod(redshifts).value
 
-    biases = []
     if plot:
         alphas = np.logspace(0, 0.6, 5)
     else:
         alphas = np.array([0, 5])
 
-    for alpha in alphas:
-        bias_actual = np.array([get_approx_efficiency(dm, alpha, vals, correction_skewnorm, 0, 0, 0) for dm in dist_mod])
-        bias_computed = np.array([get_approx_efficiency(dm, 0, vals, correction_skewnorm, alpha, frac_shift, frac_shift2) for dm in dist_mod])
-
-        bias_diff = np.log(bias_actual) - np.log(bias_computed)
-        total_bias = np.sum(bias_diff)
-        biases.append(total_bias)
-
-    biases = np.array(biases)
+    key = get_hash(np.asarray(vals, dtype=float), correction_skewnorm, frac_shift, frac_shift2, dist_mod, alphas)
+    if key not in _biases:
+        bias_actual = get_approx_efficiency(dist_mod, alphas, vals, correction_skewnorm, 0, 0, 0)
+        bias_computed = get_approx_efficiency(dist_mod, 0, vals, correction_skewnorm, alphas, frac_shift, frac_shift2)
+        _biases[key] = np.sum(np.log(bias_actual) - np.log(bias_computed), axis=1)
+    biases = _biases[key]
     b = biases - np.min(biases)
 
     fn = alphas / np.sqrt(1 + alphas ** 2)
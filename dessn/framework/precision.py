@@ -0,0 +1,153 @@
+""" Precision policy for the data passed from the simulations to the sampler.
+
+Digested supernovae are stored as float32, and stay float32 through
+``get_passed_supernova`` and ``get_data``, as views of the memory-mapped realisation
+where possible. They are promoted to float64 only at the sampler boundary, in
+:func:`to_sampler`. :func:`get_rounding_bound` bounds how far the float32 rounding
+can move the posterior, which :func:`check_rounding` logs before every fit, and
+:func:`check_rounding_fit` measures that shift directly by fitting the same data in
+both precisions. Run ``python -m dessn.framework.precision`` to check the bound on a
+small simulation.
+"""
+import logging
+import tempfile
+
+import numpy as np
+
+STORAGE_TYPE = np.float32
+SAMPLER_TYPE = np.float64
+
+# Calibration parameters have a unit normal prior, so bound their rounding out to this many sigma
+CALIBRATION_SIGMA = 5.0
+# Latent deviations have a unit normal prior, so bound the covariance rounding out to this many sigma
+DEVIATION_SIGMA = 5.0
+# Largest acceptable posterior shift from rounding, in units of the posterior width
+MAX_ROUNDING_SHIFT = 0.01
+
+
+def as_storage(array):
+    """ The array in the storage precision, without a copy if it already is. """
+    return np.asarray(array, dtype=STORAGE_TYPE)
+
+
+def to_sampler(data):
+    """ A copy of the data dictionary with every floating point array promoted to float64. """
+    result = {}
+    for key, value in data.items():
+        if isinstance(value, np.ndarray) and np.issubdtype(value.dtype, np.floating):
+            value = value.astype(SAMPLER_TYPE)
+        result[key] = value
+    return result
+
+
+def round_to_storage(data):
+    """ A copy of the data dictionary with every floating point array rounded to the storage precision and back. """
+    result = {}
+    for key, value in data.items():
+        if isinstance(value, np.ndarray) and np.issubdtype(value.dtype, np.floating):
+            value = value.astype(STORAGE_TYPE).astype(value.dtype)
+        result[key] = value
+    return result
+
+
+def get_rounding_bound(data):
+    """ Bound the posterior shift caused by storing the data in float32.
+
+    Rounding to float32 changes a value by at most ``eps * |x|``, with ``eps = 2^-24``.
+    For each supernova this moves the observed mB, x1 and c, and the calibration
+    shift ``deta_dcalib * calibration``, by at most that much. Rounding a redshift
+    moves the distance modulus by at most ``5 / ln(10) * eps * dln(d_L)/dln(z)``,
+    and the logarithmic slope of the luminosity distance is below 2 for any
+    redshift and cosmology. These shifts are whitened by the inverse Cholesky
+    factor ``L^-1`` of the covariance, to measure them in units of the uncertainty.
+
+    Rounding the covariance ``C`` changes the whitened covariance ``L^-1 C L^-T`` by
+    at most ``eps * |L^-1| |C| |L^-T|`` in each entry, and its Cholesky factor by no
+    more than that in Frobenius norm, to first order. That moves the model's
+    ``obs + chol * deviations`` by at most as much times ``DEVIATION_SIGMA``.
+
+    The sum is the largest whitened shift of any single likelihood term. A parameter
+    constrained by all ``n_sne`` supernovae has a posterior width about
+    ``sqrt(n_sne)`` times smaller, so the returned bound on the posterior shift, in
+    units of the posterior width, is the largest single shift times ``sqrt(n_sne)``.
+    """
+    eps = np.finfo(STORAGE_TYPE).eps / 2
+    obs = np.abs(np.asarray(data["obs_mBx1c"], dtype=np.float64))
+    cov = np.asarray(data["obs_mBx1c_cov"], dtype=np.float64)
+    shift = eps * obs
+    if "deta_dcalib" in data:
+        deta_dcalib = np.abs(np.asarray(data["deta_dcalib"], dtype=np.float64))
+        shift += eps * CALIBRATION_SIGMA * deta_dcalib.sum(axis=2)
+    shift[:, 0] += eps * 10 / np.log(10)
+
+    inverse = np.abs(np.linalg.inv(np.linalg.cholesky(cov)))
+    whitened = np.linalg.norm(np.einsum("nij,nj->ni", inverse, shift), axis=1)
+    perturbation = eps * np.einsum("nij,njk,nlk->nil", inverse, np.abs(cov), inverse)
+    whitened += np.linalg.norm(perturbation, axis=(1, 2)) * DEVIATION_SIGMA
+    return np.max(whitened) * np.sqrt(obs.shape[0])
+
+
+def check_rounding(data, threshold=MAX_ROUNDING_SHIFT):
+    """ Log the rounding bound, and warn if float32 storage could move the posterior noticeably. """
+    logger = logging.getLogger(__name__)
+    bound = get_rounding_bound(data)
+    if bound > threshold:
+        logger.warning("Float32 rounding could shift the posterior by up to %0.2g sigma, above %0.2g"
+                       % (bound, threshold))
+    else:
+        logger.info("Float32 rounding shifts the posterior by at most %0.2g sigma" % bound)
+    return bound
+
+
+def check_rounding_fit(model, simulation, cosmology_index=0, engine=None, num_draws=4000, output_prefix=None):
+    """ Fit one realisation with float64 data and again rounded to float32, and compare the shift to the bound.
+
+    Both fits use the Laplace approximation with the same init and seed, so their draws
+    share the same normal deviates and differ only through the data. The simulation
+    must generate its data in float64, like ``SimpleSimulation``, or rounding it
+    changes nothing.
+
+    Returns
+    -------
+    tuple
+        The largest shift of any parameter's mean in units of its float64 posterior
+        width, and the bound from :func:`get_rounding_bound`.
+    """
+    from dessn.framework.data_cache import build_model_data
+    from dessn.framework.engines import PyStanEngine
+    from dessn.framework.stan_helpers import get_deterministic_init
+
+    logger = logging.getLogger(__name__)
+    if engine is None:
+        engine = PyStanEngine(model.get_stan_file())
+    if output_prefix is None:
+        output_prefix = tempfile.mkdtemp() + "/precision"
+    exact = to_sampler(build_model_data(None, model, simulation, cosmology_index))
+    rounded = to_sampler(round_to_storage(exact))
+    init = get_deterministic_init(model, exact)
+    draws_exact = engine.laplace(exact, init, num_draws, output_prefix, seed=0)
+    draws_rounded = engine.laplace(rounded, init, num_draws, output_prefix, seed=0)
+
+    shifts = {}
+    for key in model.get_parameters():
+        if key not in draws_exact or key not in draws_rounded:
+            continue
+        std = np.std(draws_exact[key], axis=0)
+        diff = np.abs(np.mean(draws_rounded[key], axis=0) - np.mean(draws_exact[key], axis=0))
+        shifts[key] = np.max(diff[std > 0] / std[std > 0]) if np.any(std > 0) else 0.0
+    shift = max(shifts.values())
+    bound = get_rounding_bound(exact)
+    worst = max(shifts, key=shifts.get)
+    if shift > bound:
+        logger.warning("Float32 rounding shifted %s by %0.2g sigma, above the bound of %0.2g" % (worst, shift, bound))
+    else:
+        logger.info("Float32 rounding shifted %s by %0.2g sigma, within the bound of %0.2g" % (worst, shift, bound))
+    return shift, bound
+
+
+if __name__ == "__main__":
+    from dessn.framework.models.approx_model import ApproximateModel
+    from dessn.framework.simulations.simple import SimpleSimulation
+    logging.basicConfig(level=logging.INFO, format="[%(funcName)20s()] %(message)s")
+    shift, bound = check_rounding_fit(ApproximateModel(), SimpleSimulation(300))
+    assert shift <= bound, "Float32 rounding shifted the posterior by %0.2g sigma, above the bound of %0.2g" % (shift, bound)
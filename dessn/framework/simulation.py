@@ -24,6 +24,14 @@ class Simulation(ABC):
     def get_systematic_names(self):
         return []
 
+    def get_data_key(self, cosmology_index):
+        """ A hash identifying the supernovae given for a realisation, or None if they cannot be cached. """
+        return None
+
+    def prepare(self, num_realisations, num_cpu=None):
+        """ Called once before jobs are submitted, to build anything the jobs can share. """
+        pass
+
     def get_truth_values_dict(self):
         vals = self.get_truth_values()
         return {k[0]: k[1] for k in vals}
@@ -0,0 +1,170 @@
+""" Consolidated storage for the ``passed_%d.npy`` realisations of a simulation.
+
+All realisations of a simulation are concatenated into a single ``passed_archive.npy``,
+with ``passed_index.npy`` holding one ``(realisation, start, end)`` row per realisation.
+Opening the archive memory-mapped gives realisation *k*, or a run of realisations, as a
+view without reading the rest of the file. Individual files written after the archive
+take precedence over it, and are merged in when the archive is next built. To convert
+existing simulation folders::
+
+    python -m dessn.framework.simulations.archive DES3YR_DES_BHMEFF_AMG10 --remove
+"""
+import argparse
+import logging
+import os
+import re
+
+import numpy as np
+
+ARCHIVE_NAME = "passed_archive.npy"
+INDEX_NAME = "passed_index.npy"
+
+
+def get_passed_files(folder):
+    """ Returns {realisation: filename} for the individual passed files in the folder. """
+    expression = re.compile(r"^passed_(\d+)\.npy$")
+    results = {}
+    for f in os.listdir(folder):
+        match = expression.match(f)
+        if match is not None:
+            results[int(match.group(1))] = folder + "/" + f
+    return results
+
+
+def has_archive(folder):
+    return os.path.exists(folder + "/" + ARCHIVE_NAME) and os.path.exists(folder + "/" + INDEX_NAME)
+
+
+def load_index(folder):
+    return np.load(folder + "/" + INDEX_NAME)
+
+
+def load_archive(folder, mmap_mode="r"):
+    """ Returns the memory-mapped archive and its index. """
+    return np.load(folder + "/" + ARCHIVE_NAME, mmap_mode=mmap_mode), load_index(folder)
+
+
+def get_realisations(folder):
+    """ The sorted realisation numbers available in the folder. """
+    realisations = set(get_passed_files(folder).keys())
+    if has_archive(folder):
+        realisations.update(load_index(folder)[:, 0].tolist())
+    return sorted(realisations)
+
+
+def get_source_files(folder, realisation):
+    """ The files backing a realisation, suitable for fingerprinting. """
+    filename = folder + "/passed_%d.npy" % realisation
+    if os.path.exists(filename) or not has_archive(folder):
+        return [filename]
+    return [folder + "/" + ARCHIVE_NAME, folder + "/" + INDEX_NAME]
+
+
+def load_passed(folder, realisation, mmap_mode="c"):
+    """ Load a single realisation, from the archive if there is one.
+
+    The default copy-on-write mode means callers can modify the returned array
+    without touching the file on disk.
+    """
+    filename = folder + "/passed_%d.npy" % realisation
+    if has_archive(folder) and not os.path.exists(filename):
+        data, index = load_archive(folder, mmap_mode=mmap_mode)
+        rows = np.where(index[:, 0] == realisation)[0]
+        assert rows.size, "Realisation %d is not in the archive in %s" % (realisation, folder)
+        _, start, end = index[rows[0]]
+        return data[start:end]
+    assert os.path.exists(filename), "Cannot find file %s, do you have this realisations?" % filename
+    return np.load(filename, mmap_mode=mmap_mode)
+
+
+def load_passed_range(folder, start=None, stop=None, mmap_mode="r"):
+    """ Load realisations ``start <= k < stop`` stacked together, and the realisation of each row.
+
+    With an up to date archive this is a single view, as realisations are stored in order.
+    """
+    realisations = [r for r in get_realisations(folder)
+                    if (start is None or r >= start) and (stop is None or r < stop)]
+    assert realisations, "No realisations in range [%s, %s) in %s" % (start, stop, folder)
+    if has_archive(folder) and not get_passed_files(folder):
+        data, index = load_archive(folder, mmap_mode=mmap_mode)
+        rows = index[np.isin(index[:, 0], realisations)]
+        data = data[rows[0, 1]:rows[-1, 2]]
+    else:
+        rows, arrays, offset = [], [], 0
+        for r in realisations:
+            arrays.append(load_passed(folder, r, mmap_mode=mmap_mode))
+            rows.append([r, offset, offset + arrays[-1].shape[0]])
+            offset += arrays[-1].shape[0]
+        rows = np.array(rows)
+        data = np.concatenate(arrays)
+    labels = np.repeat(rows[:, 0], rows[:, 2] - rows[:, 1])
+    return data, labels
+
+
+def build_archive(folder, remove=False):
+    """ Concatenate the passed files in the folder into an archive and index.
+
+    Realisations already in an existing archive are kept unless there is a newer
+    individual file for them. The archive is written to a temporary file and moved
+    into place, so readers never see a partial archive. With ``remove``, the
+    individual files are deleted once the archive exists.
+    """
+    files = get_passed_files(folder)
+    if not files:
+        if has_archive(folder):
+            logging.debug("Archive in %s is up to date" % folder)
+        else:
+            logging.warning("No passed files found in %s" % folder)
+        return
+    sources = {r: np.load(f, mmap_mode="r") for r, f in files.items()}
+    if has_archive(folder):
+        data, index = load_archive(folder)
+        for r, start, end in index:
+            if r not in sources:
+                sources[r] = data[start:end]
+    realisations = sorted(sources.keys())
+    headers = [sources[r] for r in realisations]
+    shapes = set([h.shape[1:] for h in headers])
+    dtypes = set([h.dtype for h in headers])
+    assert len(shapes) == 1 and len(dtypes) == 1, "Inconsistent realisations in %s: %s %s" % (folder, shapes, dtypes)
+
+    sizes = np.array([h.shape[0] for h in headers])
+    ends = np.cumsum(sizes)
+    index = np.vstack((realisations, ends - sizes, ends)).T.astype(np.int64)
+
+    archive_file = folder + "/" + ARCHIVE_NAME
+    temp = "%s.%d.tmp" % (archive_file, os.getpid())
+    archive = np.lib.format.open_memmap(temp, mode="w+", dtype=dtypes.pop(), shape=(int(ends[-1]),) + shapes.pop())
+    for (_, start, end), data in zip(index, headers):
+        archive[start:end] = data
+    archive.flush()
+    del archive
+    os.replace(temp, archive_file)
+
+    index_file = folder + "/" + INDEX_NAME
+    temp = "%s.%d.tmp" % (index_file, os.getpid())
+    with open(temp, "wb") as f:
+        np.save(f, index)
+    os.replace(temp, index_file)
+    logging.info("Archived %d realisations with %d rows in %s" % (len(realisations), ends[-1], folder))
+
+    if remove:
+        for f in files.values():
+            os.remove(f)
+
+
+def get_data_folder():
+    return os.path.dirname(os.path.abspath(__file__)) + "/snana_data"
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(funcName)20s()] %(message)s")
+    parser = argparse.ArgumentParser(description="Consolidate passed realisations into a single archive")
+    parser.add_argument("simulations", nargs="*", help="Simulation folders in snana_data, defaults to all of them")
+    parser.add_argument("--remove", action="store_true", help="Delete the individual passed files afterwards")
+    args = parser.parse_args()
+    base = get_data_folder()
+    names = args.simulations or sorted(os.listdir(base))
+    for name in names:
+        if os.path.isdir(base + "/" + name):
+            build_archive(base + "/" + name, remove=args.remove)
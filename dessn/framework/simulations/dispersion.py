@@ -1,26 +1,28 @@
 import numpy as np
 from scipy.stats import binned_statistic
 
+from dessn.framework.simulations.records import load_records, unpack_cov
+
 
 def get_data(des=True, model="G10"):
     print("Getting data for %s %s" % (("DES" if des else "LowZ"), model))
     if des:
-        file = "snana_data/DES3YR_DES_BHMEFF_AM%s/passed_0.npy" % model
+        folder = "snana_data/DES3YR_DES_BHMEFF_AM%s" % model
     else:
-        file = "snana_data/DES3YR_LOWZ_BHMEFF_%s/passed_0.npy" % model
-    data = np.load(file)
+        folder = "snana_data/DES3YR_LOWZ_BHMEFF_%s" % model
+    data = load_records(folder, 0)
 
     result = {
-        "z": data[:, 1],
-        "sim_mb": data[:, 3],
-        "sim_x1": data[:, 4],
-        "sim_c": data[:, 5],
-        "mb": data[:, 6],
-        "x1": data[:, 7],
-        "c": data[:, 8],
-        "obs": data[:, 6:9],
-        "sim": data[:, 3:6],
-        "cov": data[:, 12:12+9].reshape((-1, 3, 3))
+        "z": data["z"],
+        "sim_mb": data["sim_mBx1c"][:, 0],
+        "sim_x1": data["sim_mBx1c"][:, 1],
+        "sim_c": data["sim_mBx1c"][:, 2],
+        "mb": data["obs_mBx1c"][:, 0],
+        "x1": data["obs_mBx1c"][:, 1],
+        "c": data["obs_mBx1c"][:, 2],
+        "obs": data["obs_mBx1c"],
+        "sim": data["sim_mBx1c"],
+        "cov": unpack_cov(data["cov"])
     }
     return result
 
@@ -0,0 +1,55 @@
+""" Pre-build the selection function artifacts before submitting jobs.
+
+Every worker calling ``SNANASimulation.get_approximate_correction`` then loads the
+fitted selection function from the on-disk cache instead of refitting it. Shifts and
+covariance scales are applied to the cached fit, so only the arguments of the fit itself
+need building. Run with, for example::
+
+    python -m dessn.framework.simulations.prebuild_selection --kappa 0 --zlim 0.8
+"""
+import argparse
+import logging
+import os
+import re
+
+from dessn.framework.simulations.selection_effects import des_sel, lowz_sel, get_folder, get_dump_files
+
+
+def get_bhmeff_folders():
+    """ Returns (survey, type, version) for each BHMEFF folder with dump files present. """
+    folder = get_folder("snana_data")
+    expression = re.compile(r"^DES3YR_(DES|LOWZ)_BHMEFF_(?:AM)?([A-Z0-9]+?)(?:_(v\d+))?$")
+    results = []
+    for name in sorted(os.listdir(folder)):
+        match = expression.match(name)
+        if match is None or not get_dump_files(folder + "/" + name):
+            continue
+        survey, sim_type, version = match.groups()
+        if sim_type == "CD":
+            sim_type = None
+        results.append((survey, sim_type, version))
+    return results
+
+
+def prebuild(kappas=(0.0,), zlims=(None,), cut_mags=None):
+    """ Fit every combination, with each survey's default cut magnitude unless ``cut_mags`` is given. """
+    for survey, sim_type, version in get_bhmeff_folders():
+        func = des_sel if survey == "DES" else lowz_sel
+        options = [{}] if cut_mags is None else [{"cut_mag": c} for c in cut_mags]
+        for kappa in kappas:
+            for zlim in zlims:
+                for option in options:
+                    logging.info("Building %s %s %s kappa=%s zlim=%s %s"
+                                 % (survey, sim_type, version, kappa, zlim, option))
+                    func(type=sim_type, kappa=kappa, zlim=zlim, version=version, **option)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(funcName)20s()] %(message)s")
+    parser = argparse.ArgumentParser(description="Pre-build cached selection function fits")
+    parser.add_argument("--kappa", type=float, nargs="+", default=[0.0])
+    parser.add_argument("--zlim", type=float, nargs="+", default=None)
+    parser.add_argument("--cut_mag", type=float, nargs="+", default=None,
+                        help="Cut magnitudes to fit, by default each survey's own")
+    args = parser.parse_args()
+    prebuild(kappas=args.kappa, zlims=args.zlim or [None], cut_mags=args.cut_mag)
@@ -0,0 +1,97 @@
+""" The structured record format for digested supernovae.
+
+Each passed supernova is one record with named fields, so readers take views by name
+rather than slicing columns by position. Only the six unique terms of the symmetric
+mB, x1, c covariance are stored, and the calibration offsets are a ``(3, num_calib)``
+sub-array. The version is kept in ``format.pkl`` alongside ``sys_names.pkl``; folders
+without one hold the original headerless float matrix, which is converted on load.
+"""
+import os
+import pickle
+
+import numpy as np
+
+from dessn.framework.simulations.archive import load_passed
+
+FORMAT_VERSION = 1
+FORMAT_NAME = "format.pkl"
+
+# Indexes into the flattened 3x3 covariance of the six unique terms, and back again
+COV_UNIQUE = np.array([0, 1, 2, 4, 5, 8])
+COV_FULL = np.array([0, 1, 2, 1, 3, 4, 2, 4, 5])
+
+
+def get_dtype(num_calib, float_type=np.float32):
+    return np.dtype([
+        ("cid", np.int64),
+        ("z", float_type),
+        ("mass_prob", float_type),
+        ("sim_mBx1c", float_type, (3,)),
+        ("obs_mBx1c", float_type, (3,)),
+        ("bias_mBx1c", float_type, (3,)),
+        ("cov", float_type, (6,)),
+        ("deta_dcalib", float_type, (3, num_calib))
+    ])
+
+
+def get_num_calib(records):
+    return records.dtype["deta_dcalib"].shape[1]
+
+
+def pack_cov(covs):
+    """ Reduce (n, 3, 3) symmetric covariances to their (n, 6) unique terms. """
+    return covs.reshape((-1, 9))[:, COV_UNIQUE]
+
+
+def unpack_cov(packed):
+    """ Expand (n, 6) unique covariance terms to new (n, 3, 3) arrays. """
+    return packed[:, COV_FULL].reshape((-1, 3, 3))
+
+
+def from_legacy(data, float_type=np.float32):
+    """ Convert the original float matrix layout into records.
+
+    The columns are CID, z, mass probability, simulated mB x1 c, observed mB x1 c,
+    bias mB x1 c, the flattened covariance and then the flattened (3, num_calib)
+    calibration offsets.
+    """
+    num_calib = (data.shape[1] - 21) // 3
+    records = np.empty(data.shape[0], dtype=get_dtype(num_calib, float_type=float_type))
+    records["cid"] = data[:, 0]
+    records["z"] = data[:, 1]
+    records["mass_prob"] = data[:, 2]
+    records["sim_mBx1c"] = data[:, 3:6]
+    records["obs_mBx1c"] = data[:, 6:9]
+    records["bias_mBx1c"] = data[:, 9:12]
+    records["cov"] = pack_cov(data[:, 12:21])
+    records["deta_dcalib"] = data[:, 21:].reshape((data.shape[0], 3, num_calib))
+    return records
+
+
+def as_records(data):
+    """ Returns data as records, converting the legacy layout if needed. """
+    if data.dtype.names is None:
+        return from_legacy(data)
+    return data
+
+
+def save_format(folder):
+    with open(folder + "/" + FORMAT_NAME, "wb") as f:
+        pickle.dump({"version": FORMAT_VERSION}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def get_format_version(folder):
+    """ The record format version of the folder, or 0 for the legacy float matrix. """
+    filename = folder + "/" + FORMAT_NAME
+    if not os.path.exists(filename):
+        return 0
+    with open(filename, "rb") as f:
+        return pickle.load(f)["version"]
+
+
+def load_records(folder, realisation):
+    """ Load a realisation as records, from the archive or individual file. """
+    version = get_format_version(folder)
+    assert version <= FORMAT_VERSION, "Records in %s are version %d, but only up to %d is supported" \
+                                      % (folder, version, FORMAT_VERSION)
+    return as_records(load_passed(folder, realisation))
@@ -1,13 +1,52 @@
 import numpy as np
 from scipy.ndimage import gaussian_filter1d
 from scipy.stats import norm, skewnorm
-from scipy.optimize import curve_fit, minimize
+from scipy.optimize import curve_fit, minimize, brentq
+import hashlib
 import os
 import inspect
 import logging
 
+from dessn.utility.cache import cached, get_fingerprint, get_hash
 
-def des_sel(cov_scale=1.0, shift=None, type="G10", kappa=0, zlim=None, version=None):
+_fitting_versions = {}
+
+
+def get_fitting_version(fitter):
+    """ Hash of the source of ``fitter`` and of this module, so cached fits are redone when either changes. """
+    filenames = tuple(sorted(set([os.path.abspath(__file__), os.path.abspath(inspect.getsourcefile(fitter))])))
+    if filenames not in _fitting_versions:
+        h = hashlib.sha1()
+        for filename in filenames:
+            with open(filename, "rb") as f:
+                h.update(f.read())
+        _fitting_versions[filenames] = h.hexdigest()
+    return _fitting_versions[filenames]
+
+
+def get_selection(name, fitter, cut_mag, cov_scale=1.0, shift=None, kappa=0, zlim=None):
+    """ Fit the selection function, or load the fit from the on-disk artifact cache.
+
+    The cache key is the fingerprint of the ``all_*.npy`` dumps in the data folder,
+    every argument of the fit and a hash of the fitting code. The shift and covariance scale are applied after
+    loading, so every systematics configuration shares a single fit.
+    """
+    if shift is None:
+        shift = np.array([0.0, 0.0, 0.0, 0.0])
+    shift = np.array(shift, dtype=float)
+    zlim = None if zlim is None else float(zlim)
+    key = get_hash(get_fingerprint(get_dump_files(get_folder(name))), fitter.__name__, get_fitting_version(fitter),
+                   float(kappa), zlim, float(cut_mag))
+
+    def fit():
+        return fitter(name, kappa=kappa, zlim=zlim, cut_mag=cut_mag)
+
+    sn, mean, cov, r2 = cached(get_cache_folder(), "selection_%s" % os.path.basename(name), key, fit)
+    logging.info("Selection for %s has shift of %s" % (name, shift))
+    return sn, mean + shift, cov * cov_scale, r2
+
+
+def des_sel(cov_scale=1.0, shift=None, type="G10", kappa=0, zlim=None, version=None, cut_mag=19):
     if type is None:
         name = "snana_data/DES3YR_DES_BHMEFF_CD"
     else:
@@ -15,59 +54,89 @@ def des_sel(cov_scale=1.0, shift=None, type="G10", kappa=0, zlim=None, version=N
     if version is not None:
         logging.info("Using version %s" % version)
         name += "_%s" % version
-    sn, mean, cov, _ = get_selection_effects_cdf(name, kappa=kappa, zlim=zlim)
-    if shift is None:
-        shift = np.array([0.0, 0, 0.0, 0.0])
-    mean += shift
-    logging.info("Getting DES selection, shift of %s" % shift)
-    cov *= cov_scale
+    sn, mean, cov, _ = get_selection(name, get_selection_effects_cdf, cut_mag, cov_scale=cov_scale,
+                                     shift=shift, kappa=kappa, zlim=zlim)
     return sn, mean, cov, kappa
 
 
-def lowz_sel(cov_scale=1.0, shift=None, type="G10", kappa=0, zlim=None, version=None):
+def lowz_sel(cov_scale=1.0, shift=None, type="G10", kappa=0, zlim=None, version=None, cut_mag=10):
     if type is None:
         type = "G10"
     name = "snana_data/DES3YR_LOWZ_BHMEFF_%s" % type
     if version is not None:
         logging.info("Using version %s" % version)
         name += "_%s" % version
-    sn, mean, cov, _ = get_selection_effects_skewnorm(name, kappa=kappa, zlim=zlim)
-    if shift is None:
-        shift = np.array([0.0, 0.0, 0.0, 0.0])
-    mean += shift
-    logging.info("Getting LOWZ selection, shift of %s" % shift)
-    cov *= cov_scale
+    sn, mean, cov, _ = get_selection(name, get_selection_effects_skewnorm, cut_mag, cov_scale=cov_scale,
+                                     shift=shift, kappa=kappa, zlim=zlim)
     return sn, mean, cov, kappa
 
 
-def get_data(base, zlim=None, maxc=None, minc=None):
+def get_cache_folder():
+    return os.path.dirname(os.path.abspath(inspect.stack()[0][1])) + "/cache/"
+
+
+def get_dump_files(folder):
+    return [folder + "/" + f for f in os.listdir(folder) if f.startswith("all")]
+
+
+def iterate_dump(files, zlim=None, chunk_size=1000000):
+    """ Yield (mags, passed, zs) from memory-mapped ``all_*.npy`` dumps, one chunk at a time.
+
+    Peak memory is bounded by ``chunk_size`` rather than the total number of simulated objects.
+    """
+    for f in files:
+        supernovae = np.load(f, mmap_mode="r")
+        for start in range(0, supernovae.shape[0], chunk_size):
+            chunk = np.asarray(supernovae[start:start + chunk_size])
+            passed = chunk[:, 0] > 100
+            mags = chunk[:, 0] - 100 * passed.astype(int)
+            zs = chunk[:, 1]
+            if zlim is not None:
+                mask = zs < zlim
+                mags = mags[mask]
+                passed = passed[mask]
+                zs = zs[mask]
+            yield mags, passed, zs
+
+
+def get_folder(base):
     file = os.path.abspath(inspect.stack()[0][1])
     dir_name = os.path.dirname(file)
-    folder = dir_name + "/" + base
-    supernovae_files = [folder + "/" + f for f in os.listdir(folder) if f.startswith("all")]
-    supernovae_data = [np.load(f) for f in supernovae_files]
-    supernovae = np.vstack(tuple(supernovae_data))
-    passed = supernovae[:, 0] > 100
-    mags = supernovae[:, 0] - 100 * passed.astype(np.int)
-    zs = supernovae[:, 1]
-    if zlim is not None:
-        mask = zs < zlim
-        mags = mags[mask]
-        passed = passed[mask]
+    return dir_name + "/" + base
+
+
+def get_data(base, zlim=None, maxc=None, minc=None):
+    """ Load all magnitudes into memory. Prefer :func:`get_histograms` for large dumps. """
+    chunks = list(iterate_dump(get_dump_files(get_folder(base)), zlim=zlim))
+    mags = np.concatenate([c[0] for c in chunks])
+    passed = np.concatenate([c[1] for c in chunks])
     return mags, passed
 
 
+def get_histograms(base, bins=100, zlim=None, chunk_size=1000000):
+    """ Stream over the dumps to get histograms of all and passed magnitudes.
+
+    Two passes are made: the first finds the magnitude range (to match ``np.histogram``'s
+    automatic binning), the second accumulates counts.
+    """
+    files = get_dump_files(get_folder(base))
+    low, high = np.inf, -np.inf
+    for mags, _, _ in iterate_dump(files, zlim=zlim, chunk_size=chunk_size):
+        if mags.size:
+            low = min(low, mags.min())
+            high = max(high, mags.max())
+    _, edges = np.histogram(np.array([low, high]), bins=bins)
+
+    hist_all = np.zeros(bins, dtype=np.int64)
+    hist_passed = np.zeros(bins, dtype=np.int64)
+    for mags, passed, _ in iterate_dump(files, zlim=zlim, chunk_size=chunk_size):
+        hist_all += np.histogram(mags, bins=edges)[0]
+        hist_passed += np.histogram(mags[passed], bins=edges)[0]
+    return hist_all, hist_passed, edges
+
+
 def get_ratio(base_folder, cut_mag=19.75, delta=0, zlim=None, maxc=None, minc=None):
-    mB_all, passed = get_data(base_folder, zlim=zlim, maxc=maxc, minc=minc)
-    mB_passed = mB_all[passed]
-
-    # Bin data and get ratio
-    # import matplotlib.pyplot as plt
-    # plt.hist(mB_passed, 100)
-    # plt.show()
-    # exit()
-    hist_all, bins = np.histogram(mB_all, bins=100)
-    hist_passed, _ = np.histogram(mB_passed, bins=bins)
+    hist_all, hist_passed, bins = get_histograms(base_folder, bins=100, zlim=zlim)
     hist_passed_err = np.sqrt(hist_passed)
 
     binc = 0.5 * (bins[:-1] + bins[1:])
@@ -83,6 +152,60 @@ def get_ratio(base_folder, cut_mag=19.75, delta=0, zlim=None, maxc=None, minc=No
     return binc, ratio, ratio_error, ratio_smooth, ratio_smooth_error
 
 
+def get_inflated_fit(model, binc, ratio_fit, ratio_chi2, ratio_error, p0, adj, goal=1.0, threshold=0.02,
+                     bounds=None, max_expand=60):
+    """ Fit ``model`` with an extra error term added in quadrature to ``ratio_error``, so that
+    the reduced chi2 is within ``threshold`` of ``goal``.
+
+    The reduced chi2 decreases monotonically with the error term, so instead of nudging
+    the term by a fixed factor we bracket the root in log space and solve for it with
+    Brent's method. Each ``curve_fit`` is warm started from the previous solution, and
+    any fit within ``threshold`` counts as the root, which ends the search.
+
+    Returns
+    -------
+    vals, cov, r2, ratio_error_adj
+        The fit closest to ``goal``, its covariance, the reduced chi2 of the first fit
+        (at ``adj``), and the inflated uncertainties.
+    """
+    kwargs = {} if bounds is None else {"bounds": bounds}
+    state = {"p0": p0, "fits": 0, "best": None}
+
+    def objective(log_adj):
+        ratio_error_adj = np.sqrt(ratio_error ** 2 + np.exp(log_adj) ** 2)
+        vals, cov, *_ = curve_fit(model, binc, ratio_fit, p0=state["p0"], sigma=ratio_error_adj, **kwargs)
+        chi2 = np.sum(((ratio_chi2 - model(binc, *vals)) / ratio_error_adj) ** 2)
+        red_chi2 = chi2 / (len(binc) - 3)
+        diff = red_chi2 - goal
+        state["p0"] = vals
+        state["fits"] += 1
+        if state["best"] is None or np.abs(diff) < np.abs(state["best"][2] - goal):
+            state["best"] = vals, cov, red_chi2, ratio_error_adj
+        return 0.0 if np.abs(diff) <= threshold else diff
+
+    start = np.log(adj)
+    diff = objective(start)
+    r2 = state["best"][2]
+    if diff != 0:
+        # Reduced chi2 falls as the error term grows, so step away from start until the sign flips
+        step = np.log(2.0) if diff > 0 else -np.log(2.0)
+        other, other_diff = start, diff
+        for i in range(max_expand):
+            start, diff = other, other_diff
+            other = other + step
+            other_diff = objective(other)
+            if np.sign(other_diff) != np.sign(diff):
+                break
+            step *= 1.5
+        else:
+            logging.warning("Could not bracket the error inflation term, using the closest fit")
+        if other_diff != 0 and np.sign(other_diff) != np.sign(diff):
+            brentq(objective, min(start, other), max(start, other), xtol=1e-6)
+    vals, cov, red_chi2, ratio_error_adj = state["best"]
+    logging.info("Error inflation found after %d fits, reduced chi2 of %0.3f" % (state["fits"], red_chi2))
+    return vals, cov, r2, ratio_error_adj
+
+
 def get_selection_effects_cdf(dump_npy, plot=False, cut_mag=19, kappa=0, zlim=None):
     binc, ratio, ratio_error, ratio_smooth, ratio_smooth_error = get_ratio(dump_npy, cut_mag=cut_mag, delta=kappa, zlim=zlim)
     # print(binc, ratio)
@@ -90,24 +213,9 @@ def get_selection_effects_cdf(dump_npy, plot=False, cut_mag=19, kappa=0, zlim=No
         model = (1 - norm.cdf(b, loc=mean, scale=sigma)) * n + 10 * alpha
         return model
 
-    threshold = 0.02
-    red_chi2 = 100
-    adj = 0.0001
-    r2 = None
-    while np.abs(red_chi2 - 1) > threshold:
-        if red_chi2 > 1:
-            adj *= 1.01
-        else:
-            adj *= 0.98
-        ratio_error_adj = np.sqrt(ratio_error**2 + adj**2)
-        # ratio_error_adj = 0.001 + ratio_error * adj
-        # print(ratio_error_adj)
-        result = curve_fit(cdf, binc, ratio, p0=np.array([23.0, 1.0, 0.0, 0.5]), sigma=ratio_error_adj)
-        vals, cov, *_ = result
-        chi2 = np.sum(((ratio - cdf(binc, *vals)) / ratio_error_adj) ** 2)
-        red_chi2 = chi2 / (len(binc) - 3)
-        if r2 is None:
-            r2 = red_chi2
+    vals, cov, r2, ratio_error_adj = get_inflated_fit(cdf, binc, ratio, ratio, ratio_error,
+                                                      np.array([23.0, 1.0, 0.0, 0.5]), 0.0001 * 1.01,
+                                                      threshold=0.02)
 
     if plot:
         import matplotlib.pyplot as plt
@@ -150,25 +258,9 @@ def get_selection_effects_skewnorm(dump_npy, plot=False, cut_mag=10, kappa=0, zl
         model = skewnorm.pdf(b, alpha, loc=mean, scale=sigma) * n
         return model
 
-    threshold = 0.1
-    red_chi2 = np.inf
-    adj = 0.0001
-    goal = 1
-    r2 = None
-    while np.abs(red_chi2 - goal) > threshold:
-        if red_chi2 > goal:
-            adj *= 1.2
-        else:
-            adj *= 0.8
-        # ratio_error_adj = ratio_smooth_error + adj
-        ratio_error_adj = np.sqrt(ratio_smooth_error**2 + adj**2)
-        result = curve_fit(sknorm, binc, ratio_smooth, p0=np.array([15.0, 1.0, 0.0, 0.5]),
-                           sigma=ratio_error_adj, bounds=([10, 0, -10, 0], [30, 10, 10, 5.0]))
-        vals, cov, *_ = result
-        chi2 = np.sum(((ratio - sknorm(binc, *vals)) / ratio_error_adj) ** 2)
-        red_chi2 = chi2 / (len(binc) - 3)
-        if r2 is None:
-            r2 = red_chi2
+    vals, cov, r2, ratio_error_adj = get_inflated_fit(sknorm, binc, ratio_smooth, ratio, ratio_smooth_error,
+                                                      np.array([15.0, 1.0, 0.0, 0.5]), 0.0001 * 1.2,
+                                                      threshold=0.1, bounds=([10, 0, -10, 0], [30, 10, 10, 5.0]))
 
     if plot:
         import matplotlib.pyplot as plt
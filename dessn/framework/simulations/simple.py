@@ -1,20 +1,63 @@
+import hashlib
+import inspect
+import os
+import pickle
+from multiprocessing import Pool
+
 import numpy as np
 from astropy.cosmology import FlatwCDM
 from scipy.stats import norm, multivariate_normal, skewnorm
+from scipy.optimize import minimize_scalar
 
 from dessn.framework.simulation import Simulation
+from dessn.framework.simulations.records import get_dtype, load_records, pack_cov, unpack_cov, save_format
+from dessn.utility.cache import get_hash
+
+_generator_version = None
+
+
+def get_generator_version():
+    """ Hash of the generator source, so prepared realisations are rebuilt when it changes. """
+    global _generator_version
+    if _generator_version is None:
+        h = hashlib.sha1()
+        for filename in [os.path.abspath(__file__), inspect.getsourcefile(Simulation)]:
+            with open(filename, "rb") as f:
+                h.update(f.read())
+        _generator_version = h.hexdigest()
+    return _generator_version
+
+
+def _write_realisation(args):
+    simulation, cosmology_index = args
+    simulation.write_realisation(cosmology_index)
+    return cosmology_index
 
 
 class SimpleSimulation(Simulation):
+    """ Supernovae drawn from the model's own population, with a simple magnitude selection.
 
+    By default the output matches the original object by object generator in distribution.
+    ``analytic_selection`` normalises the selection probability by its maximum over all
+    magnitudes, instead of over each block of ``block_size`` generated objects, which
+    lowers the low-z efficiency by about a third. ``latent_sims`` gives the ``sim_*``
+    values as the true latent values, instead of the observed ones the original
+    generator returned, which changes the weights of ``FullModelWithCorrection``.
+    """
     def __init__(self, num_supernova, dscale=0.08, alpha_c=2, mass=True, num_nodes=4, lowz=False, min_prob_ia=0.9999999,
-                 disable_selection=False, kappa0=0.03, kappa1=0.03):
+                 disable_selection=False, kappa0=0.03, kappa1=0.03, analytic_selection=False, latent_sims=False):
         super().__init__()
+        self.params = {"num_supernova": num_supernova, "dscale": dscale, "alpha_c": alpha_c, "mass": mass,
+                       "num_nodes": num_nodes, "lowz": lowz, "min_prob_ia": min_prob_ia,
+                       "disable_selection": disable_selection, "kappa0": kappa0, "kappa1": kappa1,
+                       "analytic_selection": analytic_selection, "latent_sims": latent_sims}
         self.alpha_c = alpha_c
         self.dscale = dscale
         self.min_prob_ia = min_prob_ia
         self.num_calib = 1
         self.disable_selection = disable_selection
+        self.analytic_selection = analytic_selection
+        self.latent_sims = latent_sims
         self.kappa0 = kappa0
         self.kappa1 = kappa1
         if lowz:
@@ -37,10 +80,17 @@ class SimpleSimulation(Simulation):
         self.mass_scale = 1.0 if mass else 0.0
         self.num_nodes = num_nodes
         self.num_supernova = num_supernova
+        self.max_batch = 1000000
+        self.block_size = 2000
+        this_dir = os.path.dirname(os.path.abspath(__file__))
+        self.cache_folder = this_dir + "/cache/simple_%s/" % get_hash(self.params, get_generator_version())
 
     def get_name(self):
         return "simple"
 
+    def get_data_key(self, cosmology_index):
+        return get_hash(type(self).__name__, self.params, cosmology_index)
+
     def get_truth_values(self):
         return [
             ("Om", 0.3, r"$\Omega_m$"),
@@ -81,106 +131,211 @@ class SimpleSimulation(Simulation):
         self.logger.info("Generating for cosmology index %d" % cosmology_index)
         cosmology = FlatwCDM(70.0, truth["Om"])
 
-        # Unwrap some values
-        alpha, beta, dscale, dratio = truth["alpha"], truth["beta"], truth["dscale"], truth["dratio"]
-        sim_mBx1c, obs_mBx1c_cov, obs_mBx1c, deta_dcalib = [], [], [], []
-        redshifts_all, redshift_pre_comp_all, p_high_masses_all, mask_all, mbs_all,  = [], [], [], [], []
-        ia_probs_all = []
-        sim_x1s_all, sim_cs_all = [], []
+        # Generate in batches, sizing each batch from the efficiency seen so far
+        batches = []
+        num_passed, num_generated = 0, 0
+        nn = 2000
+        while True:
+            batch = self.get_batch(nn, truth, cosmology)
+            batches.append(batch)
+            num_passed += batch["passed"].sum()
+            num_generated += nn
+            self.logger.debug("Have %d passed out of required %d sne, generated %d" % (num_passed, n_sne, num_generated))
+            if num_passed >= n_sne:
+                break
+            efficiency = max(num_passed, 1) / num_generated
+            nn = int(np.clip(1.1 * (n_sne - num_passed) / efficiency, 2000, self.max_batch))
+            # Whole blocks only, so every block shares one selection normalisation
+            nn = self.block_size * int(np.ceil(nn / self.block_size))
+
+        result = {k: np.concatenate([b[k] for b in batches]) for k in batches[0].keys()}
+        cut_index = np.where(result["passed"].cumsum() == n_sne)[0][0] + 1
+        self.logger.debug("Generated %d objects out of %d passed, %d percent"
+                          % (num_passed, num_generated, 100 * (num_passed / num_generated)))
+
+        result = {k: v[:cut_index] for k, v in result.items()}
+        result["n_sne"] = n_sne
+        return result
+
+    def get_passed_supernova(self, n_sne, cosmology_index=0):
+        filename = self.cache_folder + "passed_%d.npy" % cosmology_index
+        if n_sne != self.num_supernova or not os.path.exists(filename):
+            return super().get_passed_supernova(n_sne, cosmology_index=cosmology_index)
+
+        self.logger.info("Loading prepared realisation from %s" % filename)
+        supernovae = load_records(self.cache_folder, cosmology_index)
+        extra = np.load(self.cache_folder + "extra_%d.npy" % cosmology_index)
+        return {
+            "n_sne": supernovae.shape[0],
+            "obs_mBx1c": np.array(supernovae["obs_mBx1c"]),
+            "obs_mBx1c_cov": unpack_cov(supernovae["cov"]),
+            "deta_dcalib": np.array(supernovae["deta_dcalib"]),
+            "redshifts": np.array(supernovae["z"]),
+            "shift_deltas": extra[:, 2],
+            "masses": np.array(supernovae["mass_prob"]),
+            "existing_prob": extra[:, 1],
+            "sim_apparents": np.array(supernovae["sim_mBx1c"][:, 0]),
+            "sim_stretches": np.array(supernovae["sim_mBx1c"][:, 1]),
+            "sim_colours": np.array(supernovae["sim_mBx1c"][:, 2]),
+            "prob_ia": extra[:, 0]
+        }
+
+    def write_realisation(self, cosmology_index):
+        """ Generate one realisation and save it in the layout SNANASimulation reads.
+
+        passed_%d.npy holds the passed supernovae as double precision records, and all_%d.npy
+        holds mB + 100 * passed and z for every generated object. The values the records have
+        no field for go in extra_%d.npy.
+        """
+        result = self.get_all_supernova(self.num_supernova, cosmology_index=cosmology_index)
+        passed = result["passed"]
+        n = passed.size
+        all_sne = np.vstack((result["sim_apparents"] + 100 * passed, result["redshifts"])).T
+        supernovae = np.zeros(n, dtype=get_dtype(self.num_calib, float_type=np.float64))
+        supernovae["cid"] = np.arange(n)
+        supernovae["z"] = result["redshifts"]
+        supernovae["mass_prob"] = result["masses"]
+        supernovae["sim_mBx1c"] = np.vstack((result["sim_apparents"], result["sim_stretches"], result["sim_colours"])).T
+        supernovae["obs_mBx1c"] = result["obs_mBx1c"]
+        supernovae["cov"] = pack_cov(result["obs_mBx1c_cov"])
+        supernovae["deta_dcalib"] = result["deta_dcalib"]
+        extra = np.vstack((result["prob_ia"], result["existing_prob"], result["shift_deltas"])).T
+
+        # Passed file last, as its presence marks the realisation as complete
+        self._save(self.cache_folder + "all_%d.npy" % cosmology_index, all_sne)
+        self._save(self.cache_folder + "extra_%d.npy" % cosmology_index, extra[passed])
+        self._save(self.cache_folder + "passed_%d.npy" % cosmology_index, supernovae[passed])
 
-        # Assume constant population.
+    def _save(self, filename, array):
+        temp = "%s.%d.tmp" % (filename, os.getpid())
+        with open(temp, "wb") as f:
+            np.save(f, array)
+        os.replace(temp, filename)
+
+    def prepare(self, num_realisations, num_cpu=None):
+        """ Generate any missing realisations in parallel, so fitting jobs load rather than regenerate them. """
+        if not os.path.exists(self.cache_folder):
+            os.makedirs(self.cache_folder, exist_ok=True)
+        with open(self.cache_folder + "sys_names.pkl", "wb") as f:
+            pickle.dump(self.get_systematic_names(), f)
+        save_format(self.cache_folder)
+
+        missing = [i for i in range(num_realisations) if not os.path.exists(self.cache_folder + "passed_%d.npy" % i)]
+        self.logger.info("Preparing %d of %d realisations in %s" % (len(missing), num_realisations, self.cache_folder))
+        if not missing:
+            return
+        with Pool(processes=num_cpu) as pool:
+            for index in pool.imap_unordered(_write_realisation, [(self, i) for i in missing]):
+                self.logger.debug("Wrote realisation %d" % index)
+
+    def get_distmod(self, cosmology, redshifts):
+        """ Distance modulus, interpolated in log redshift for large batches as astropy integrates per object. """
+        if redshifts.size < 10000:
+            return cosmology.distmod(redshifts).value
+        log_zs = np.linspace(np.log(redshifts.min()), np.log(redshifts.max()), 5000)
+        return np.interp(np.log(redshifts), log_zs, cosmology.distmod(np.exp(log_zs)).value)
+
+    def get_population(self, nn, truth):
+        """ Draw the (skewed in colour) population of MB, x1, c and its log probability.
+
+        Drawing from a multivariate normal and accepting with probability Phi(alpha_c (c - <c>) / sigma_c)
+        is equivalent to drawing the population alongside an auxiliary normal, correlated
+        with colour, and reflecting every draw where the auxiliary value is negative. This
+        gives the skew normal directly without rejection.
+        """
         means = np.array([truth["mean_MB"], truth["mean_x1"][0], truth["mean_c"][0]])
         sigmas = np.array([truth["sigma_MB"], truth["sigma_x1"], truth["sigma_c"]])
         sigmas_mat = np.dot(sigmas[:, None], sigmas[None, :])
         correlations = np.dot(truth["intrinsic_correlation"], truth["intrinsic_correlation"].T)
         pop_cov = correlations * sigmas_mat
-        probs = []
 
+        skew = truth["alpha_c"]
+        cross = skew * pop_cov[:, 2] / truth["sigma_c"] / np.sqrt(1 + skew ** 2)
+        joint_cov = np.zeros((4, 4))
+        joint_cov[:3, :3] = pop_cov
+        joint_cov[:3, 3] = cross
+        joint_cov[3, :3] = cross
+        joint_cov[3, 3] = 1.0
+        draws = np.random.multivariate_normal(np.zeros(4), joint_cov, size=nn)
+        MBx1c = means + np.where(draws[:, 3:] < 0, -1, 1) * draws[:, :3]
+
+        skew_prob = norm.logcdf(skew * (MBx1c[:, 2] - truth["mean_c"][0]) / truth["sigma_c"], 0, 1)
+        probs = multivariate_normal.logpdf(MBx1c, mean=means, cov=pop_cov) + skew_prob
+        return MBx1c, probs, sigmas
+
+    def get_selection_probability(self, mbs):
+        """ Probability each object with apparent magnitude ``mbs`` passes selection.
+
+        The original generator divided the efficiency by its largest value among each
+        batch of 2000 objects, so that is the default, applied to consecutive blocks of
+        ``block_size``. With ``analytic_selection`` it is divided by its maximum over all
+        magnitudes instead, which is 1 for the complementary CDF and the analytic peak
+        for the skew normal.
+        """
+        if self.disable_selection:
+            return np.ones(mbs.shape)
+        if not self.skewnorm:
+            probs = 1 - norm.cdf(mbs, self.mb_mean, self.mb_width)
+        else:
+            probs = skewnorm.pdf(mbs, self.mb_alpha, self.mb_mean, self.mb_width)
+        if self.analytic_selection:
+            if not self.skewnorm:
+                return probs
+            peak = minimize_scalar(lambda x: -skewnorm.pdf(x, self.mb_alpha, self.mb_mean, self.mb_width),
+                                   bracket=(self.mb_mean, self.mb_mean + self.mb_width)).fun
+            return probs / -peak
+        starts = np.arange(0, probs.size, self.block_size)
+        maxes = np.maximum.reduceat(probs, starts)
+        return probs / np.repeat(maxes, np.diff(np.append(starts, probs.size)))
+
+    def get_batch(self, nn, truth, cosmology):
+        alpha, beta, dscale, dratio = truth["alpha"], truth["beta"], truth["dscale"], truth["dratio"]
         outlier_MB_delta, outlier_dispersion = truth["outlier_MB_delta"], truth["outlier_dispersion"]
-        nn = 2000
-        # Generate 1000 at a time
-        while True:
-            redshifts = (np.random.uniform(self.min_z_gen, self.max_z_gen, nn) ** self.power)
-            dist_mod = cosmology.distmod(redshifts).value
-            redshift_pre_comp = 0.9 + np.power(10, 0.95 * redshifts)
-            p_high_masses = np.random.uniform(low=0.0, high=1.0, size=dist_mod.size) * self.mass_scale
-            ia_probs = np.random.uniform(low=self.min_prob_ia, high=1.0, size=nn)
-            contaminations = np.random.random(nn) > ia_probs
-            for zz, mu, p, contamination, red in zip(redshift_pre_comp, dist_mod, p_high_masses, contaminations, redshifts):
-                while True:
-                    MB, x1, c = np.random.multivariate_normal(means, pop_cov)
-                    if np.random.random() < norm.cdf(truth["alpha_c"] * (c - truth["mean_c"][0]) / truth["sigma_c"], 0, 1):
-                        skew_prob = norm.logcdf(truth["alpha_c"] * (c - truth["mean_c"][0]) / truth["sigma_c"], 0, 1)
-                        break
-                probs.append(multivariate_normal.logpdf([MB, x1, c], mean=means, cov=pop_cov) + skew_prob)
-                if contamination:
-                    MB -= outlier_MB_delta
-                    adjust = np.random.normal(loc=0, scale=np.sqrt(outlier_dispersion**2 - sigmas**2), size=3)
-                    MB += adjust[0]
-                    x1 += adjust[1]
-                    c += adjust[2]
-
-                mass_correction = dscale * (1.9 * (1 - dratio) / zz + dratio)
-                mb = MB + mu - alpha * x1 + beta * c - mass_correction * p
-                vector = np.array([mb, x1, c])
-                # Add intrinsic scatter to the mix
-                diag = np.array([0.04, 0.2, 0.03])**2
-                cov = np.diag(diag)
-                obs_mBx1c_cov.append(cov)
-                sim_mBx1c.append(vector)
-                cov2 = cov.copy()
-                cov2[2, 2] += (self.kappa0 + self.kappa1 * red)**2
-                vector += np.random.multivariate_normal([0, 0, 0], cov2)
-                obs_mBx1c.append(vector)
-                deta_dcalib.append(np.zeros((3, self.num_calib)))
-            redshifts_all += redshifts.tolist()
-            redshift_pre_comp_all += redshift_pre_comp.tolist()
-            p_high_masses_all += p_high_masses.tolist()
-            ia_probs_all += ia_probs.tolist()
-
-            mbs = np.array([o[0] for o in sim_mBx1c[-nn:]])
-            sim_x1 = np.array([o[1] for o in sim_mBx1c[-nn:]])
-            sim_c = np.array([o[2] for o in sim_mBx1c[-nn:]])
-            vals = np.random.uniform(size=mbs.size)
-            if self.disable_selection:
-                pdfs = np.ones(mbs.shape)
-            else:
-                if not self.skewnorm:
-                    pdfs = 1 - norm.cdf(mbs, self.mb_mean, self.mb_width)
-                    pdfs /= pdfs.max()
-                else:
-                    pdfs = skewnorm.pdf(mbs, self.mb_alpha, self.mb_mean, self.mb_width)
-                    pdfs /= pdfs.max()
-            mask = vals < pdfs
-            mbs_all += mbs.tolist()
-            sim_x1s_all += sim_x1.tolist()
-            sim_cs_all += sim_c.tolist()
-            mask_all += mask.tolist()
-
-            self.logger.debug("Have %d passed out of required %d sne, generated %d"
-                              % (np.array(mask_all).sum(), n_sne, len(mask_all)))
-            if np.array(mask_all).sum() >= n_sne:
-                break
 
-        indexes = np.array(mask_all).cumsum()
-        cut_index = np.where(indexes == n_sne)[0][0] + 1
-        mask_all = np.array(mask_all)
-        self.logger.debug("Generated %d objects out of %d passed, %d percent" % (mask_all.sum(), mask_all.size, 100 * (mask_all.sum() / mask_all.size)))
+        redshifts = (np.random.uniform(self.min_z_gen, self.max_z_gen, nn) ** self.power)
+        dist_mod = self.get_distmod(cosmology, redshifts)
+        redshift_pre_comp = 0.9 + np.power(10, 0.95 * redshifts)
+        p_high_masses = np.random.uniform(low=0.0, high=1.0, size=dist_mod.size) * self.mass_scale
+        ia_probs = np.random.uniform(low=self.min_prob_ia, high=1.0, size=nn)
+        contaminations = np.random.random(nn) > ia_probs
+
+        MBx1c, probs, sigmas = self.get_population(nn, truth)
+        num_contam = contaminations.sum()
+        if num_contam:
+            MBx1c[contaminations, 0] -= outlier_MB_delta
+            MBx1c[contaminations] += np.random.normal(loc=0, scale=np.sqrt(outlier_dispersion**2 - sigmas**2),
+                                                      size=(num_contam, 3))
+        MB, x1, c = MBx1c.T
+
+        mass_correction = dscale * (1.9 * (1 - dratio) / redshift_pre_comp + dratio)
+        mb = MB + dist_mod - alpha * x1 + beta * c - mass_correction * p_high_masses
+        sim_mBx1c = np.vstack((mb, x1, c)).T
+
+        # Add intrinsic scatter to the mix
+        diag = np.array([0.04, 0.2, 0.03])**2
+        obs_mBx1c_cov = np.repeat(np.diag(diag)[None, :, :], nn, axis=0)
+        variances = np.repeat(diag[None, :], nn, axis=0)
+        variances[:, 2] += (self.kappa0 + self.kappa1 * redshifts)**2
+        obs_mBx1c = sim_mBx1c + np.random.normal(size=(nn, 3)) * np.sqrt(variances)
+
+        # Selection acts on the observed apparent magnitude
+        passed = np.random.uniform(size=nn) < self.get_selection_probability(obs_mBx1c[:, 0])
+        # The original generator added the noise in place, so its sim_* values were the observed ones
+        sims = sim_mBx1c if self.latent_sims else obs_mBx1c
 
         return {
-            "n_sne": n_sne,
-            "obs_mBx1c": np.array(obs_mBx1c[:cut_index]),
-            "obs_mBx1c_cov": np.array(obs_mBx1c_cov[:cut_index]),
-            "deta_dcalib": np.array(deta_dcalib[:cut_index]),
-            "redshifts": np.array(redshifts_all[:cut_index]),
-            "shift_deltas": np.zeros(cut_index),
-            "masses": np.array(p_high_masses_all[:cut_index]),
-            "existing_prob": np.array(probs[:cut_index]),
-            "sim_apparents": np.array(mbs_all[:cut_index]),
-            "sim_stretches": np.array(sim_x1s_all[:cut_index]),
-            "sim_colours": np.array(sim_cs_all[:cut_index]),
-            "passed": np.array(mask_all[:cut_index]),
-            "prob_ia": np.array(ia_probs_all[:cut_index])
+            "obs_mBx1c": obs_mBx1c,
+            "obs_mBx1c_cov": obs_mBx1c_cov,
+            "deta_dcalib": np.zeros((nn, 3, self.num_calib)),
+            "redshifts": redshifts,
+            "shift_deltas": np.zeros(nn),
+            "masses": p_high_masses,
+            "existing_prob": probs,
+            "sim_apparents": sims[:, 0],
+            "sim_stretches": sims[:, 1],
+            "sim_colours": sims[:, 2],
+            "passed": passed,
+            "prob_ia": ia_probs
         }
 
     def get_approximate_correction(self):
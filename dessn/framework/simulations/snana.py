@@ -2,13 +2,61 @@ import numpy as np
 import os
 import inspect
 import pickle
+import logging
 
 from scipy.interpolate import interp1d
 from scipy.stats import binned_statistic
 
+from dessn.framework.precision import STORAGE_TYPE, as_storage
 from dessn.framework.simulation import Simulation
 from dessn.general.pecvelcor import get_sigma_mu_pecvel
-from dessn.framework.simulations.selection_effects import des_sel, lowz_sel
+from dessn.framework.simulations.selection_effects import des_sel, lowz_sel, get_dump_files
+from dessn.framework.simulations.archive import get_source_files
+from dessn.framework.simulations.records import load_records, unpack_cov
+from dessn.utility.cache import cached, get_fingerprint, get_hash
+
+
+def compute_bias_cor(folders, bine=30):
+    """ Mean colour bias as a function of redshift, for the C11 and G10 BHMEFF sims. """
+    models = ["C11", "G10"]
+    means = []
+    for folder, model in zip(folders, models):
+        data = load_records(folder, 0)
+        z = data["z"]
+        c_obs = data["obs_mBx1c"][:, 2]
+        c_true = data["sim_mBx1c"][:, 2]
+        diff = c_obs - c_true
+        mean, bine, _ = binned_statistic(z, diff, bins=bine)
+        means.append(mean)
+
+    middle = np.array(means)
+    binc = 0.5 * (bine[1:] + bine[:-1])
+    return binc, models[0], middle[0]
+
+
+def compute_disp(folders, bine=10):
+    """ Extra colour dispersion of C11 over G10 as a function of redshift. """
+    models = ["C11", "G10"]
+    means = []
+    for folder, model in zip(folders, models):
+        data = load_records(folder, 0)
+        z = data["z"]
+        c_obs = data["obs_mBx1c"][:, 2]
+        c_true = data["sim_mBx1c"][:, 2]
+        c_std = np.sqrt(data["cov"][:, 5])
+        rms = np.abs(c_obs - c_true)
+
+        mean_rms, bine, _ = binned_statistic(z, rms, bins=bine)
+        mean_cstd, _, _ = binned_statistic(z, c_std, bins=bine)
+
+        extra = mean_rms**2 - mean_cstd**2
+        logging.debug("%s extra dispersion %s" % (model, extra))
+        means.append(extra)
+    final = means[0] - means[1]
+    final = np.array([max(0, i) for i in final])
+    binc = 0.5 * (bine[1:] + bine[:-1])
+    logging.debug("Extra dispersion %s" % np.sqrt(final))
+    return binc, final
 
 
 class SNANASimulation(Simulation):
@@ -20,6 +68,8 @@ class SNANASimulation(Simulation):
         self.global_calib = global_calib
         this_dir = os.path.dirname(os.path.abspath(inspect.stack()[0][1]))
         self.data_folder = this_dir + "/snana_data/%s/" % self.simulation_name
+        self.cache_folder = this_dir + "/cache/"
+        self.chunk_size = 1000000
         assert os.path.exists(self.data_folder), "Cannot find folder %s" % self.data_folder
         self.use_sim = use_sim
         self.num_nodes = num_nodes
@@ -54,6 +104,17 @@ class SNANASimulation(Simulation):
     def get_name(self):
         return self.simulation_name
 
+    def get_data_key(self, cosmology_index):
+        if self.use_sim:
+            return None  # Observations are redrawn on every call
+        files = get_source_files(self.data_folder, cosmology_index)
+        if self.bias_cor or self.add_disp:
+            files += [f for folder in self.get_bias_cor_folders("_DES" in self.simulation_name)
+                      for f in get_source_files(folder, 0)]
+        settings = [self.simulation_name, self.num_supernova, self.num_nodes, self.cov_scale, self.global_calib,
+                    self.shift, self.type, self.kappa, self.bias_cor, self.zlim, self.add_pecv, self.add_disp]
+        return get_hash(type(self).__name__, settings, get_fingerprint(files), self.get_approximate_correction())
+
     def get_truth_values(self):
         return [
             ("Om", 0.3, r"$\Omega_m$"),
@@ -91,102 +152,73 @@ class SNANASimulation(Simulation):
     def get_all_supernova(self, n_sne, cosmology_index=0):
         self.logger.info("Getting SNANA data from %s" % self.data_folder)
 
-        supernovae_files = [np.load(self.data_folder + "/" + f) for f in os.listdir(self.data_folder) if f.startswith("all")]
-        supernovae = np.vstack(tuple(supernovae_files))
-        passed = supernovae > 100
-        mags = supernovae - 100 * passed.astype(np.int)
+        files = get_dump_files(self.data_folder)
+        dumps = [np.load(f, mmap_mode="r") for f in files]
+        # Keep the columns and precision of the dumps, rather than promoting them
+        columns, dtype = dumps[0].shape[1:], dumps[0].dtype
+        for f, dump in zip(files, dumps):
+            assert dump.shape[1:] == columns and dump.dtype == dtype, \
+                "Dump %s has shape %s and type %s, not %s and %s" % (f, dump.shape[1:], dump.dtype, columns, dtype)
+        total = sum([dump.shape[0] for dump in dumps])
+        mags = np.empty((total,) + columns, dtype=dtype)
+        passed = np.empty((total,) + columns, dtype=bool)
+        offset = 0
+        for supernovae in dumps:
+            for start in range(0, supernovae.shape[0], self.chunk_size):
+                chunk = np.asarray(supernovae[start:start + self.chunk_size])
+                end = offset + chunk.shape[0]
+                passed[offset:end] = chunk > 100
+                mags[offset:end] = chunk - dtype.type(100) * passed[offset:end]
+                offset = end
         res = {
             "sim_apparents": mags,
             "passed": passed
         }
         return res
 
-    def get_bias_cor(self, des=True):
-        print("Getting biascor for des=%s" % des)
+    def get_bias_cor_folders(self, des=True):
         if des:
-            file = self.data_folder + "../DES3YR_DES_BHMEFF_AM%s/passed_0.npy"
+            folder = self.data_folder + "../DES3YR_DES_BHMEFF_AM%s"
         else:
-            file = self.data_folder + "../DES3YR_LOWZ_BHMEFF_%s/passed_0.npy"
-        models = ["C11", "G10"]
-        bine = 30
-        means = []
-        for model in models:
-            data = np.load(file % model)
-            z = data[:, 1]
-            c_obs = data[:, 8]
-            c_true = data[:, 5]
-            diff = c_obs - c_true
-            mean, bine, _ = binned_statistic(z, diff, bins=bine)
-            means.append(mean)
-            std, _, _ = binned_statistic(z, diff, statistic=lambda x: np.std(x) / np.sqrt(len(x)), bins=bine)
-
-        middle = np.array(means)
-        binc = 0.5 * (bine[1:] + bine[:-1])
-        return binc, models[0], middle[0]
+            folder = self.data_folder + "../DES3YR_LOWZ_BHMEFF_%s"
+        return [os.path.abspath(folder % model) for model in ["C11", "G10"]]
+
+    def get_bias_cor_fingerprint(self, folders):
+        return get_fingerprint([f for folder in folders for f in get_source_files(folder, 0)])
+
+    def get_bias_cor(self, des=True):
+        self.logger.info("Getting biascor for des=%s" % des)
+        folders = self.get_bias_cor_folders(des=des)
+        return cached(self.cache_folder, "biascor", self.get_bias_cor_fingerprint(folders),
+                      lambda: compute_bias_cor(folders))
 
     def get_disp(self, des=True):
-        print("Getting dispersion for des=%s" % des)
-        if des:
-            file = self.data_folder + "../DES3YR_DES_BHMEFF_AM%s/passed_0.npy"
-        else:
-            file = self.data_folder + "../DES3YR_LOWZ_BHMEFF_%s/passed_0.npy"
-        models = ["C11", "G10"]
-        bine = 10
-        means = []
-        for model in models:
-            data = np.load(file % model)
-            z = data[:, 1]
-            mb_obs = data[:, 6]
-            mb_true = data[:, 3]
-            c_obs = data[:, 8]
-            c_true = data[:, 5]
-            c_std = np.sqrt(data[:, 12 + 8])
-            rms = np.abs(c_obs - c_true)
-
-            mean_rms, bine, _ = binned_statistic(z, rms, bins=bine)
-            mean_cstd, _, _ = binned_statistic(z, c_std, bins=bine)
-
-            extra = mean_rms**2 - mean_cstd**2
-            print(model, extra)
-            means.append(extra)
-        final = means[0] - means[1]
-        final = np.array([max(0, i) for i in final])
-        binc = 0.5 * (bine[1:] + bine[:-1])
-        print("EXTRA ", np.sqrt(final), mean_rms)
-        return binc, final
+        self.logger.info("Getting dispersion for des=%s" % des)
+        folders = self.get_bias_cor_folders(des=des)
+        return cached(self.cache_folder, "disp", self.get_bias_cor_fingerprint(folders),
+                      lambda: compute_disp(folders))
 
     def get_passed_supernova(self, n_sne, cosmology_index=0):
-        filename = self.data_folder + "passed_%d.npy" % cosmology_index
-        assert os.path.exists(filename), "Cannot find file %s, do you have this realisations?" % filename
-        supernovae = np.load(filename)
-        self.logger.info("%s SN in %s" % (supernovae.shape[0], filename))
+        supernovae = load_records(self.data_folder, cosmology_index)
+        self.logger.info("%s SN in realisation %d of %s" % (supernovae.shape[0], cosmology_index, self.data_folder))
 
         if self.zlim is not None:
-            redshifts = supernovae[:, 1]
+            redshifts = supernovae["z"]
             self.logger.info("Enforcing zlim of %0.2f" % self.zlim)
             mask = redshifts < self.zlim
             self.logger.info("%d supernova out of %d passed the redshift cut" % (mask.sum(), supernovae.shape[0]))
-            supernovae = supernovae[mask, :]
+            supernovae = supernovae[mask]
 
         if n_sne != -1:
-            supernovae = supernovae[:n_sne, :]
+            supernovae = supernovae[:n_sne]
         else:
             n_sne = supernovae.shape[0]
             self.logger.info("All SN requested: found %d SN" % n_sne)
-        cids = supernovae[:, 0]
-        redshifts = supernovae[:, 1]
-        masses = supernovae[:, 2]
-        s_ap = supernovae[:, 3]
-        s_st = supernovae[:, 4]
-        s_co = supernovae[:, 5]
-        apparents = supernovae[:, 6]
-        stretches = supernovae[:, 7]
-        colours = supernovae[:, 8]
-        # bias_mB = supernovae[:, 9]
-        # bias_x1 = supernovae[:, 10]
-        # bias_c = supernovae[:, 11]
+        cids = supernovae["cid"]
+        redshifts = supernovae["z"]
+        masses = supernovae["mass_prob"]
+        s_ap, s_st, s_co = supernovae["sim_mBx1c"].T
         extra_uncert = get_sigma_mu_pecvel(redshifts)
-        obs_mBx1c_cov, obs_mBx1c, deta_dcalibs = [], [], []
 
         shift_amount = np.zeros(redshifts.shape)
         shift_deltas = np.zeros(redshifts.shape)
@@ -206,23 +238,18 @@ class SNANASimulation(Simulation):
             # shift_deltas = interp1d(cor_z, delta, bounds_error=False, fill_value=(delta[0], delta[-1]))(redshifts)
             shift_deltas = interp1d(cor_z, cor_means, bounds_error=False, fill_value=(cor_means[0], cor_means[-1]))(redshifts)
 
-        for i, (mb, x1, c, smb, sx1, sc, eu, sa) in enumerate(zip(apparents, stretches, colours, s_ap, s_st, s_co, extra_uncert, shift_amount)):
-            if self.use_sim:
-                cov = np.diag(np.array([0.04, 0.1, 0.04]) ** 2)
-                vector = np.array([smb, sx1, sc]) + np.random.multivariate_normal([0, 0, 0], cov)
-            else:
-                vector = np.array([mb, x1, c - sa])
-                cov = supernovae[i, 12:12 + 9].reshape((3, 3))
-                cov[2, 2] += extra_colour_add[i]
-            if self.add_pecv:
-                cov[0, 0] += eu**2
-            calib = supernovae[i, 12+9:].reshape((3, -1))
-            obs_mBx1c_cov.append(cov)
-            obs_mBx1c.append(vector)
-            deta_dcalibs.append(calib)
-        covs = np.array(obs_mBx1c_cov)
-        deta_dcalibs = np.array(deta_dcalibs)
-        obs_mBx1c = np.array(obs_mBx1c)
+        if self.use_sim:
+            cov = np.diag(np.array([0.04, 0.1, 0.04]) ** 2)
+            covs = as_storage(np.repeat(cov[None, :, :], n_sne, axis=0))
+            obs_mBx1c = as_storage([v + np.random.multivariate_normal([0, 0, 0], cov) for v in supernovae["sim_mBx1c"]])
+        else:
+            obs_mBx1c = np.array(supernovae["obs_mBx1c"])
+            obs_mBx1c[:, 2] -= shift_amount
+            covs = unpack_cov(supernovae["cov"])
+            covs[:, 2, 2] += extra_colour_add
+        if self.add_pecv:
+            covs[:, 0, 0] += extra_uncert**2
+        deta_dcalibs = supernovae["deta_dcalib"]
         result = {
             "cids": cids,
             "n_sne": n_sne,
@@ -234,8 +261,8 @@ class SNANASimulation(Simulation):
             "sim_apparents": s_ap,
             "sim_stretches": s_st,
             "sim_colours": s_co,
-            "shift_deltas": shift_deltas,
-            "prob_ia": np.ones(n_sne) * 1.0
+            "shift_deltas": as_storage(shift_deltas),
+            "prob_ia": np.ones(n_sne, dtype=STORAGE_TYPE)
         }
         return result
 
@@ -0,0 +1,211 @@
+""" Stan helpers shared by the engines in :mod:`dessn.framework.engines`.
+
+For PyStan, parameters are moved between Stan's constrained and unconstrained spaces
+with a ``StanFit4Model`` from a single fixed parameter draw, so jitter and
+approximations can work on an unbounded vector without knowing each parameter's
+constraints. For CmdStan, the output CSV files of sampling, optimisation, the Laplace
+approximation and variational inference are parsed into the same dictionaries of
+draws that ``fit.extract`` returns.
+"""
+import logging
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def get_deterministic_init(model, data, seed=0):
+    """ ``model.get_init`` with the global random state fixed, which is restored afterwards. """
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        return model.get_init(**data)
+    finally:
+        np.random.set_state(state)
+
+
+def find_mode(stan_model, data, init, seed=0, iter=2000):
+    """ Penalised maximum likelihood point from Stan's LBFGS optimiser.
+
+    Returns the parameters, including transformed parameters, and the log density.
+    """
+    result = stan_model.optimizing(data=data, init=lambda: init, seed=seed, iter=iter, as_vector=False)
+    logging.info("Optimiser finished with log density %0.2f" % result["value"])
+    return result["par"], result["value"]
+
+
+def get_transform_fit(stan_model, data, pars, seed=0):
+    """ A fit holding one fixed draw, used for its parameter transforms and log density. """
+    return stan_model.sampling(data=data, init=[pars], iter=1, chains=1, seed=seed, algorithm="Fixed_param")
+
+
+def unflatten(names, values):
+    """ Rebuild named arrays from flat Stan names such as ``mean_x1.1.2`` and their values.
+
+    ``values`` has the flat parameters along its last axis, and any leading axes, such
+    as one per draw, are kept in front of each parameter's own shape.
+    """
+    values = np.asarray(values)
+    groups = OrderedDict()
+    for i, name in enumerate(names):
+        parts = name.split(".")
+        groups.setdefault(parts[0], []).append((i, tuple(int(p) - 1 for p in parts[1:])))
+    result = OrderedDict()
+    for name, entries in groups.items():
+        columns = [e[0] for e in entries]
+        indexes = [e[1] for e in entries]
+        if not indexes[0]:
+            result[name] = values[..., columns[0]]
+            continue
+        shape = tuple(max(index[k] for index in indexes) + 1 for k in range(len(indexes[0])))
+        array = np.zeros(values.shape[:-1] + shape)
+        array[(Ellipsis,) + tuple(np.array(indexes).T)] = values[..., columns]
+        result[name] = array
+    return result
+
+
+def constrain(fit, unconstrained):
+    """ Constrained parameter dictionaries for each row of unconstrained vectors, stacked along the first axis. """
+    unconstrained = np.atleast_2d(unconstrained)
+    flat = np.array([fit.constrain_pars(np.ascontiguousarray(u, dtype=np.float64)) for u in unconstrained])
+    return unflatten(fit.constrained_param_names(), flat)
+
+
+def jitter_inits(fit, pars, num_chains, scale=0.1, seed=0):
+    """ Starting points scattered around ``pars``, jittered in the unconstrained space to respect the bounds. """
+    centre = np.array(fit.unconstrain_pars(pars))
+    draws = centre + scale * np.random.RandomState(seed).normal(size=(num_chains, centre.size))
+    constrained = constrain(fit, draws)
+    return [{k: v[i] for k, v in constrained.items()} for i in range(num_chains)]
+
+
+def get_divergences(fit):
+    """ The number of divergent transitions after warmup, over all chains. """
+    return int(sum([np.sum(p["divergent__"]) for p in fit.get_sampler_params(inc_warmup=False)]))
+
+
+def get_hessian(fit, unconstrained, step=1e-4):
+    """ Hessian of the log density in the unconstrained space, from central differences of its gradient. """
+    unconstrained = np.asarray(unconstrained, dtype=np.float64)
+    hessian = np.empty((unconstrained.size, unconstrained.size))
+    for i in range(unconstrained.size):
+        delta = np.zeros(unconstrained.size)
+        delta[i] = step
+        upper = np.array(fit.grad_log_prob(unconstrained + delta, adjust_transform=True))
+        lower = np.array(fit.grad_log_prob(unconstrained - delta, adjust_transform=True))
+        hessian[i] = (upper - lower) / (2 * step)
+    return 0.5 * (hessian + hessian.T)
+
+
+def get_laplace(fit, pars, max_steps=10, tolerance=1e-6):
+    """ Mean and covariance of the Laplace approximation to the posterior, in the unconstrained space.
+
+    Stan's optimiser finds the mode of the density without the Jacobian of the
+    constraining transforms, so ``pars`` is refined with damped Newton steps on the
+    Jacobian adjusted density before taking the Hessian there.
+    """
+    current = np.array(fit.unconstrain_pars(pars))
+    log_prob = fit.log_prob(current, adjust_transform=True)
+    hessian = get_hessian(fit, current)
+    for i in range(max_steps):
+        step = np.linalg.solve(hessian, np.array(fit.grad_log_prob(current, adjust_transform=True)))
+        scale = 1.0
+        while scale > 1e-4:
+            proposal = current - scale * step
+            proposal_log_prob = fit.log_prob(proposal, adjust_transform=True)
+            if proposal_log_prob >= log_prob:
+                break
+            scale *= 0.5
+        else:
+            break
+        current, log_prob = proposal, proposal_log_prob
+        hessian = get_hessian(fit, current)
+        if np.max(np.abs(scale * step)) < tolerance:
+            break
+    logging.info("Laplace mode has log density %0.2f after %d Newton steps" % (log_prob, i + 1))
+    precision = -hessian
+    # Fails if the mode is not a maximum, in which case the approximation is meaningless
+    chol = np.linalg.cholesky(precision)
+    identity = np.eye(precision.shape[0])
+    covariance = np.linalg.solve(chol.T, np.linalg.solve(chol, identity))
+    return current, covariance
+
+
+def get_laplace_draws(fit, pars, num_draws, seed=0):
+    """ Draws from the Laplace approximation around ``pars``, as constrained parameter arrays. """
+    mean, covariance = get_laplace(fit, pars)
+    draws = np.random.RandomState(seed).multivariate_normal(mean, covariance, size=num_draws)
+    return constrain(fit, draws)
+
+
+def read_stan_csv(filename, select=None):
+    """ The column names and rows of a Stan CSV output file, skipping comments.
+
+    The file is read a line at a time, and with ``select``, a function taking the list of
+    parameter names and returning those wanted, only the columns of those parameters and
+    of the sampler diagnostics ending in ``__`` are kept in memory.
+    """
+    names, columns, rows = None, None, []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if names is None:
+                names = line.split(",")
+                columns = list(range(len(names)))
+                if select is not None:
+                    wanted = set(select(list(OrderedDict.fromkeys([n.split(".")[0] for n in names]))))
+                    columns = [i for i, n in enumerate(names) if n.endswith("__") or n.split(".")[0] in wanted]
+                    names = [names[i] for i in columns]
+            else:
+                values = line.split(",")
+                rows.append([float(values[i]) for i in columns])
+    return names, np.array(rows).reshape((-1, len(names)))
+
+
+def split_stan_csv(names, rows):
+    """ Separate the sampler diagnostic columns ending in ``__`` from the parameters, unflattening the latter. """
+    diagnostics = OrderedDict([(n, rows[:, i]) for i, n in enumerate(names) if n.endswith("__")])
+    columns = [i for i, n in enumerate(names) if not n.endswith("__")]
+    return unflatten([names[i] for i in columns], rows[:, columns]), diagnostics
+
+
+def read_variational(sample_file, diagnostic_file):
+    """ Draws and the ELBO trace from Stan's ADVI output files, which are removed afterwards. """
+    names, rows = read_stan_csv(sample_file)
+    # The first row holds the mean of the approximation rather than a draw
+    draws, _ = split_stan_csv(names, rows[1:])
+    trace_names, trace = read_stan_csv(diagnostic_file)
+    elbo = OrderedDict([(n, trace[:, i].tolist()) for i, n in enumerate(trace_names)])
+    for f in [sample_file, diagnostic_file]:
+        os.remove(f)
+    return draws, elbo
+
+
+def run_variational(stan_model, data, init, output_prefix, algorithm="meanfield", num_draws=1000, iter=10000, seed=0):
+    """ Fit a mean-field or full-rank Gaussian with Stan's ADVI and draw from it.
+
+    Stan writes the draws and the ELBO trace to CSV files starting with ``output_prefix``,
+    which are read back and removed.
+
+    Returns
+    -------
+    draws : dict
+        The constrained parameter arrays, with one row per draw.
+    diagnostics : dict
+        The algorithm, the run time in seconds, and the ELBO trace with one list per
+        column of Stan's diagnostic output.
+    """
+    sample_file = output_prefix + "_samples.csv"
+    diagnostic_file = output_prefix + "_diagnostics.csv"
+    start = time.time()
+    stan_model.vb(data=data, init=lambda: init, algorithm=algorithm, output_samples=num_draws, iter=iter, seed=seed,
+                  sample_file=sample_file, diagnostic_file=diagnostic_file)
+    duration = time.time() - start
+    draws, elbo = read_variational(sample_file, diagnostic_file)
+    diagnostics = {"algorithm": algorithm, "duration": duration, "num_draws": num_draws, "elbo": elbo}
+    if "ELBO" in elbo and elbo["ELBO"]:
+        logging.info("%s ADVI finished in %0.1fs with ELBO %0.2f" % (algorithm, duration, elbo["ELBO"][-1]))
+    return draws, diagnostics
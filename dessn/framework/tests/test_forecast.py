@@ -0,0 +1,104 @@
+import numpy as np
+
+from dessn.framework.forecast import get_hessian_blocks, get_latent_index, get_marginal_covariance, \
+    get_uncertainties, refine_latents
+from dessn.framework.stan_helpers import get_hessian
+
+NUM_SNE, DIM = 40, 2
+
+
+class HierarchicalFit(object):
+    """ Stands in for a ``StanFit4Model`` of a small hierarchical model with analytic gradients.
+
+    ``Om`` is logit transformed and ``s`` log transformed, and each supernova has a
+    ``DIM`` dimensional latent deviation drawn around the global ``mu``. As in
+    approximate.stan, the latents are declared between the global parameters, and the
+    constrained names of the latent matrix are column major.
+    """
+    def __init__(self, seed=1):
+        self.y = np.random.RandomState(seed).normal(size=(NUM_SNE, DIM)) * 0.7 + np.array([0.2, -0.1])
+
+    def unconstrained_param_names(self):
+        return ["Om", "mu.1", "mu.2"] + ["deviations.%d.%d" % (i + 1, j + 1)
+                                         for i in range(NUM_SNE) for j in range(DIM)] + ["log_s"]
+
+    def constrained_param_names(self):
+        return ["Om", "mu.1", "mu.2"] + ["deviations.%d.%d" % (i + 1, j + 1)
+                                         for j in range(DIM) for i in range(NUM_SNE)] + ["log_s"]
+
+    def split(self, u):
+        return u[0], u[1:3], u[3:3 + NUM_SNE * DIM].reshape((NUM_SNE, DIM)), u[-1]
+
+    def grad_log_prob(self, u, adjust_transform=True):
+        t, mu, dev, ls = self.split(u)
+        om, s = 1 / (1 + np.exp(-t)), np.exp(ls)
+        dom = om * (1 - om)
+        g_t = (-(om - 0.3) / 0.05 ** 2 + (1 - 2 * om) / dom + np.sum(mu)) * dom
+        g_mu = -mu / 100 + np.sum((dev - mu) / s ** 2, axis=0) + om
+        g_dev = -(dev - mu) / s ** 2 + (self.y - dev) / 0.25
+        g_ls = np.sum(((dev - mu) / s) ** 2) - NUM_SNE * DIM - ls
+        return np.concatenate([[g_t], g_mu, g_dev.flatten(), [g_ls]])
+
+    def constrain_pars(self, u):
+        t, mu, dev, ls = self.split(u)
+        return np.concatenate([[1 / (1 + np.exp(-t))], mu, dev.T.flatten(), [ls]])
+
+
+def get_start():
+    return np.concatenate([[np.log(0.3 / 0.7)], [0.2, -0.1], np.zeros(NUM_SNE * DIM), [np.log(0.7)]])
+
+
+def get_refined():
+    fit = HierarchicalFit()
+    latent_index = get_latent_index(fit, ("deviations",))
+    return fit, refine_latents(fit, get_start(), latent_index), latent_index
+
+
+def test_latent_index_orders_by_supernova_then_dimension():
+    fit = HierarchicalFit()
+    names = fit.unconstrained_param_names()
+    latent_index = get_latent_index(fit, ("deviations",))
+    assert latent_index.shape == (NUM_SNE, DIM)
+    for i in range(NUM_SNE):
+        for j in range(DIM):
+            assert names[latent_index[i, j]] == "deviations.%d.%d" % (i + 1, j + 1)
+    assert get_latent_index(fit, ("missing",)).size == 0
+
+
+def test_refine_latents_reaches_conditional_mode():
+    fit, unconstrained, latent_index = get_refined()
+    assert np.abs(fit.grad_log_prob(unconstrained)[latent_index]).max() < 1e-6
+    # The global parameters are held fixed
+    start = get_start()
+    mask = np.ones(start.size, dtype=bool)
+    mask[latent_index.flatten()] = False
+    assert np.all(unconstrained[mask] == start[mask])
+
+
+def test_hessian_blocks_match_dense_hessian():
+    fit, unconstrained, latent_index = get_refined()
+    global_index = np.array([0, 1, 2, unconstrained.size - 1])
+    globals_block, cross, latent_blocks = get_hessian_blocks(fit, unconstrained, global_index, latent_index)
+    dense = get_hessian(fit, unconstrained)
+    assert np.allclose(globals_block, dense[np.ix_(global_index, global_index)], atol=1e-5)
+    assert np.allclose(cross, dense[global_index][:, latent_index], atol=1e-5)
+    for i in range(NUM_SNE):
+        assert np.allclose(latent_blocks[i], dense[np.ix_(latent_index[i], latent_index[i])], atol=1e-5)
+
+
+def test_marginal_covariance_matches_dense_inverse():
+    fit, unconstrained, latent_index = get_refined()
+    covariance, global_index = get_marginal_covariance(fit, unconstrained, latent_index)
+    assert list(global_index) == [0, 1, 2, unconstrained.size - 1]
+    dense = np.linalg.inv(-get_hessian(fit, unconstrained))[np.ix_(global_index, global_index)]
+    assert np.max(np.abs(covariance - dense)) < 1e-6 * np.abs(dense).max()
+
+
+def test_uncertainties_propagate_through_transforms():
+    fit, unconstrained, latent_index = get_refined()
+    covariance, global_index = get_marginal_covariance(fit, unconstrained, latent_index)
+    values, sigmas = get_uncertainties(fit, unconstrained, covariance, global_index)
+    om = values["Om"]
+    assert np.isclose(sigmas["Om"], np.sqrt(covariance[0, 0]) * om * (1 - om), rtol=1e-6)
+    assert np.allclose(sigmas["mu"], np.sqrt(np.diag(covariance))[1:3], rtol=1e-6)
+    assert sigmas["deviations"].shape == (NUM_SNE, DIM) and np.all(sigmas["deviations"] == 0)
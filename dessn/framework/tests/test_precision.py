@@ -0,0 +1,81 @@
+import numpy as np
+from astropy.cosmology import FlatwCDM
+
+from dessn.framework.model import Model
+from dessn.framework.precision import STORAGE_TYPE, check_rounding_fit, get_rounding_bound, round_to_storage
+
+
+class LinearModel(Model):
+    """ Observed mB, x1 and c are a distance modulus plus a constant offset each, shifted by the
+    calibration, so the posterior of the offsets and calibration is an exact Gaussian. """
+    def __init__(self, num_sne=1000, num_calib=4, sigma_scale=1.0):
+        super().__init__("linear.stan")
+        self.num_sne = num_sne
+        self.num_calib = num_calib
+        self.sigma_scale = sigma_scale
+
+    def get_data(self, simulation, cosmology_index):
+        random = np.random.RandomState(cosmology_index)
+        n = self.num_sne
+        redshifts = random.uniform(0.05, 1.0, n)
+        sigmas = self.sigma_scale * np.array([0.04, 0.2, 0.03]) * random.uniform(0.5, 2.0, (n, 3))
+        correlation = np.array([[1.0, 0.3, -0.6], [0.3, 1.0, -0.2], [-0.6, -0.2, 1.0]])
+        cov = sigmas[:, :, None] * sigmas[:, None, :] * correlation
+        deta_dcalib = random.normal(scale=0.01, size=(n, 3, self.num_calib))
+        truth = np.array([-19.365, 0.1, -0.02])
+        mean = truth + deta_dcalib @ random.normal(size=self.num_calib)
+        mean[:, 0] += get_distmod(redshifts)
+        obs = mean + np.einsum("nij,nj->ni", np.linalg.cholesky(cov), random.normal(size=(n, 3)))
+        return {"n_sne": n, "redshifts": redshifts, "obs_mBx1c": obs, "obs_mBx1c_cov": cov,
+                "deta_dcalib": deta_dcalib}
+
+    def get_init(self, **kwargs):
+        return {"offsets": np.zeros(3), "calibration": np.zeros(self.num_calib)}
+
+    def get_name(self):
+        return "Linear"
+
+    def get_parameters(self):
+        return ["offsets", "calibration"]
+
+    def get_labels(self):
+        return {}
+
+    def get_cosmo_params(self):
+        return []
+
+
+class GaussianEngine(object):
+    """ Exact posterior draws of :class:`LinearModel`, with the calibration's unit normal prior. """
+    def laplace(self, data, init, num_draws, output_prefix, seed=0):
+        n, num_calib = data["n_sne"], data["deta_dcalib"].shape[2]
+        design = np.concatenate((np.repeat(np.eye(3)[None], n, axis=0), data["deta_dcalib"]), axis=2)
+        residual = np.array(data["obs_mBx1c"])
+        residual[:, 0] -= get_distmod(data["redshifts"])
+        weighted = np.linalg.solve(data["obs_mBx1c_cov"], design)
+        precision = np.einsum("nki,nkj->ij", design, weighted)
+        precision[3:, 3:] += np.eye(num_calib)
+        cov = np.linalg.inv(precision)
+        mean = cov @ np.einsum("nki,nk->i", weighted, residual)
+        draws = np.random.RandomState(seed).multivariate_normal(mean, cov, size=num_draws)
+        return {"offsets": draws[:, :3], "calibration": draws[:, 3:]}
+
+
+def get_distmod(redshifts):
+    return FlatwCDM(70.0, 0.3).distmod(redshifts).value
+
+
+def test_round_to_storage_only_rounds_floats():
+    data = {"a": np.array([1 / 3]), "b": np.arange(3), "c": 0.1}
+    rounded = round_to_storage(data)
+    assert rounded["a"].dtype == np.float64
+    assert rounded["a"][0] == np.float64(STORAGE_TYPE(1 / 3))
+    assert rounded["b"] is data["b"] and rounded["c"] == 0.1
+
+
+def test_bound_covers_measured_shift(tmp_path):
+    for sigma_scale in [1.0, 0.01]:
+        model = LinearModel(sigma_scale=sigma_scale)
+        shift, bound = check_rounding_fit(model, None, engine=GaussianEngine(), output_prefix=str(tmp_path / "p"))
+        assert 0 < shift <= bound
+        assert bound == get_rounding_bound(model.get_data(None, 0))
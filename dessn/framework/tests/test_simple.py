@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from dessn.framework.simulations.simple import SimpleSimulation
+
+# Statistics of the original object by object generator, over seeds 0, 1 and 2 with 2000
+# passed supernovae each: the pass fraction, then the mean and standard deviation of the
+# observed mB, x1 and c of the passed supernovae.
+BASELINE = {
+    False: (0.1308, [22.8212, 0.1579, 0.0514], [0.7067, 0.9986, 0.0849]),
+    True: (0.0439, [16.4427, 0.1746, 0.0506], [0.7780, 1.0185, 0.0776]),
+}
+NUM_SNE = 2000
+SEEDS = [0, 1, 2]
+
+
+def get_statistics(**kwargs):
+    passed, generated, observed = 0, 0, []
+    for seed in SEEDS:
+        result = SimpleSimulation(NUM_SNE, **kwargs).get_all_supernova(NUM_SNE, cosmology_index=seed)
+        passed += result["passed"].sum()
+        generated += result["passed"].size
+        observed.append(result["obs_mBx1c"][result["passed"]])
+    return passed / generated, generated, np.concatenate(observed)
+
+
+@pytest.mark.parametrize("lowz", [False, True])
+def test_matches_baseline_generator(lowz):
+    fraction, generated, observed = get_statistics(lowz=lowz)
+    base_fraction, base_means, base_stds = BASELINE[lowz]
+    n = observed.shape[0]
+    # Four sigma for the difference of two independent estimates of the same size
+    tolerance = 4 * np.sqrt(2)
+    assert np.abs(fraction - base_fraction) < tolerance * np.sqrt(base_fraction * (1 - base_fraction) / generated)
+    assert np.all(np.abs(observed.mean(axis=0) - base_means) < tolerance * np.array(base_stds) / np.sqrt(n))
+    assert np.all(np.abs(observed.std(axis=0) - base_stds) < tolerance * np.array(base_stds) / np.sqrt(2 * n))
+
+
+def test_analytic_selection_lowers_lowz_efficiency():
+    fraction, generated, _ = get_statistics(lowz=True, analytic_selection=True)
+    assert fraction < 0.8 * BASELINE[True][0]
+
+
+def test_sims_are_observed_values_unless_latent():
+    observed = SimpleSimulation(100).get_all_supernova(100)
+    assert np.all(observed["sim_apparents"] == observed["obs_mBx1c"][:, 0])
+    assert np.all(observed["sim_colours"] == observed["obs_mBx1c"][:, 2])
+    latent = SimpleSimulation(100, latent_sims=True).get_all_supernova(100)
+    assert np.all(latent["obs_mBx1c"] == observed["obs_mBx1c"])
+    assert not np.any(latent["sim_apparents"] == latent["obs_mBx1c"][:, 0])
@@ -4,6 +4,7 @@ Created on Thu Sep 15 12:42:49 2016
 
 @author: shint1
 """
+import argparse
 import numpy as np
 import pandas as pd
 import os
@@ -11,38 +12,90 @@ import pickle
 import inspect
 import re
 import fnmatch
+import shutil
 import hashlib
 import logging
+import time
+import traceback
+from multiprocessing import Pool
 
 from scipy.stats import norm
 from scipy.stats import binned_statistic
 from dessn.snana.systematic_names import get_systematic_mapping
+from dessn.framework.simulations.archive import build_archive, get_realisations as get_archived_realisations
+from dessn.framework.simulations.records import from_legacy, save_format
+from dessn.utility.covariance import cholesky_batch, describe_failures
 
+# Increment when a change to the converter alters its output, so existing outputs are redone
+CONVERTER_VERSION = 1
+MANIFEST_NAME = "manifest.pkl"
 
-def load_fitres(filename, skiprows=6):
-    # logging.debug("Loading %s" % filename)
-    if filename.endswith(".gz"):
-        compression = "gzip"
-    else:
-        compression = None
+
+FITRES_COLUMNS = ['CID', 'IDSURVEY', 'zHD', 'HOST_LOGMASS', 'HOST_LOGMASS_ERR', 'x1',
+                  'x1ERR', 'c', 'cERR', 'mB', 'mBERR', 'x0', 'x0ERR',
+                  'COV_x1_c', 'COV_x1_x0', 'COV_c_x0', 'SIM_mB', 'SIM_x1', 'SIM_c',
+                  'biasCor_mB', 'biasCor_x1', 'biasCor_c']
+FITRES_CACHE_VERSION = 1
+
+
+def get_fitres_cache_key(filename, skiprows):
+    stat = os.stat(filename)
+    return "%d|%d|%d|%d" % (FITRES_CACHE_VERSION, stat.st_size, stat.st_mtime_ns, skiprows)
+
+
+def parse_fitres(filename, skiprows=6):
+    """ Parse the FITRES_COLUMNS present in the file into a dictionary of column arrays. """
+    compression = "gzip" if filename.endswith(".gz") else None
+    dtypes = {c: np.float64 for c in FITRES_COLUMNS if c not in ["CID", "IDSURVEY"]}
+    kwargs = {"sep": '\s+', "compression": compression, "skiprows": skiprows, "comment": "#",
+              "usecols": lambda c: c in FITRES_COLUMNS}
     try:
-        dataframe = pd.read_csv(filename, sep='\s+', compression=compression, skiprows=skiprows, comment="#")
+        dataframe = pd.read_csv(filename, dtype=dtypes, **kwargs)
     except ValueError:
-        logging.error("Filename %s failed to load" % filename)
-        return None
-    columns = ['CID', 'IDSURVEY', 'zHD', 'HOST_LOGMASS', 'HOST_LOGMASS_ERR', 'x1',
-               'x1ERR', 'c', 'cERR', 'mB', 'mBERR', 'x0', 'x0ERR',
-               'COV_x1_c', 'COV_x1_x0', 'COV_c_x0', 'SIM_mB', 'SIM_x1', 'SIM_c',
-               'biasCor_mB', 'biasCor_x1', 'biasCor_c']
-    final_columns = [c for c in columns if c in dataframe.columns]
-    data = dataframe[final_columns].to_records()
-    return data
-
-
-def is_pos_def(x):
-    if not np.all(np.isfinite(x)):
-        return False
-    return np.all(np.linalg.eigvals(x) > 0)
+        # Non-numeric values in a float column, fall back to letting pandas infer types
+        dataframe = pd.read_csv(filename, **kwargs)
+    columns = {c: dataframe[c].to_numpy() for c in FITRES_COLUMNS if c in dataframe.columns}
+    for c in columns:
+        if columns[c].dtype == object:
+            columns[c] = columns[c].astype(str)
+    return columns
+
+
+def load_fitres(filename, skiprows=6, columns=None, cache=True):
+    """ Load a FITRES file as records with the requested columns, defaulting to all of FITRES_COLUMNS.
+
+    The parsed columns are saved to a ``.npz`` alongside the FITRES, keyed by its size and
+    modification time, so later loads of an unchanged file skip the text parsing.
+    """
+    cache_file = filename + ".npz"
+    key = get_fitres_cache_key(filename, skiprows)
+    data = None
+    if cache and os.path.exists(cache_file):
+        try:
+            with np.load(cache_file) as f:
+                if str(f["_key"]) == key:
+                    data = {k: f[k] for k in f.files if k != "_key"}
+        except Exception as e:
+            logging.warning("Could not read FITRES cache %s: %s" % (cache_file, e))
+    if data is None:
+        try:
+            data = parse_fitres(filename, skiprows=skiprows)
+        except ValueError:
+            logging.error("Filename %s failed to load" % filename)
+            return None
+        if cache:
+            try:
+                temp = "%s.%d.tmp.npz" % (filename, os.getpid())
+                np.savez(temp, _key=np.array(key), **data)
+                os.replace(temp, cache_file)
+            except OSError as e:
+                logging.warning("Could not write FITRES cache %s: %s" % (cache_file, e))
+
+    if columns is None:
+        columns = FITRES_COLUMNS
+    final_columns = [c for c in columns if c in data]
+    n = data[final_columns[0]].size if final_columns else 0
+    return np.rec.fromarrays([np.arange(n)] + [data[c] for c in final_columns], names=["index"] + final_columns)
 
 
 def get_scaling():
@@ -112,210 +165,310 @@ def get_realisations(base_folder, dump_dir):
     return sim_dirs
 
 
-def load_dump_file(sim_dir):
-    filename = "SIMGEN.DAT.gz" if os.path.exists(sim_dir + "/SIMGEN.DAT.gz") else "SIMGEN.DAT"
-    compression = "gzip" if filename.endswith("gz") else None
-    names = ["SN", "CID", "S2mb", "MAGSMEAR_COH", "S2c", "S2x1", "Z"]
-    keep = ["CID", "S2mb", "MAGSMEAR_COH", "S2c", "Z"]
-    dtypes = [int, float, float, float, float]
-    dataframe = pd.read_csv(sim_dir + "/" + filename, compression=compression, sep='\s+',
-                            skiprows=1, comment="V", error_bad_lines=False, names=names)
-    logging.info("Loaded dump file from %s" % (sim_dir + "/" + filename))
-    data = dataframe.to_records()
-    res = []
-    for row in data:
-        try:
-            r = [d(row[k]) for k, d in zip(keep, dtypes)]
-            res.append(tuple(r))
-        except Exception:
-            pass
-    data = np.array(res, dtype=[('CID', np.int32), ('S2mb', np.float64), ('MAGSMEAR_COH', np.float64),
-                                ("S2c", np.float64), ("Z", np.float64)])
-    good_mask = (data["S2mb"] > 10) & (data["S2mb"] < 30)
-    data = data[good_mask]
-    return data
+def get_dump_filename(sim_dir):
+    return "SIMGEN.DAT.gz" if os.path.exists(sim_dir + "/SIMGEN.DAT.gz") else "SIMGEN.DAT"
 
 
-def digest_simulation(sim_dir, systematics_scales, output_dir, systematic_labels, load_dump=False, skip=6, biascor=None, zipped=True):
+DUMP_NAMES = ["SN", "CID", "S2mb", "MAGSMEAR_COH", "S2c", "S2x1", "Z"]
+# Lines with more fields than DUMP_NAMES are malformed. Chunked parsing does not reliably skip
+# them, so they are read into these overflow columns and dropped explicitly.
+DUMP_OVERFLOW = ["OVERFLOW%d" % i for i in range(4)]
+DUMP_DTYPE = [('CID', np.int32), ('S2mb', np.float64), ('MAGSMEAR_COH', np.float64), ("S2c", np.float64), ("Z", np.float64)]
 
-    max_offset_mB = 0.2
+
+def iterate_dump_file(sim_dir, chunk_size=1000000):
+    """ Yield the valid rows of the SIMGEN dump as structured arrays, chunk_size lines at a time.
+
+    Rows with a missing or non-integer CID, or a non-numeric value in any kept column,
+    are dropped, as are rows without a sensible S2mb.
+    """
+    filename = get_dump_filename(sim_dir)
+    compression = "gzip" if filename.endswith("gz") else None
+    reader = pd.read_csv(sim_dir + "/" + filename, compression=compression, sep='\s+', skiprows=1, comment="V",
+                         on_bad_lines="skip", names=DUMP_NAMES + DUMP_OVERFLOW, chunksize=chunk_size)
+    logging.info("Streaming dump file from %s" % (sim_dir + "/" + filename))
+    for dataframe in reader:
+        data = np.empty(dataframe.shape[0], dtype=DUMP_DTYPE)
+        valid = np.array(dataframe[DUMP_OVERFLOW].isna().all(axis=1), dtype=bool)
+        for name in data.dtype.names:
+            raw = dataframe[name]
+            values = np.array(pd.to_numeric(raw, errors="coerce"), dtype=np.float64)
+            valid &= ~(np.isnan(values) & raw.notna().to_numpy())
+            if name == "CID":
+                valid &= np.isfinite(values)
+                values[~valid] = 0
+            data[name] = values
+        data = data[valid]
+        yield data[(data["S2mb"] > 10) & (data["S2mb"] < 30)]
+
+
+def load_dump_file(sim_dir, chunk_size=1000000):
+    return np.concatenate(list(iterate_dump_file(sim_dir, chunk_size=chunk_size)))
+
+
+def write_all_file(sim_dir, filename, passed_cids, chunk_size=1000000, max_rows=7000000):
+    """ Write mB + 100 * passed and z for every dumped object to filename, at most max_rows of them.
+
+    Rows are streamed into a raw temporary file and the npy header is written once the final
+    row count is known, so memory use is bounded by the chunk size.
+    """
+    passed_cids = np.array([c for c in passed_cids if not isinstance(c, str)], dtype=np.int64)
+    raw_file = "%s.%d.raw" % (filename, os.getpid())
+    num_rows, num_nan = 0, 0
+    with open(raw_file, "wb") as raw:
+        for supernovae in iterate_dump_file(sim_dir, chunk_size=chunk_size):
+            all_mags = supernovae["S2mb"] + supernovae["MAGSMEAR_COH"]
+            supernovae_passed = np.isin(supernovae["CID"], passed_cids)
+            mask_nan = ~np.isnan(all_mags)
+            num_nan += (~mask_nan).sum()
+            all_data = np.vstack((all_mags[mask_nan] + 100 * supernovae_passed[mask_nan], supernovae["Z"][mask_nan])).T
+            all_data = all_data[:max(0, max_rows - num_rows)]
+            num_rows += all_data.shape[0]
+            raw.write(all_data.astype(np.float32).tobytes())
+
+    temp = "%s.%d.tmp" % (filename, os.getpid())
+    with open(temp, "wb") as f:
+        np.lib.format.write_array_header_1_0(f, {"descr": "<f4", "fortran_order": False, "shape": (num_rows, 2)})
+        with open(raw_file, "rb") as raw:
+            shutil.copyfileobj(raw, f)
+    os.replace(temp, filename)
+    os.remove(raw_file)
+    logging.info("Wrote %d dumped objects to %s" % (num_rows, filename))
+    logging.info("%d nans in apparents. Probably correspond to num sims." % num_nan)
+
+
+def get_realisation_index(sim_dir):
     ind = 0
     if "-0" in sim_dir:
         ind = int(sim_dir.split("-0")[-1]) - 1
+    return ind
+
+
+def get_bias_fitres_file(sim_dir, biascor):
+    short_name = os.path.basename(sim_dir).replace("DES3YR", "").replace("_DES_", "").replace("_LOWZ_", "")
+    bias_loc = os.path.dirname(os.path.dirname(sim_dir)) + os.sep + biascor + os.sep + short_name
+    return bias_loc + os.sep + "SALT2mu_FITOPT000_MUOPT000.FITRES"
+
+
+def get_fitres_files(sim_dir, zipped=True):
+    ending = ".FITRES.gz" if zipped else ".FITRES"
+    return sorted([sim_dir + "/" + i for i in os.listdir(sim_dir) if i.endswith(ending)])
+
+
+def get_input_files(sim_dir, load_dump=False, biascor=None, zipped=True):
+    """ Every file digest_simulation reads for a realisation. """
+    files = get_fitres_files(sim_dir, zipped=zipped)
+    if biascor is not None:
+        files.append(get_bias_fitres_file(sim_dir, biascor))
+    if load_dump:
+        files.append(sim_dir + "/" + get_dump_filename(sim_dir))
+    return files
+
+
+def describe_files(files):
+    """ The path, size and modification time of each file, or None for missing files. """
+    results = []
+    for f in files:
+        if not os.path.exists(f):
+            results.append((os.path.abspath(f), None, None))
+        else:
+            stat = os.stat(f)
+            results.append((os.path.abspath(f), stat.st_size, stat.st_mtime_ns))
+    return results
+
+
+def load_manifest(output_dir):
+    filename = output_dir + "/" + MANIFEST_NAME
+    if not os.path.exists(filename):
+        return {}
+    try:
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+    except Exception as e:
+        logging.warning("Could not read manifest %s, treating all realisations as stale: %s" % (filename, e))
+        return {}
+
+
+def save_manifest(output_dir, manifest):
+    filename = output_dir + "/" + MANIFEST_NAME
+    temp = "%s.%d.tmp" % (filename, os.getpid())
+    with open(temp, "wb") as f:
+        pickle.dump(manifest, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp, filename)
+
+
+def is_up_to_date(output_dir, manifest, ind, entry, load_dump=False):
+    """ Whether the realisation was last digested from identical inputs and settings, and its outputs exist. """
+    if manifest.get(ind) != entry:
+        return False
+    if ind not in get_archived_realisations(output_dir):
+        return False
+    return not load_dump or os.path.exists(output_dir + "/all_%s.npy" % ind)
+
+
+def get_saved_labels(systematics_scales, systematic_labels):
+    """ The labels of the systematics that are kept, those with a non-zero scale. """
+    return [s for sc, s in zip(systematics_scales, systematic_labels) if sc != 0]
+
+
+def save_labels(output_dir, systematic_labels_save):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+    with open(output_dir + "/sys_names.pkl", 'wb') as f:
+        pickle.dump(systematic_labels_save, f, protocol=pickle.HIGHEST_PROTOCOL)
+    save_format(output_dir)
+
+
+def digest_simulation(sim_dir, systematics_scales, output_dir, systematic_labels, load_dump=False, skip=6, biascor=None,
+                      zipped=True, save_names=True):
+
+    max_offset_mB = 0.2
+    ind = get_realisation_index(sim_dir)
     logging.info("Digesting index %d in folder %s" % (ind, sim_dir))
 
     bias_fitres = None
     if biascor is not None:
         logging.info("Biascor is %s" % biascor)
-        short_name = os.path.basename(sim_dir).replace("DES3YR", "").replace("_DES_", "").replace("_LOWZ_", "")
-        bias_loc = os.path.dirname(os.path.dirname(sim_dir)) + os.sep + biascor + os.sep + short_name
-        bias_fitres_file = bias_loc + os.sep + "SALT2mu_FITOPT000_MUOPT000.FITRES"
+        bias_fitres_file = get_bias_fitres_file(sim_dir, biascor)
         assert os.path.exists(bias_fitres_file)
-        fres = load_fitres(bias_fitres_file, skiprows=5)
+        fres = load_fitres(bias_fitres_file, skiprows=5, columns=["CID", "IDSURVEY", "biasCor_mB", "biasCor_x1", "biasCor_c"])
         bias_fitres = {"%s_%s" % (row["IDSURVEY"], row["CID"]): [row['biasCor_mB'], row['biasCor_x1'], row['biasCor_c']] for row in fres}
 
-    inner_files = sorted(list(os.listdir(sim_dir)))
-    ending = ".FITRES.gz" if zipped else ".FITRES"
-    fitres_files = sorted([sim_dir + "/" + i for i in inner_files if i.endswith(ending)])
+    fitres_files = get_fitres_files(sim_dir, zipped=zipped)
     base_fitres = fitres_files[0]
     sysematics_fitres = fitres_files[1:]
     logging.info("Have %d fitres files for systematics" % len(sysematics_fitres))
 
     base_fits = load_fitres(base_fitres, skiprows=skip)
-    sysematics = [load_fitres(m, skiprows=skip) for m in sysematics_fitres]
+    sysematics = [load_fitres(m, skiprows=skip, columns=["CID", "mB", "x1", "c"]) for m in sysematics_fitres]
 
     sysematics_sort_indexes = [None if m is None else np.argsort(m['CID']) for m in sysematics]
     sysematics_idss = [None if m is None else m['CID'][s] for m, s in zip(sysematics, sysematics_sort_indexes)]
-    systematic_labels_save = [s for sc, s in zip(systematics_scales, systematic_labels) if sc != 0]
+    systematic_labels_save = get_saved_labels(systematics_scales, systematic_labels)
     num_bad_calib = 0
     num_bad_calib_index = np.zeros(len(systematic_labels_save))
     logging.debug("Have %d, %d, %d, %d systematics" %
                   (len(sysematics), len(sysematics_sort_indexes), len(sysematics_idss), len(systematics_scales)))
 
-    final_results = []
-    passed_cids = []
-    all_offsets = []
     logging.debug("Have %d rows to process" % base_fits.shape)
+    n = base_fits.shape[0]
+    cids = base_fits['CID']
+    mask = np.ones(n, dtype=bool)
+
+    if bias_fitres is None:
+        not_found = n
+        biases = np.zeros((n, 3))
+    else:
+        keys = ["%s_%s" % (s, c) for s, c in zip(base_fits['IDSURVEY'], cids)]
+        found = np.array([k in bias_fitres for k in keys], dtype=bool)
+        not_found = n - found.sum()
+        biases = np.array([bias_fitres.get(k, [0, 0, 0]) for k in keys], dtype=np.float64).reshape((n, 3))
+        mask &= found
+
+    z = base_fits['zHD']
+    mb = base_fits['mB']
+    x0 = base_fits['x0']
+    x1 = base_fits['x1']
+    c = base_fits['c']
+
+    mass = base_fits['HOST_LOGMASS']
+    mass_err = np.where(base_fits['HOST_LOGMASS_ERR'] < 0.01, 0.01, base_fits['HOST_LOGMASS_ERR'])
+    mass_prob = np.where(mass < 0, 0, 1 - norm.cdf(10, mass, mass_err))
     mass_mean = np.mean(base_fits["HOST_LOGMASS_ERR"])
-    not_found = 0
-    fake_mass = False
     if mass_mean == -9 or mass_mean == 0:
         logging.warning("Mass is fake")
-        fake_mass = True
-    for i, row in enumerate(base_fits):
-        if i % 1000 == 0 and i > 0:
-            logging.debug("Up to row %d" % i)
-        cid = row['CID']
-        survey_id = row['IDSURVEY']
-
-        key = "%s_%s" % (survey_id, cid)
-        if bias_fitres is None:
-            not_found += 1
-            bias_mB, bias_x1, bias_c = 0, 0, 0
-        else:
-            if key not in bias_fitres:
-                not_found += 1
-                continue
-            else:
-                bias_mB, bias_x1, bias_c = bias_fitres[key]
-
-        z = row['zHD']
-
-        mb = row['mB']
-        x0 = row['x0']
-        x1 = row['x1']
-        c = row['c']
-
-        mass = row['HOST_LOGMASS']
-        mass_err = row['HOST_LOGMASS_ERR']
-        if mass < 0:
-            mass_prob = 0
-        else:
-            if mass_err < 0.01:
-                mass_err = 0.01
-            mass_prob = 1 - norm.cdf(10, mass, mass_err)
-        if fake_mass:
-            mass_prob = 0
-        mbe = row["mBERR"]
-        x1e = row["x1ERR"]
-        ce = row["cERR"]
-
-        if "SIM_mB" not in row.dtype.names:
-            sim_mb = 0
-            sim_x1 = 0
-            sim_c = 0
-        else:
-            sim_mb = row["SIM_mB"]
-            sim_x1 = row["SIM_x1"]
-            sim_c = row["SIM_c"]
-
-        cov_x1_c = row["COV_x1_c"]
-        cov_x0_c = row["COV_c_x0"]
-        cov_x1_x0 = row["COV_x1_x0"]
+        mass_prob = np.zeros(n)
 
-        cmbx1 = -5 * cov_x1_x0 / (2 * x0 * np.log(10))
-        cmbc = -5 * cov_x0_c / (2 * x0 * np.log(10))
-
-        cov = np.array([[mbe * mbe, cmbx1, cmbc], [cmbx1, x1e * x1e, cov_x1_c], [cmbc, cov_x1_c, ce * ce]])
-
-        if not is_pos_def(cov):
-            continue
-
-        offset_mb = []
-        offset_x1 = []
-        offset_c = []
-        for mag, sorted_indexes, magcids, scale in \
-                zip(sysematics, sysematics_sort_indexes, sysematics_idss, systematics_scales):
-            if scale == 0:
-                continue
-            if mag is None:
-                offset_mb.append(0.0)
-                offset_x1.append(0.0)
-                offset_c.append(0.0)
-                continue
-            index = np.searchsorted(magcids, cid)
-            if index >= magcids.size or magcids[index] != cid:
-                offset_mb.append(0.0)
-                offset_x1.append(0.0)
-                offset_c.append(0.0)
-            else:
-                offset_mb.append((mag['mB'][sorted_indexes[index]] - mb) * scale)
-                offset_x1.append((mag['x1'][sorted_indexes[index]] - x1) * scale)
-                offset_c.append((mag['c'][sorted_indexes[index]] - c) * scale)
-        if len(offset_mb) == 0:
-            offset_mb.append(0.0)
-            offset_x1.append(0.0)
-            offset_c.append(0.0)
-
-        if np.any(np.isnan(offset_mb)) or np.any(np.abs(offset_mb) > max_offset_mB):
-            num_bad_calib += 1
-            num_bad_calib_index += np.isnan(offset_mb)
+    if "SIM_mB" not in base_fits.dtype.names:
+        sims = np.zeros((n, 3))
+    else:
+        sims = np.vstack((base_fits["SIM_mB"], base_fits["SIM_x1"], base_fits["SIM_c"])).T
+
+    mbe = base_fits["mBERR"]
+    x1e = base_fits["x1ERR"]
+    ce = base_fits["cERR"]
+    cov_x1_c = base_fits["COV_x1_c"]
+    cmbx1 = -5 * base_fits["COV_x1_x0"] / (2 * x0 * np.log(10))
+    cmbc = -5 * base_fits["COV_c_x0"] / (2 * x0 * np.log(10))
+    covs = np.array([[mbe * mbe, cmbx1, cmbc], [cmbx1, x1e * x1e, cov_x1_c], [cmbc, cov_x1_c, ce * ce]]).transpose((2, 0, 1))
+    # Check the covariances as they will be stored, so the fit can always factorise them
+    _, valid_cov, cov_reasons = cholesky_batch(covs.astype(np.float32))
+    if not valid_cov[mask].all():
+        logging.info("Removing supernovae with bad covariances: %s" % describe_failures(cov_reasons[mask], ids=cids[mask]))
+    mask &= valid_cov
+
+    # Align every systematic table to the base CIDs at once, with zero offsets for missing objects
+    offset_mb, offset_x1, offset_c = [], [], []
+    for mag, sorted_indexes, magcids, scale in zip(sysematics, sysematics_sort_indexes, sysematics_idss, systematics_scales):
+        if scale == 0:
             continue
-        offsets = np.vstack((offset_mb, offset_x1, offset_c))
-        passed_cids.append(cid)
-
-        if isinstance(cid, str):
-            cid = int(hashlib.sha256(cid.encode('utf-8')).hexdigest(), 16) % 10 ** 8
-        all_offsets.append(offsets)
-        final_result = [cid, z, mass_prob, sim_mb, sim_x1, sim_c, mb, x1, c, bias_mB, bias_x1, bias_c] \
-                       + cov.flatten().tolist() + offsets.flatten().tolist()
-        final_results.append(final_result)
+        offsets = np.zeros((3, n))
+        if mag is not None and magcids.size:
+            index = np.searchsorted(magcids, cids)
+            found = index < magcids.size
+            index[~found] = 0
+            found &= magcids[index] == cids
+            rows = sorted_indexes[index[found]]
+            offsets[0, found] = (mag['mB'][rows] - mb[found]) * scale
+            offsets[1, found] = (mag['x1'][rows] - x1[found]) * scale
+            offsets[2, found] = (mag['c'][rows] - c[found]) * scale
+        offset_mb.append(offsets[0])
+        offset_x1.append(offsets[1])
+        offset_c.append(offsets[2])
+    if len(offset_mb) == 0:
+        offset_mb, offset_x1, offset_c = [np.zeros(n)], [np.zeros(n)], [np.zeros(n)]
+    offset_mb, offset_x1, offset_c = np.array(offset_mb).T, np.array(offset_x1).T, np.array(offset_c).T
+
+    nan_calib = np.isnan(offset_mb)
+    bad_calib = mask & (nan_calib.any(axis=1) | (np.abs(offset_mb) > max_offset_mB).any(axis=1))
+    num_bad_calib = bad_calib.sum()
+    num_bad_calib_index = num_bad_calib_index + nan_calib[bad_calib].sum(axis=0)
+    mask &= ~bad_calib
+
+    passed_cids = cids[mask].tolist()
+    final_cids = np.array([int(hashlib.sha256(cid.encode('utf-8')).hexdigest(), 16) % 10 ** 8 if isinstance(cid, str) else cid
+                           for cid in passed_cids], dtype=np.float64)
+    offsets = np.hstack((offset_mb, offset_x1, offset_c))
+    final_results = np.hstack((final_cids[:, None], z[mask, None], mass_prob[mask, None], sims[mask], mb[mask, None],
+                               x1[mask, None], c[mask, None], biases[mask], covs[mask].reshape((-1, 9)), offsets[mask]))
 
     if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+        os.makedirs(output_dir, exist_ok=True)
 
-    fitted_data = np.array(final_results).astype(np.float32)
+    fitted_data = from_legacy(final_results)
 
     np.save("%s/passed_%d.npy" % (output_dir, ind), fitted_data)
     logging.info("Bias not found for %d  out of %d SN (%d found)" % (not_found, base_fits.shape[0], base_fits.shape[0] - not_found))
     logging.info("Calib faliures: %d in total. Breakdown: %s" % (num_bad_calib, num_bad_calib_index))
 
-    # Save the labels out
-    with open(output_dir + "/sys_names.pkl", 'wb') as f:
-        pickle.dump(systematic_labels_save, f, protocol=pickle.HIGHEST_PROTOCOL)
+    if save_names:
+        save_labels(output_dir, systematic_labels_save)
 
     if load_dump:
+        write_all_file(sim_dir, output_dir + "/all_%s.npy" % ind, passed_cids)
 
-        supernovae = load_dump_file(sim_dir)
-        all_mags = supernovae["S2mb"].astype(np.float64) + supernovae["MAGSMEAR_COH"].astype(np.float64)
-        all_zs = supernovae["Z"].astype(np.float64)
-        all_cids = supernovae["CID"].astype(np.int32)
-
-        cids_dict = dict([(c, True) for c in passed_cids])
 
-        supernovae_passed = np.array([c in cids_dict for c in all_cids])
-        mask_nan = ~np.isnan(all_mags)
+def digest_job(args):
+    """ Digest one realisation, returning (sim_dir, error traceback or None, seconds taken). """
+    sim_dir, kwargs = args
+    start = time.time()
+    try:
+        digest_simulation(sim_dir, **kwargs)
+        return sim_dir, None, time.time() - start
+    except Exception:
+        return sim_dir, traceback.format_exc(), time.time() - start
 
-        all_data = np.vstack((all_mags[mask_nan] + 100 * supernovae_passed[mask_nan], all_zs[mask_nan])).T
-        print(all_data.shape)
-        if all_data.shape[0] > 7000000:
-            all_data = all_data[:7000000, :]
-        np.save(output_dir + "/all_%s.npy" % ind, all_data.astype(np.float32))
-        logging.info("%d nans in apparents. Probably correspond to num sims." % (~mask_nan).sum())
 
+def convert(base_folder, load_dump=False, override=False, skip=11, biascor=None, zipped=True, archive=False,
+            num_workers=1, force=False):
+    """ Digest every realisation of a simulation, using a pool of num_workers processes.
 
-def convert(base_folder, load_dump=False, override=False, skip=11, biascor=None, zipped=True):
+    Each output directory keeps a manifest of the inputs (path, size and modification time)
+    and settings each realisation was digested with. Realisations whose inputs, settings and
+    the converter version are unchanged are skipped, unless force is set.
 
+    Returns the realisation directories that failed, after logging their tracebacks.
+    """
     dump_dir, output_dir, nml_file = get_directories(base_folder)
     logging.info("Found nml file %s" % nml_file)
     systematic_labels, systematics_scales = get_systematic_scales(nml_file, override=override)
@@ -323,6 +476,13 @@ def convert(base_folder, load_dump=False, override=False, skip=11, biascor=None,
     version = ""
     if base_folder.split("_")[-1].startswith("v"):
         version = "_" + base_folder.split("_")[-1]
+    settings = {"version": CONVERTER_VERSION, "scaling": get_scaling(), "systematics_scales": systematics_scales,
+                "systematic_labels": systematic_labels, "load_dump": load_dump, "skip": skip, "biascor": biascor,
+                "zipped": zipped}
+    output_dirs = {}
+    manifests = {}
+    entries = {}
+    jobs = []
     for sim in sim_dirs:
         sim_name = os.path.basename(sim)
         if "-0" in sim_name:
@@ -332,29 +492,76 @@ def convert(base_folder, load_dump=False, override=False, skip=11, biascor=None,
         if base_folder.endswith("sys"):
             this_output_dir += "sys"
         this_output_dir += version
-        digest_simulation(sim, systematics_scales, this_output_dir, systematic_labels, load_dump=load_dump,
-                          skip=skip, biascor=biascor, zipped=zipped)
+        output_dirs[sim] = this_output_dir
+        if this_output_dir not in manifests:
+            manifests[this_output_dir] = {} if force else load_manifest(this_output_dir)
+        ind = get_realisation_index(sim)
+        entries[sim] = {"inputs": describe_files(get_input_files(sim, load_dump=load_dump, biascor=biascor, zipped=zipped)),
+                        "settings": settings}
+        if not force and is_up_to_date(this_output_dir, manifests[this_output_dir], ind, entries[sim], load_dump=load_dump):
+            logging.debug("Skipping %s as it is up to date" % sim)
+            continue
+        jobs.append((sim, {"systematics_scales": systematics_scales, "output_dir": this_output_dir,
+                           "systematic_labels": systematic_labels, "load_dump": load_dump, "skip": skip,
+                           "biascor": biascor, "zipped": zipped, "save_names": False}))
+
+    logging.info("%d of %d realisations need digesting" % (len(jobs), len(sim_dirs)))
+
+    # Shared by every realisation in an output directory, so written once up front
+    for this_output_dir in sorted(set([output_dirs[sim] for sim, _ in jobs])):
+        save_labels(this_output_dir, get_saved_labels(systematics_scales, systematic_labels))
+
+    failures = []
+
+    def record(results):
+        for i, (sim, error, duration) in enumerate(results):
+            # Only this process writes manifests, so workers never race on them
+            this_output_dir = output_dirs[sim]
+            manifest = manifests[this_output_dir]
+            if error is None:
+                logging.info("Finished %d/%d: %s in %0.1fs" % (i + 1, len(jobs), sim, duration))
+                manifest[get_realisation_index(sim)] = entries[sim]
+            else:
+                logging.error("Failed %d/%d: %s after %0.1fs\n%s" % (i + 1, len(jobs), sim, duration, error))
+                manifest.pop(get_realisation_index(sim), None)
+                failures.append(sim)
+            save_manifest(this_output_dir, manifest)
 
+    if num_workers == 1:
+        record(map(digest_job, jobs))
+    else:
+        with Pool(processes=num_workers) as pool:
+            record(pool.imap_unordered(digest_job, jobs))
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG, format="[%(funcName)20s()] %(message)s")
-    # convert("DES3YR_LOWZ_COMBINED_TEXT_v8")
-    # convert("DES3YR_DES_COMBINED_TEXT_v8")
-    # convert("DES3YR_DES_NOMINAL")
-    # convert("DES3YR_LOWZ_NOMINAL")
-    # convert("DES3YR_DES_BULK_v8", skip=6)
-    # convert("DES3YR_LOWZ_BULK_v8", skip=6)
-    # convert("DES3YR_DES_SAM_COHERENT_v8", skip=11)
-    # convert("DES3YR_DES_SAM_MINUIT_v8", skip=11)
-    # convert("DES3YR_LOWZ_SAM_COHERENT_v8", skip=11)
-    # convert("DES3YR_LOWZ_SAM_MINUIT_v8", skip=11)
-    # convert("DES3YR_LOWZ_BULK", skip=6)
-    # convert("DES3YR_DES_SAMTEST", skip=11)
-    # convert("DES3YR_LOWZ_SAMTEST", skip=11)
-    convert("DES3YR_DES_BHMEFF_v8", load_dump=True, skip=11, zipped=True)
-    # convert("DES3YR_LOWZ_BHMEFF_v8", load_dump=True, skip=11, zipped=True)
-    # convert("DES3YR_LOWZ_VALIDATION", skip=11)
-    # convert("DES3YR_DES_VALIDATION", skip=11)
+    if failures:
+        logging.error("%d of %d realisations failed: %s" % (len(failures), len(jobs), [os.path.basename(f) for f in failures]))
 
+    if archive:
+        failed_dirs = set([output_dirs[f] for f in failures])
+        for this_output_dir in sorted(set([output_dirs[sim] for sim, _ in jobs])):
+            if this_output_dir in failed_dirs:
+                logging.warning("Not archiving %s as some of its realisations failed" % this_output_dir)
+            else:
+                build_archive(this_output_dir, remove=True)
+    return failures
 
 
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format="[%(funcName)20s()] %(message)s")
+    parser = argparse.ArgumentParser(description="Convert SNANA simulation outputs into the snana_data format")
+    parser.add_argument("base_folders", nargs="+", help="Folders in data_dump, eg DES3YR_DES_BHMEFF_v8")
+    parser.add_argument("--load_dump", action="store_true", help="Also convert the SIMGEN dump of all objects")
+    parser.add_argument("--override", action="store_true", help="Set all systematic scales to unity")
+    parser.add_argument("--skip", type=int, default=11, help="Header rows to skip, 6 for the BULK sims")
+    parser.add_argument("--biascor", default=None)
+    parser.add_argument("--unzipped", action="store_true", help="FITRES files are not gzipped")
+    parser.add_argument("--archive", action="store_true", help="Consolidate realisations into an archive")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--force", action="store_true", help="Redo realisations even if the manifest is up to date")
+    args = parser.parse_args()
+    # For example:
+    #   DES3YR_DES_BULK_v8 DES3YR_LOWZ_BULK_v8 --skip 6
+    #   DES3YR_DES_BHMEFF_v8 DES3YR_LOWZ_BHMEFF_v8 --load_dump
+    for base_folder in args.base_folders:
+        convert(base_folder, load_dump=args.load_dump, override=args.override, skip=args.skip, biascor=args.biascor,
+                zipped=not args.unzipped, archive=args.archive, num_workers=args.workers, force=args.force)
@@ -0,0 +1,98 @@
+import hashlib
+import logging
+import os
+import pickle
+
+import numpy as np
+
+_memory = {}
+
+
+def get_fingerprint(filenames):
+    """ Hash the path, size and modification time of each input file.
+
+    Cheap enough to compute on every call, and changes whenever an input
+    file is regenerated.
+    """
+    h = hashlib.sha1()
+    for filename in sorted(filenames):
+        stat = os.stat(filename)
+        h.update(("%s|%d|%d;" % (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)).encode("utf-8"))
+    return h.hexdigest()
+
+
+def get_hash(*args):
+    """ Deterministically hash (nested) python and numpy objects. """
+    h = hashlib.sha1()
+    _update_hash(h, args)
+    return h.hexdigest()
+
+
+def _update_hash(h, obj):
+    if isinstance(obj, dict):
+        h.update(b"dict")
+        for k in sorted(obj.keys(), key=str):
+            _update_hash(h, k)
+            _update_hash(h, obj[k])
+    elif isinstance(obj, (list, tuple)):
+        h.update(("%s%d" % (type(obj).__name__, len(obj))).encode("utf-8"))
+        for o in obj:
+            _update_hash(h, o)
+    elif isinstance(obj, np.ndarray):
+        h.update(("array%s%s" % (obj.dtype.str, obj.shape)).encode("utf-8"))
+        h.update(np.ascontiguousarray(obj).tobytes())
+    else:
+        h.update(("%s:%r" % (type(obj).__name__, obj)).encode("utf-8"))
+
+
+def load_cache(filename):
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+    except Exception as e:
+        logging.warning("Could not load cache file %s: %s" % (filename, e))
+        return None
+
+
+def save_cache(filename, obj):
+    """ Atomically write obj, so concurrent processes never see a partial file. """
+    directory = os.path.dirname(filename)
+    try:
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        temp = "%s.%d.tmp" % (filename, os.getpid())
+        with open(temp, "wb") as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, filename)
+    except OSError as e:
+        logging.warning("Could not write cache file %s: %s" % (filename, e))
+
+
+def cached(directory, name, key, func):
+    """ Return func() from memory, then from disk, computing and storing it if needed.
+
+    Parameters
+    ----------
+    directory : str
+        Where the cache files live.
+    name : str
+        A human readable prefix for the cache file.
+    key : str
+        Hash identifying the inputs, normally from :func:`get_fingerprint` or :func:`get_hash`.
+    func : callable
+        Computes the value when it is not cached.
+    """
+    filename = os.path.join(directory, "%s_%s.pkl" % (name, key))
+    if filename in _memory:
+        return _memory[filename]
+    result = load_cache(filename)
+    if result is None:
+        logging.info("Cache miss for %s, computing" % filename)
+        result = func()
+        save_cache(filename, result)
+    else:
+        logging.debug("Loaded %s from cache" % filename)
+    _memory[filename] = result
+    return result
@@ -0,0 +1,69 @@
+""" Batched validation and Cholesky factorisation of stacks of small covariance matrices.
+
+Supernova covariances are only 3x3, so rather than calling into LAPACK once per object,
+the factorisation runs one column at a time over the whole stack. Matrices that cannot
+be factorised are flagged with the reason, instead of raising on the first failure.
+"""
+from collections import Counter
+
+import numpy as np
+
+NON_FINITE = "non-finite entries"
+ASYMMETRIC = "not symmetric"
+NOT_POS_DEF = "not positive definite (pivot %d)"
+
+
+def cholesky_batch(covs, rtol=1e-6):
+    """ Lower triangular Cholesky factors of an ``(n, d, d)`` stack of covariances.
+
+    Parameters
+    ----------
+    covs : np.ndarray
+        The covariance matrices.
+    rtol : float, optional
+        Relative tolerance used when checking symmetry.
+
+    Returns
+    -------
+    chols : np.ndarray
+        The ``(n, d, d)`` factors in float64, zero for matrices that failed.
+    valid : np.ndarray
+        Boolean mask of matrices that were factorised.
+    reasons : np.ndarray
+        Why each matrix failed, or an empty string if it did not.
+    """
+    covs = np.asarray(covs, dtype=np.float64)
+    n, d = covs.shape[0], covs.shape[1]
+    chols = np.zeros(covs.shape)
+    reasons = np.full(n, "", dtype=object)
+
+    finite = np.all(np.isfinite(covs), axis=(1, 2))
+    reasons[~finite] = NON_FINITE
+    transposed = covs.transpose((0, 2, 1))
+    symmetric = np.all(np.abs(covs - transposed) <= rtol * np.abs(transposed), axis=(1, 2))
+    reasons[finite & ~symmetric] = ASYMMETRIC
+    valid = finite & symmetric
+
+    for j in range(d):
+        pivot = covs[:, j, j] - np.sum(chols[:, j, :j] ** 2, axis=1)
+        failed = valid & ~(pivot > 0)
+        reasons[failed] = NOT_POS_DEF % (j + 1)
+        valid &= ~failed
+        diagonal = np.sqrt(np.where(valid, pivot, 1.0))
+        chols[valid, j, j] = diagonal[valid]
+        below = covs[:, j + 1:, j] - np.einsum("nik,nk->ni", chols[:, j + 1:, :j], chols[:, j, :j])
+        chols[valid, j + 1:, j] = below[valid] / diagonal[valid, None]
+    chols[~valid] = 0
+    return chols, valid, reasons
+
+
+def describe_failures(reasons, ids=None, max_listed=5):
+    """ A one line summary of the failures from :func:`cholesky_batch`. """
+    failed = np.where(reasons != "")[0]
+    if not failed.size:
+        return "all %d covariances are valid" % reasons.size
+    counts = Counter(reasons[failed].tolist())
+    breakdown = ", ".join(["%d %s" % (v, k) for k, v in sorted(counts.items())])
+    listed = failed[:max_listed] if ids is None else np.asarray(ids)[failed[:max_listed]]
+    return "%d of %d covariances are invalid: %s. First failures: %s" \
+           % (failed.size, reasons.size, breakdown, ", ".join([str(i) for i in listed]))